@@ -4,6 +4,7 @@ from dotenv import load_dotenv
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import tempfile
 load_dotenv()
 
 # Thiết lập các biến môi trường cho OAuthlib
@@ -12,8 +13,21 @@ os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 
 app = Flask(__name__)
 
-cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+# FileSystemCache dùng chung giữa các worker gunicorn trên cùng máy mà không cần dịch vụ ngoài
+cache = Cache(config={
+    'CACHE_TYPE': os.environ.get('CACHE_TYPE', 'FileSystemCache'),
+    'CACHE_DIR': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'mkclan-cache')),
+    'CACHE_THRESHOLD': int(os.environ.get('CACHE_THRESHOLD', 1000)),
+})
 cache.init_app(app)
+# Trạng thái cần giữ tới khi hết hạn (token CoC, cursor warlog) nằm trong thư mục riêng không giới hạn số mục,
+# để việc dọn cache khi vượt CACHE_THRESHOLD (hàng nghìn hồ sơ người chơi) không xóa mất chúng
+state_cache = Cache(config={
+    'CACHE_TYPE': os.environ.get('STATE_CACHE_TYPE', 'FileSystemCache'),
+    'CACHE_DIR': os.environ.get('STATE_DIR', os.path.join(tempfile.gettempdir(), 'mkclan-state')),
+    'CACHE_THRESHOLD': 0,
+})
+state_cache.init_app(app)
 
 # Cấu hình Logger cho ứng dụng
 file_handler = RotatingFileHandler('app.log', maxBytes=1024000, backupCount=5)
@@ -22,6 +36,10 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 file_handler.setFormatter(formatter)
 app.logger.addHandler(file_handler)
 app.logger.setLevel(logging.INFO)
+# Module dựng mùa CWL (cwl_season.py) không phụ thuộc app nhưng vẫn ghi log vào app.log khi chạy trong worker
+cwl_season_logger = logging.getLogger('cwl_season')
+cwl_season_logger.addHandler(file_handler)
+cwl_season_logger.setLevel(logging.INFO)
 
 # Cấu hình ứng dụng từ biến môi trường
 app.secret_key = os.environ.get('SECRET_KEY')
@@ -29,6 +47,9 @@ app.config['AUTHORIZED_EMAILS'] = os.environ.get('AUTHORIZED_EMAILS')
 app.config['DRIVE_FOLDER_ID'] = os.environ.get('DRIVE_FOLDER_ID')
 app.config['WL_DRIVE_FOLDER_ID'] = os.environ.get('WL_DRIVE_FOLDER_ID')
 app.config['WL_RP_DRIVE_FOLDER_ID'] = os.environ.get('WL_RP_DRIVE_FOLDER_ID')
+# Clan mặc định; CLANS (JSON) cấu hình nhiều clan, mỗi clan có thư mục Drive riêng
+app.config['CLAN_TAG'] = os.environ.get('CLAN_TAG', '#2QCV8UJ8Q')
+app.config['CLANS'] = os.environ.get('CLANS')
 app.config['CLIENT_CONFIG'] = os.environ.get('GOOGLE_CLIENT_SECRET_JSON')
 app.config['CRON_SECRET_KEY'] = os.environ.get('CRON_SECRET_KEY')
 app.config['EMAIL'] = os.environ.get('COC_EMAIL')
@@ -36,5 +57,59 @@ app.config['PASSWORD'] = os.environ.get('COC_PASSWORD')
 app.config['CLAN_INFO_FILE_NAME'] = os.environ.get('CLAN_INFO_FILE_NAME')
 app.config['WARLOG_FILE_NAME'] = os.environ.get('WARLOG_FILE_NAME')
 app.config['API_URL'] = os.environ.get('API_URL')
+# Địa chỉ các dịch vụ bên ngoài, có thể trỏ tới máy chủ giả lập (benchmarks/)
+app.config['COC_API_URL'] = os.environ.get('COC_API_URL', 'https://api.clashofclans.com/v1')
+app.config['COC_DEVELOPER_URL'] = os.environ.get('COC_DEVELOPER_URL', 'https://developer.clashofclans.com/api')
+app.config['CLASHOFSTATS_API_URL'] = os.environ.get('CLASHOFSTATS_API_URL', 'https://api.clashofstats.com')
+app.config['GOOGLE_API_URL'] = os.environ.get('GOOGLE_API_URL')
+app.config['COC_POOL_SIZE'] = int(os.environ.get('COC_POOL_SIZE', 10))
+app.config['COC_KEEPALIVE_TIMEOUT'] = int(os.environ.get('COC_KEEPALIVE_TIMEOUT', 60))
+app.config['BLOCKING_IO_WORKERS'] = int(os.environ.get('BLOCKING_IO_WORKERS', 8))
+app.config['COC_TOKEN_TTL'] = int(os.environ.get('COC_TOKEN_TTL', 3500))
+app.config['COC_TOKEN_REFRESH_MARGIN'] = int(os.environ.get('COC_TOKEN_REFRESH_MARGIN', 300))
+app.config['COC_RATE_LIMIT'] = float(os.environ.get('COC_RATE_LIMIT', 10))
+app.config['COC_MIN_RATE_LIMIT'] = float(os.environ.get('COC_MIN_RATE_LIMIT', 1))
+app.config['COC_MAX_RATE_LIMIT'] = float(os.environ.get('COC_MAX_RATE_LIMIT', 30))
+app.config['COC_RATE_BURST'] = int(os.environ.get('COC_RATE_BURST', 10))
+app.config['COC_MAX_RETRIES'] = int(os.environ.get('COC_MAX_RETRIES', 3))
+app.config['COC_RUN_REQUEST_BUDGET'] = int(os.environ.get('COC_RUN_REQUEST_BUDGET', 200))
+app.config['JOB_MAX_WORKERS'] = int(os.environ.get('JOB_MAX_WORKERS', 2))
+app.config['JOB_HISTORY_SIZE'] = int(os.environ.get('JOB_HISTORY_SIZE', 100))
+# Trạng thái job trong cache dùng chung (cho mọi worker); khóa chống chạy trùng tự hết hạn nếu worker chết giữa chừng
+app.config['JOB_STATUS_TTL'] = int(os.environ.get('JOB_STATUS_TTL', 24 * 3600))
+app.config['JOB_ACTIVE_TTL'] = int(os.environ.get('JOB_ACTIVE_TTL', 3600))
+app.config['PLAYER_PROFILE_MAX_AGE'] = int(os.environ.get('PLAYER_PROFILE_MAX_AGE', 21600))
+# Mặc định giữ định dạng indent=4 của các tệp trên Drive; bật JSON_COMPACT để ghi JSON gọn (nhỏ hơn, khó đọc bằng tay)
+app.config['JSON_COMPACT'] = os.environ.get('JSON_COMPACT', 'false').lower() in ('1', 'true', 'yes')
+app.config['STORAGE_CODEC'] = os.environ.get('STORAGE_CODEC', 'json')
+app.config['JSON_SPOOL_MAX_SIZE'] = int(os.environ.get('JSON_SPOOL_MAX_SIZE', 1024 * 1024))
+app.config['DRIVE_UPLOAD_CHUNK_SIZE'] = int(os.environ.get('DRIVE_UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024))
+app.config['CREDENTIALS_REFRESH_MARGIN'] = int(os.environ.get('CREDENTIALS_REFRESH_MARGIN', 300))
+app.config['DRIVE_CLIENT_CACHE_SIZE'] = int(os.environ.get('DRIVE_CLIENT_CACHE_SIZE', 8))
+app.config['DRIVE_INDEX_TTL'] = int(os.environ.get('DRIVE_INDEX_TTL', 300))
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'drive')
+app.config['LOCAL_STORAGE_DIR'] = os.environ.get('LOCAL_STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'mkclan-storage'))
+app.config['CWL_ANALYTICS_FILE_NAME'] = os.environ.get('CWL_ANALYTICS_FILE_NAME', 'cwl_analytics.json')
+app.config['CWL_ROLLING_WINDOW'] = int(os.environ.get('CWL_ROLLING_WINDOW', 3))
+app.config['CWL_SEASON_CACHE_SIZE'] = int(os.environ.get('CWL_SEASON_CACHE_SIZE', 240))
+app.config['CLASHOFSTATS_RATE_LIMIT'] = float(os.environ.get('CLASHOFSTATS_RATE_LIMIT', 2))
+app.config['BACKFILL_PROCESS_WORKERS'] = int(os.environ.get('BACKFILL_PROCESS_WORKERS', 2))
+app.config['BACKFILL_MAX_SEASONS'] = int(os.environ.get('BACKFILL_MAX_SEASONS', 120))
+app.config['WARLOG_PAGE_SIZE'] = int(os.environ.get('WARLOG_PAGE_SIZE', 10))
+app.config['WARLOG_CURSOR_TTL'] = int(os.environ.get('WARLOG_CURSOR_TTL', 7 * 24 * 3600))
+# Số trận đã lưu ngay trước cursor được lấy lại mỗi lần để cập nhật khi API sửa kết quả (tối đa 50)
+app.config['WARLOG_CURSOR_OVERLAP'] = int(os.environ.get('WARLOG_CURSOR_OVERLAP', 3))
+# 'single': một tệp WARLOG_FILE_NAME; 'sharded': mỗi năm một shard kèm manifest (xem services/war_log_store.py)
+app.config['WARLOG_LAYOUT'] = os.environ.get('WARLOG_LAYOUT', 'single')
+app.config['READ_CACHE_TTL'] = int(os.environ.get('READ_CACHE_TTL', 60))
+app.config['READ_API_MAX_LIMIT'] = int(os.environ.get('READ_API_MAX_LIMIT', 500))
+app.config['PROFILE_CRON_JOBS'] = os.environ.get('PROFILE_CRON_JOBS', 'false').lower() in ('1', 'true', 'yes')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'mkclan-profiles'))
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', 20))
+app.config['PROFILE_SAMPLE_INTERVAL'] = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+
+# Chạy các view async trên event loop nền dùng chung để tái sử dụng pool kết nối
+from app.services.http_client import async_to_sync
+app.async_to_sync = async_to_sync
 
 from app import routes
\ No newline at end of file
@@ -1,16 +1,29 @@
 from . import app
-from flask import render_template, redirect, url_for, session, request, flash
+from flask import render_template, redirect, url_for, session, request, flash, make_response
 from functools import wraps
 from .services.drive_service import DriveService
-from .services.api_service import getCocApiToken, fetch_clan_info, fetch_war_log, process_wldata_and_upload, get_token
+from .services.storage import create_storage
+from .services.api_service import getCocApiToken, fetch_clan_info, fetch_war_log, fetch_war_log_updates, save_war_log_cursor, process_wldata_and_upload, process_wldata_backfill
+from .services.http_client import run_blocking
+from .services.job_runner import job_runner, report_progress
+from .services.credential_manager import CredentialManager
+from .services.cwl_analytics import process_cwl_analytics
+from .services.metrics import PIPELINE_DURATION, CONTENT_TYPE, render_metrics
+from .services.profiler import profiling_requested, run_profiled
+from .services.clans import get_clans, run_for_clans
+from .services.read_cache import read_cache, publish_output, body_etag, encode_body, compress_body, GZIP_MIN_SIZE
+from .services.war_log_store import ShardedWarLog, merge_wars, manifest_file_name, load_war_log_view
+from .services.rate_limiter import RequestBudget
 
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
 from werkzeug.exceptions import HTTPException
+import re
 import json
 import time
+import asyncio
 
 try:
     client_secret_json = json.loads(app.config['CLIENT_CONFIG'])
@@ -19,7 +32,7 @@ except (json.JSONDecodeError, TypeError):
     client_secret_json = None
 
 SCOPES = ["https://www.googleapis.com/auth/drive",  'https://www.googleapis.com/auth/userinfo.email']
-CLAN_TAG = '#2QCV8UJ8Q'
+credential_manager = CredentialManager(SCOPES)
 
 def login_required(f):
     @wraps(f)
@@ -75,7 +88,7 @@ def auth_callback():
         flow.fetch_token(authorization_response=request.url)        
         credentials = flow.credentials
         
-        user_info_service = build('oauth2', 'v2', credentials=credentials)
+        user_info_service = build('oauth2', 'v2', credentials=credentials, static_discovery=True, cache_discovery=False)
         user_info = user_info_service.userinfo().get().execute()
         user_email = user_info.get('email')
 
@@ -86,8 +99,10 @@ def auth_callback():
 
         session['credentials'] = credentials.to_json()
     
-        drive_service = DriveService(credentials=credentials)
+        drive_service = DriveService.for_credentials(credentials)
         drive_service.upload_string_to_drive(session['credentials'], 'token.json', app.config.get('DRIVE_FOLDER_ID'), num_backups_to_keep=0)
+        # token.json vừa thay đổi: các endpoint cron sẽ tải lại credentials ở lần gọi sau
+        credential_manager.invalidate()
 
         flash("Đăng nhập thành công!", "success")
         return redirect(url_for('home'))
@@ -113,32 +128,157 @@ def logout():
 async def home():
     return render_template('home.html', title='Trang chủ')
 
-async def process_data_and_upload(data_type, credentials):
+async def process_data_and_upload(data_type, credentials, clans=None, storage=None):
+    """
+    Lấy và lưu data_type cho các clan (mặc định mọi clan đã cấu hình) đồng thời,
+    dùng chung token CoC, storage và ngân sách request của lần chạy.
+    storage mặc định được tạo từ credentials.
+    """
     try:
-        coc_token_res = await getCocApiToken()
+        if data_type not in ('clan_info', 'war_log'):
+            return {"error": "Invalid data type"}
+        clans = clans or get_clans()
+        report_progress("fetching CoC token")
+        storage = storage or await create_storage(credentials)
+        # Lấy token CoC và nạp chỉ mục thư mục Drive của các clan song song;
+        # war_log chỉ nạp chỉ mục khi thật sự có trận mới (xem fetch_war_log)
+        preloads = [storage.preload_folder(clan.folder_id) for clan in clans] if data_type == 'clan_info' else []
+        coc_token_res, *_ = await asyncio.gather(getCocApiToken(), *preloads)
         if "error" in coc_token_res:
             return {"error": coc_token_res["error"]}
-        drive_service = DriveService(credentials=credentials)
+        budget = RequestBudget(app.config['COC_RUN_REQUEST_BUDGET'] * len(clans))
+        return await run_for_clans(clans, process_clan_data, data_type, coc_token_res["data"], storage, budget)
+    except Exception as e:
+        return {"error": str(e)}
+
+async def process_clan_data(clan, data_type, token, storage, budget):
+    try:
+        if data_type == 'war_log' and app.config['WARLOG_LAYOUT'] == 'sharded':
+            return await process_sharded_war_log(clan, token, storage, budget)
+        report_progress(f"fetching {data_type} for {clan.tag}")
         if data_type == 'clan_info':
-            data_res = await fetch_clan_info(coc_token_res["data"], CLAN_TAG)
+            data_res = await fetch_clan_info(token, clan.tag, budget=budget)
             file_name = app.config['CLAN_INFO_FILE_NAME']
-        elif data_type == 'war_log':
-            data_res = await fetch_war_log(coc_token_res["data"], CLAN_TAG, drive_service)
-            wl_last50 = json.dumps(data_res["last50"], indent=4)
-            drive_service.upload_string_to_drive(wl_last50, "war_log_50.json", app.config['DRIVE_FOLDER_ID'], num_backups_to_keep=0)
-            file_name = app.config['WARLOG_FILE_NAME']
         else:
-            return {"error": "Invalid data type"}
+            data_res = await fetch_war_log(token, clan, storage, budget=budget)
+            file_name = app.config['WARLOG_FILE_NAME']
         if "error" in data_res:
             return {"error": data_res["error"]}
+        if data_res.get("status") == "unchanged":
+            return data_res
 
-        data_str = json.dumps(data_res["data"], indent=4)
-        uploaded_res = drive_service.upload_string_to_drive(data_str, file_name, app.config['DRIVE_FOLDER_ID'], num_backups_to_keep=1)
-        
+        report_progress(f"uploading {data_type} for {clan.tag}")
+        # Dữ liệu được mã hóa JSON theo luồng ngay trong thread tải lên
+        # Chỉ war_log (lớn dần theo thời gian) dùng STORAGE_CODEC, các tệp nhỏ giữ JSON thuần
+        codec = None if data_type == 'war_log' else 'json'
+        uploads = [storage.upload_object(data_res["data"], file_name, clan.folder_id, num_backups_to_keep=1, codec=codec)]
+        if data_type == 'war_log':
+            uploads.append(storage.upload_object(data_res["last50"], "war_log_50.json", clan.folder_id, num_backups_to_keep=0, codec='json'))
+        # Các tệp độc lập với nhau nên được tải lên song song
+        uploaded_res, *other_res = await asyncio.gather(*uploads)
+        # Chỉ lưu cursor khi mọi tệp đã ghi xong, để lần chạy sau ghi lại tệp bị lỗi
+        failed = next((res for res in (uploaded_res, *other_res) if "error" in res), None)
+        if failed is not None:
+            return {"error": failed["error"]}
+        dataset = 'clan' if data_type == 'clan_info' else 'warlog'
+        await publish_output(storage, (clan.tag, dataset), data_res["data"], file_name, clan.folder_id)
+        if data_type == 'war_log':
+            await save_war_log_cursor(clan, data_res["cursor"], data_res["data"])
         return uploaded_res
     except Exception as e:
         return {"error": str(e)}
 
+async def process_sharded_war_log(clan, token, storage, budget):
+    """
+    Cập nhật warlog dạng shard: chỉ ghi lại shard của các trận mới và manifest,
+    war_log_50.json được dựng từ các shard mới nhất.
+    """
+    store = ShardedWarLog(storage, clan.folder_id)
+    report_progress(f"fetching war_log for {clan.tag}")
+    data_res = await fetch_war_log_updates(token, clan, store, budget=budget)
+    if "error" in data_res:
+        return {"error": data_res["error"]}
+    if data_res.get("status") == "unchanged":
+        return data_res
+
+    report_progress(f"uploading war_log for {clan.tag}")
+    uploaded_res = await store.append(data_res["data"])
+    last50 = await store.read(limit=50)
+    last50_res = await storage.upload_object(last50, "war_log_50.json", clan.folder_id, num_backups_to_keep=0, codec='json')
+    if "error" in last50_res:
+        return {"error": last50_res["error"]}
+
+    # Chỉ cập nhật bản trong cache đọc nếu đã có; nếu chưa, /data/warlog sẽ ghép các shard khi cần
+    cached = read_cache.peek((clan.tag, 'warlog'))
+    if cached is not None and isinstance(cached.data, list):
+        await publish_output(storage, (clan.tag, 'warlog'), merge_wars(cached.data, data_res["data"]), manifest_file_name(), clan.folder_id)
+    await save_war_log_cursor(clan, store.newest, last50)
+    return uploaded_res
+
+def uploaded_ids(uploaded_res):
+    # Kết quả nhiều clan có dạng {"clans": {tag: kết quả}}
+    if "clans" in uploaded_res:
+        return ", ".join(f"{tag}: {res.get('id')}" for tag, res in uploaded_res["clans"].items())
+    return uploaded_res["id"]
+
+async def get_api_credentials():
+    """
+    Lấy credentials Google cho các endpoint cron; được giữ trong bộ nhớ, chỉ gọi GAS Api khi cần.
+    """
+    return await credential_manager.get_credentials()
+
+async def run_cron_pipeline(data_type, *args):
+    """
+    Pipeline đầy đủ của các endpoint cron: lấy credentials rồi xử lý và tải dữ liệu lên Drive.
+    Thời gian chạy được ghi vào metric mkclan_pipeline_duration_seconds theo loại job.
+    """
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        result = await _run_cron_pipeline(data_type, *args)
+        if isinstance(result, dict) and "error" not in result:
+            status = result.get("status", "ok")
+        return result
+    finally:
+        PIPELINE_DURATION.observe(time.perf_counter() - started, job_type=data_type, status=status)
+
+async def load_storage():
+    """
+    Storage theo STORAGE_BACKEND cho các endpoint không có session người dùng (cron, đọc dữ liệu).
+    Chỉ lấy credentials Google khi backend cần Drive ('drive' hoặc mirror của 'write_through').
+    """
+    if app.config['STORAGE_BACKEND'] == 'local':
+        return {"data": await create_storage(None)}
+    report_progress("loading Google credentials")
+    cred_res = await get_api_credentials()
+    if "error" in cred_res:
+        return {"error": cred_res.get('error')}
+    return {"data": await create_storage(cred_res["data"])}
+
+async def _run_cron_pipeline(data_type, *args):
+    storage_res = await load_storage()
+    if "error" in storage_res:
+        return {"error": storage_res["error"]}
+    storage = storage_res["data"]
+    if data_type == 'current_war_league':
+        return await run_for_clans(get_clans(), lambda clan: process_wldata_and_upload(storage, clan))
+    if data_type == 'cwl_analytics':
+        return await run_for_clans(get_clans(), lambda clan: process_cwl_analytics(storage, clan))
+    if data_type == 'war_league_backfill':
+        return await process_wldata_backfill(storage, get_clans(), *args)
+    return await process_data_and_upload(data_type, None, storage=storage)
+
+async def start_cron_job(data_type, *args):
+    pipeline, pipeline_args = run_cron_pipeline, (data_type, *args)
+    # ?profile=1 (hoặc PROFILE_CRON_JOBS) ghi profile của lần chạy này vào PROFILE_DIR
+    if profiling_requested(request.args.get('profile')):
+        pipeline, pipeline_args = run_profiled, (data_type, run_cron_pipeline, data_type, *args)
+    # ?wait=1 giữ hành vi cũ: chạy toàn bộ pipeline và trả kết quả trong cùng request
+    if request.args.get('wait') == '1':
+        return await pipeline(*pipeline_args)
+    job = await job_runner.submit(data_type, pipeline, *pipeline_args, params=args)
+    return {"job_id": job["job_id"], "status": job["status"], "status_url": url_for('job_status_api', job_id=job["job_id"], key=request.args.get('key'))}, 202
+
 @app.route('/update-clan-info')
 @login_required
 async def update_clan_info():
@@ -148,13 +288,13 @@ async def update_clan_info():
         return redirect(url_for('index'))
     creds = Credentials.from_authorized_user_info(json.loads(creds_data), SCOPES)      
     if creds.expired and creds.refresh_token:
-        creds.refresh(Request())
+        await run_blocking(creds.refresh, Request())
         session['credentials'] = creds.to_json()
     uploaded_res = await process_data_and_upload('clan_info', creds)
     if "error" in uploaded_res:
         flash(f"Upload thất bại! Error: {uploaded_res["error"]}", "danger")
     else:
-        flash(f"Đã upload thành công với ID: {uploaded_res["id"]}", "success")
+        flash(f"Đã upload thành công với ID: {uploaded_ids(uploaded_res)}", "success")
     return redirect(url_for('home'))
 
 @app.route('/update-warlog')
@@ -166,13 +306,13 @@ async def update_warlog():
         return redirect(url_for('index'))      
     creds = Credentials.from_authorized_user_info(json.loads(creds_data), SCOPES) 
     if creds.expired and creds.refresh_token:
-        creds.refresh(Request())
+        await run_blocking(creds.refresh, Request())
         session['credentials'] = creds.to_json()
     uploaded_res = await process_data_and_upload('war_log', creds)
     if "error" in uploaded_res:
         flash(f"Upload thất bại! Error: {uploaded_res["error"]}", "danger")
     else:
-        flash(f"Đã upload thành công với ID: {uploaded_res["id"]}", "success")
+        flash(f"Đã upload thành công với ID: {uploaded_ids(uploaded_res)}", "success")
     return redirect(url_for('home'))
 
 @app.route('/api/update-clan-info')
@@ -180,50 +320,140 @@ async def update_clan_info_api():
     secret_from_request = request.args.get('key')
     if secret_from_request != app.config['CRON_SECRET_KEY']:
         return {"error":"Unauthorized access"}, 403
-    
-    cred_data = get_token()
-    if "error" in cred_data:
-        return {"error": cred_data.get('error')}
-    credentials = Credentials.from_authorized_user_info(cred_data.get('data'), SCOPES)
-    if credentials.expired and credentials.refresh_token:
-        credentials.refresh(Request())
-        drive_service = DriveService(credentials=credentials)
-        drive_service.upload_string_to_drive(credentials.to_json() , 'token.json', app.config.get('DRIVE_FOLDER_ID'), num_backups_to_keep=0)
-
-    uploaded_res = await process_data_and_upload('clan_info', credentials)
-    return uploaded_res
+    return await start_cron_job('clan_info')
 
 @app.route('/api/update-war-log')
 async def update_war_log_api():
     secret_from_request = request.args.get('key')
     if secret_from_request != app.config['CRON_SECRET_KEY']:
         return {"error":"Unauthorized access"}, 403
-    
-    cred_data = get_token()
-    if "error" in cred_data:
-        return {"error": cred_data.get('error')}
-    credentials = Credentials.from_authorized_user_info(cred_data.get('data'), SCOPES)
-    if credentials.expired and credentials.refresh_token:
-        credentials.refresh(Request())
-        drive_service = DriveService(credentials=credentials)
-        drive_service.upload_string_to_drive(credentials.to_json() , 'token.json', app.config.get('DRIVE_FOLDER_ID'), num_backups_to_keep=0)
-    uploaded_res = await process_data_and_upload('war_log', credentials)
-    return uploaded_res
+    return await start_cron_job('war_log')
 
 @app.route('/api/upload-current-war-league')
-def upload_current_war_league_api():
+async def upload_current_war_league_api():
     secret_from_request = request.args.get('key')
     if secret_from_request != app.config['CRON_SECRET_KEY']:
         return {"error":"Unauthorized access"}, 403
-    
-    cred_data = get_token()
-    if "error" in cred_data:
-        return {"error": cred_data.get('error')}
-    credentials = Credentials.from_authorized_user_info(cred_data.get('data'), SCOPES)
-    if credentials.expired and credentials.refresh_token:
-        credentials.refresh(Request())
-        drive_service = DriveService(credentials=credentials)
-        drive_service.upload_string_to_drive(credentials.to_json() , 'token.json', app.config.get('DRIVE_FOLDER_ID'), num_backups_to_keep=0)
-    drive_service = DriveService(credentials=credentials)
-    uploaded_res = process_wldata_and_upload(drive_service)
-    return uploaded_res
+    return await start_cron_job('current_war_league')
+
+@app.route('/api/backfill-war-league')
+async def backfill_war_league_api():
+    secret_from_request = request.args.get('key')
+    if secret_from_request != app.config['CRON_SECRET_KEY']:
+        return {"error":"Unauthorized access"}, 403
+    start_season = request.args.get('from')
+    end_season = request.args.get('to', start_season)
+    if not start_season:
+        return {"error":"Missing 'from' season (YYYY-MM)"}, 400
+    return await start_cron_job('war_league_backfill', start_season, end_season, request.args.get('force') == '1')
+
+@app.route('/api/update-cwl-analytics')
+async def update_cwl_analytics_api():
+    secret_from_request = request.args.get('key')
+    if secret_from_request != app.config['CRON_SECRET_KEY']:
+        return {"error":"Unauthorized access"}, 403
+    return await start_cron_job('cwl_analytics')
+
+SEASON_PATTERN = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+async def read_storage():
+    # Storage cho các endpoint đọc khi cache trống/hết hạn
+    storage_res = await load_storage()
+    if "error" in storage_res:
+        raise RuntimeError(storage_res["error"])
+    return storage_res["data"]
+
+def find_clan(tag):
+    clans = get_clans()
+    if not tag:
+        return clans[0]
+    tag = tag.strip().upper()
+    tag = tag if tag.startswith('#') else '#' + tag
+    return next((clan for clan in clans if clan.tag == tag), None)
+
+def cached_json_response(body, etag, gzip_body=None):
+    """
+    Trả JSON kèm ETag; 304 nếu client đã có bản này, nén gzip khi client chấp nhận.
+    gzip_body là hàm trả về nội dung đã nén (được cache sẵn cho các dataset đầy đủ).
+    """
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(etag):
+        return '', 304, headers
+    if len(body) >= GZIP_MIN_SIZE and 'gzip' in request.accept_encodings:
+        body = gzip_body() if gzip_body is not None else compress_body(body)
+        headers['Content-Encoding'] = 'gzip'
+    response = make_response(body, 200, headers)
+    response.mimetype = 'application/json'
+    return response
+
+async def load_dataset(clan_tag, key, file_name, folder_id, loader=None):
+    clan = find_clan(clan_tag)
+    if clan is None:
+        return None, ({"error": f"Unknown clan {clan_tag}"}, 404)
+    res = await read_cache.get((clan.tag, *key), file_name, folder_id(clan), read_storage, loader=loader)
+    if "error" in res:
+        return None, ({"error": res["error"]}, 404 if res.get("not_found") else 502)
+    return res["data"], None
+
+@app.route('/data/clan')
+async def read_clan_info():
+    dataset, error = await load_dataset(request.args.get('clan'), ('clan',), app.config['CLAN_INFO_FILE_NAME'], lambda clan: clan.folder_id)
+    if error:
+        return error
+    return cached_json_response(dataset.body(), dataset.etag(), dataset.gzip_body)
+
+@app.route('/data/cwl/<season>')
+async def read_cwl_season(season):
+    if not SEASON_PATTERN.match(season):
+        return {"error": "Invalid season, expected YYYY-MM"}, 400
+    dataset, error = await load_dataset(request.args.get('clan'), ('cwl', season), season + '.json', lambda clan: clan.wl_folder_id)
+    if error:
+        return error
+    return cached_json_response(dataset.body(), dataset.etag(), dataset.gzip_body)
+
+@app.route('/data/warlog')
+async def read_war_log():
+    """
+    Danh sách trận (endTime giảm dần) theo trang: ?since=<endTime> chỉ lấy các trận kết thúc sau mốc đó,
+    ?limit (mặc định 50, tối đa READ_API_MAX_LIMIT) và ?offset để phân trang.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), app.config['READ_API_MAX_LIMIT'])
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return {"error": "limit and offset must be integers"}, 400
+    if app.config['WARLOG_LAYOUT'] == 'sharded':
+        dataset, error = await load_dataset(request.args.get('clan'), ('warlog',), manifest_file_name(), lambda clan: clan.folder_id, loader=load_war_log_view)
+    else:
+        dataset, error = await load_dataset(request.args.get('clan'), ('warlog',), app.config['WARLOG_FILE_NAME'], lambda clan: clan.folder_id)
+    if error:
+        return error
+    if not isinstance(dataset.data, list):
+        return {"error": "Stored war log is not a list"}, 502
+    since = request.args.get('since')
+    total = dataset.wars_after(since) if since else len(dataset.data)
+    items = dataset.data[offset:min(offset + limit, total)]
+    next_offset = offset + limit if offset + limit < total else None
+    page = {
+        "items": items,
+        "paging": {"total": total, "offset": offset, "limit": limit, "next_offset": next_offset},
+    }
+    body = encode_body(page)
+    return cached_json_response(body, body_etag(body))
+
+@app.route('/metrics')
+def metrics():
+    secret_from_request = request.args.get('key')
+    if secret_from_request != app.config['CRON_SECRET_KEY']:
+        return {"error":"Unauthorized access"}, 403
+    return render_metrics(), 200, {'Content-Type': CONTENT_TYPE}
+
+@app.route('/api/jobs/<job_id>')
+def job_status_api(job_id):
+    secret_from_request = request.args.get('key')
+    if secret_from_request != app.config['CRON_SECRET_KEY']:
+        return {"error":"Unauthorized access"}, 403
+    job = job_runner.get(job_id)
+    if job is None:
+        return {"error": "Job not found"}, 404
+    return job
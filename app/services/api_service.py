@@ -1,33 +1,112 @@
-from .. import app, cache
+from .. import app, cache, state_cache
+import os
 import json
+import time
+import fcntl
+import weakref
+import tempfile
+import hashlib
 import datetime
 import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import aiohttp
 import requests
 import urllib.parse
-from .data_processor import process_wl_data, deep_merge
+from cwl_season import build_wl_season_from_bytes
+from .data_processor import process_wl_data, upload_wl_season, deep_merge
+from .http_client import get_coc_session, run_blocking
+from .job_runner import report_progress
+from .clans import run_for_clans
+from .war_log_store import merge_wars
+from .metrics import API_REQUESTS, API_RETRIES, API_REQUEST_DURATION, API_RATE_LIMIT_WAIT, SERIALIZATION_DURATION, SERIALIZATION_BYTES, COC_TOKEN_CACHE, COC_LOGINS
+from .rate_limiter import get_coc_rate_limiter, get_clashofstats_rate_limiter, RequestBudget, backoff_delay, parse_retry_after
 
 MEMBER_EXCLUDED_KEYS = ['playerHouse', 'clan', 'achievements', 'labels', 'troops', 'heroes', 'heroEquipment', 'spells']
+# Khóa single-flight cho việc đăng nhập CoC, mỗi event loop một khóa
+_token_locks = weakref.WeakKeyDictionary()
+_token_refresh_task = None
+# Mã lỗi HTTP tạm thời, được retry với backoff
+RETRYABLE_STATUSES = {429, 502, 503, 504}
+CLASHOFSTATS_CWL_PATH = "/clans/{clan}/cwl/seasons/{season}"
+# Các trường tóm tắt trong memberList cũng có trong hồ sơ người chơi, dùng để phát hiện thay đổi
+PLAYER_SUMMARY_KEYS = ['name', 'role', 'expLevel', 'league', 'trophies', 'builderBaseTrophies', 'donations', 'donationsReceived', 'townHallLevel']
 
-async def fetch_data(session, url, semaphore, params=None, headers=None, timeout=10):
-    async with semaphore:
-        try:
-            async with session.get(url, params=params, headers=headers, timeout=timeout) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return {"data": data}
-        except asyncio.TimeoutError:
-            app.logger.error(f"Error: The request to {url} timed out after {timeout} seconds.")
-            return {"error": f"Request to {url} timed out."}
-        except aiohttp.ClientResponseError as e:
-            app.logger.error(f"RequestException: Error fetching data from {url}: {e}")
-            return {"error": f"Failed to fetch data from {url}: {e}"}
-        except Exception as e:
-            app.logger.error(f"An unexpected error occurred while fetching data from {url}: {e}")
-            return {"error": f"An unexpected error occurred: {e}"}
+async def fetch_data(session, url, params=None, headers=None, timeout=10, budget=None, limiter=None, raw=False, endpoint=None):
+    """
+    Gọi CoC API qua rate limiter dùng chung (hoặc limiter được truyền vào); retry với backoff khi bị
+    giới hạn (429/503), lỗi gateway, timeout hoặc lỗi kết nối. raw=True trả về nội dung bytes chưa giải mã.
+    endpoint là mẫu đường dẫn (vd. "/players/{playerTag}") dùng làm nhãn metric.
+    """
+    limiter = limiter or get_coc_rate_limiter()
+    endpoint = endpoint or 'other'
+    max_retries = app.config['COC_MAX_RETRIES']
+    started = time.perf_counter()
+    status = None
+    error = None
+    try:
+        for attempt in range(max_retries + 1):
+            if budget is not None and not budget.consume():
+                status = 'budget_exhausted'
+                app.logger.error(f"Request budget exhausted before fetching {url}.")
+                return {"error": f"Request budget exhausted before fetching {url}."}
+            with API_RATE_LIMIT_WAIT.time(endpoint=endpoint):
+                await limiter.acquire()
+            retry_after = None
+            try:
+                async with session.get(url, params=params, headers=headers, timeout=timeout) as response:
+                    status = str(response.status)
+                    API_REQUESTS.inc(endpoint=endpoint, status=status)
+                    if response.status in RETRYABLE_STATUSES:
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        if response.status in (429, 503):
+                            limiter.on_throttle(retry_after)
+                        error = f"HTTP {response.status} {response.reason}"
+                    else:
+                        if response.status == 304:
+                            limiter.on_success()
+                            return {"not_modified": True, "etag": response.headers.get('ETag')}
+                        response.raise_for_status()
+                        body = await response.read()
+                        if raw:
+                            data = body
+                        else:
+                            with SERIALIZATION_DURATION.time(operation='decode', codec='json'):
+                                data = json.loads(body)
+                            SERIALIZATION_BYTES.inc(len(body), operation='decode', codec='json')
+                        limiter.on_success()
+                        return {"data": data, "etag": response.headers.get('ETag')}
+            except asyncio.TimeoutError:
+                status = 'timeout'
+                API_REQUESTS.inc(endpoint=endpoint, status=status)
+                app.logger.warning(f"Error: The request to {url} timed out after {timeout} seconds.")
+                error = f"Request to {url} timed out."
+            except aiohttp.ClientResponseError as e:
+                app.logger.error(f"RequestException: Error fetching data from {url}: {e}")
+                return {"error": f"Failed to fetch data from {url}: {e}"}
+            except aiohttp.ClientConnectionError as e:
+                status = 'connection_error'
+                API_REQUESTS.inc(endpoint=endpoint, status=status)
+                app.logger.warning(f"Connection error while fetching data from {url}: {e}")
+                error = f"Connection error: {e}"
+            except Exception as e:
+                status = status or 'error'
+                app.logger.error(f"An unexpected error occurred while fetching data from {url}: {e}")
+                return {"error": f"An unexpected error occurred: {e}"}
+
+            if attempt < max_retries:
+                API_RETRIES.inc(endpoint=endpoint)
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                app.logger.warning(f"Retrying {url} in {delay:.2f}s after: {error} (attempt {attempt + 1}/{max_retries})")
+                await asyncio.sleep(delay)
+
+        app.logger.error(f"Giving up on {url} after {max_retries + 1} attempts: {error}")
+        return {"error": f"Failed to fetch data from {url}: {error}"}
+    finally:
+        API_REQUEST_DURATION.observe(time.perf_counter() - started, endpoint=endpoint, status=status or 'error')
 
 async def login_coc(email, password):
-    login_url = "https://developer.clashofclans.com/api/login"
+    login_url = f"{app.config['COC_DEVELOPER_URL']}/login"
     payload = {
         "email": email,
         "password": password
@@ -36,157 +115,499 @@ async def login_coc(email, password):
         "Content-Type": "application/json"
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(login_url, data=json.dumps(payload), headers=headers) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return {"data": data}
+        session = await get_coc_session()
+        async with session.post(login_url, data=json.dumps(payload), headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+            COC_LOGINS.inc(status='ok')
+            return {"data": data}
     except aiohttp.ClientResponseError as e:
+        COC_LOGINS.inc(status='error')
         app.logger.error(f"RequestException: Error calling login API: {e}")
         return {"error": f"Failed to call coc login API: {e}"}
     except Exception as e:
+        COC_LOGINS.inc(status='error')
         app.logger.error(f"An unexpected error occurred during coc login: {e}")
         return {"error": f"An unexpected error occurred during coc login: {e}"}
 
+def _fresh_coc_token(cached):
+    # Token còn hạn lâu hơn COC_TOKEN_REFRESH_MARGIN thì chưa cần làm mới
+    if isinstance(cached, dict) and cached.get('expires_at', 0) - time.time() > app.config['COC_TOKEN_REFRESH_MARGIN']:
+        return cached['token']
+    return None
+
+def _get_token_lock():
+    loop = asyncio.get_running_loop()
+    lock = _token_locks.get(loop)
+    if lock is None:
+        lock = asyncio.Lock()
+        _token_locks[loop] = lock
+    return lock
+
+def _acquire_token_file_lock():
+    # Khóa file để chỉ một worker đăng nhập tại một thời điểm
+    lock_dir = state_cache.config.get('CACHE_DIR') or tempfile.gettempdir()
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = open(os.path.join(lock_dir, 'coc_api_token.lock'), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def _release_token_file_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+async def refresh_coc_api_token():
+    """
+    Đăng nhập lấy token mới theo kiểu single-flight: trong một worker chỉ một coroutine đăng nhập,
+    giữa các worker thì dùng khóa file; bên chờ sẽ dùng lại token vừa được lưu vào cache.
+    """
+    async with _get_token_lock():
+        token = _fresh_coc_token(await run_blocking(state_cache.get, 'coc_api_token'))
+        if token is not None:
+            return {"data": token}
+
+        lock_file = await run_blocking(_acquire_token_file_lock)
+        try:
+            token = _fresh_coc_token(await run_blocking(state_cache.get, 'coc_api_token'))
+            if token is not None:
+                return {"data": token}
+
+            email = app.config.get('EMAIL')
+            password = app.config.get('PASSWORD')
+            if not email or not password:
+                app.logger.error("COC_EMAIL or COC_PASSWORD not found in config.")
+                return {"error": "Authentication credentials not configured."}
+                
+            login_response = await login_coc(email, password)
+            if 'error' in login_response:
+                app.logger.error(f"Login failed: {login_response['error']}")
+                return {"error": "Login to COC API failed."}
+                
+            if 'temporaryAPIToken' not in login_response['data']:
+                app.logger.error("temporaryAPIToken not found in login response.")
+                return {"error": "temporaryAPIToken not found in login response."}
+
+            token = login_response['data']['temporaryAPIToken']
+            ttl = app.config['COC_TOKEN_TTL']
+            await run_blocking(state_cache.set, 'coc_api_token', {"token": token, "expires_at": time.time() + ttl}, timeout=ttl)
+            app.logger.info("Logged in to CoC API and cached a new token.")
+            return {"data": token}
+        finally:
+            await run_blocking(_release_token_file_lock, lock_file)
+
+def _schedule_token_refresh():
+    global _token_refresh_task
+    if _token_refresh_task is None or _token_refresh_task.done():
+        _token_refresh_task = asyncio.ensure_future(refresh_coc_api_token())
+
 async def getCocApiToken():
-    token = cache.get('coc_api_token')
-    if token is None:
-        email = app.config.get('EMAIL')
-        password = app.config.get('PASSWORD')
-        if not email or not password:
-            app.logger.error("COC_EMAIL or COC_PASSWORD not found in config.")
-            return {"error": "Authentication credentials not configured."}
-            
-        login_response = await login_coc(email, password)
-        if 'error' in login_response:
-            app.logger.error(f"Login failed: {login_response['error']}")
-            return {"error": "Login to COC API failed."}
-            
-        if 'temporaryAPIToken' not in login_response['data']:
-            app.logger.error("temporaryAPIToken not found in login response.")
-            return {"error": "temporaryAPIToken not found in login response."}
-
-        token = login_response['data']['temporaryAPIToken']
-        cache.set('coc_api_token', token, timeout=3500)
-    return {"data": token}
-
-async def fetch_clan_info(token, clan_tag):
+    cached = await run_blocking(state_cache.get, 'coc_api_token')
+    if isinstance(cached, dict) and cached.get('expires_at', 0) > time.time():
+        # Sắp hết hạn: vẫn dùng token hiện tại và làm mới ở nền
+        if _fresh_coc_token(cached) is None:
+            COC_TOKEN_CACHE.inc(result='stale')
+            _schedule_token_refresh()
+        else:
+            COC_TOKEN_CACHE.inc(result='hit')
+        return {"data": cached['token']}
+    COC_TOKEN_CACHE.inc(result='miss')
+    return await refresh_coc_api_token()
+
+def player_fingerprint(member):
+    summary = {key: member.get(key) for key in PLAYER_SUMMARY_KEYS}
+    return hashlib.sha1(json.dumps(summary, sort_keys=True).encode('utf-8')).hexdigest()
+
+async def fetch_member_profile(session, member, headers, budget=None):
+    """
+    Lấy hồ sơ người chơi, dùng lại bản trong cache nếu tóm tắt trong memberList không đổi
+    và bản cache chưa quá PLAYER_PROFILE_MAX_AGE; khi tải lại thì gửi kèm If-None-Match.
+    """
+    cache_key = f"player_profile:{member['tag']}"
+    fingerprint = player_fingerprint(member)
+    max_age = app.config['PLAYER_PROFILE_MAX_AGE']
+    cached = await run_blocking(cache.get, cache_key)
+    if cached is not None and cached['fingerprint'] == fingerprint and time.time() - cached['fetched_at'] < max_age:
+        return {"data": cached['profile']}
+
+    request_headers = dict(headers)
+    if cached is not None and cached.get('etag'):
+        request_headers['If-None-Match'] = cached['etag']
+    url = f"{app.config['COC_API_URL']}/players/{urllib.parse.quote(member['tag'])}"
+    member_res = await fetch_data(session, url, headers=request_headers, budget=budget, endpoint='/players/{playerTag}')
+    if 'error' in member_res:
+        if cached is not None:
+            app.logger.warning(f"Using cached profile for {member['tag']} after error: {member_res['error']}")
+            return {"data": cached['profile']}
+        return member_res
+
+    if member_res.get('not_modified') and cached is not None:
+        profile = cached['profile']
+        etag = member_res.get('etag') or cached.get('etag')
+    elif 'data' in member_res:
+        # Chỉ giữ các trường sẽ được ghi ra để cache gọn nhẹ
+        profile = {key: value for key, value in member_res['data'].items() if key not in MEMBER_EXCLUDED_KEYS}
+        etag = member_res.get('etag')
+    else:
+        return {"error": f"Unexpected 304 response for player {member['tag']} without cached profile."}
+
+    await run_blocking(cache.set, cache_key, {
+        "fingerprint": fingerprint,
+        "fetched_at": time.time(),
+        "etag": etag,
+        "profile": profile,
+    }, timeout=max_age * 4)
+    return {"data": profile}
+
+async def fetch_clan_info(token, clan_tag, budget=None):
     if not token or not clan_tag:
         return {"error": "Token or clan tag is missing."}
         
-    url = f"https://api.clashofclans.com/v1/clans/{urllib.parse.quote(clan_tag)}"
+    url = f"{app.config['COC_API_URL']}/clans/{urllib.parse.quote(clan_tag)}"
     headers = {
         "Authorization": f"Bearer {token}"
     }
 
-    async with aiohttp.ClientSession() as session:
-        semaphore = asyncio.Semaphore(6)
-        clan_data_res = await fetch_data(session, url, semaphore=semaphore, headers=headers)
-        if 'error' in clan_data_res:
-            return {"error": f"Failed to fetch clan info: {clan_data_res['error']}"}
-
-        clan_data = clan_data_res['data']
-        if 'memberList' in clan_data and len(clan_data['memberList']) > 0:
-            new_member_list = []
-            member_tasks = []
-            for member in clan_data['memberList']:
-                member_tasks.append(fetch_data(session, f"https://api.clashofclans.com/v1/players/{urllib.parse.quote(member['tag'])}", semaphore=semaphore, headers=headers))
-                
-            member_data_results = await asyncio.gather(*member_tasks)
+    session = await get_coc_session()
+    # Có thể dùng chung một ngân sách request cho nhiều clan trong cùng một job
+    budget = budget or RequestBudget(app.config['COC_RUN_REQUEST_BUDGET'])
+    clan_data_res = await fetch_data(session, url, headers=headers, budget=budget, endpoint='/clans/{clanTag}')
+    if 'error' in clan_data_res:
+        return {"error": f"Failed to fetch clan info: {clan_data_res['error']}"}
 
-            for member, member_data in zip(clan_data['memberList'], member_data_results):
-                if member_data is not None and 'error' not in member_data:
-                    merge_data = deep_merge(member.copy(), member_data['data'])
-                    final_member_data = {key: value for key, value in merge_data.items() if key not in MEMBER_EXCLUDED_KEYS}
-                    new_member_list.append(final_member_data)
+    clan_data = clan_data_res['data']
+    if 'memberList' in clan_data and len(clan_data['memberList']) > 0:
+        new_member_list = []
+        member_tasks = []
+        for member in clan_data['memberList']:
+            member_tasks.append(fetch_member_profile(session, member, headers, budget=budget))
 
-            clan_data['memberList'] = new_member_list
-        return {"data": clan_data}
+        member_data_results = await asyncio.gather(*member_tasks)
 
-async def fetch_war_log(token, clan_tag, drive_service):
-    if not token or not clan_tag:
+        for member, member_data in zip(clan_data['memberList'], member_data_results):
+            if member_data is not None and 'error' not in member_data:
+                merge_data = deep_merge(member.copy(), member_data['data'])
+                final_member_data = {key: value for key, value in merge_data.items() if key not in MEMBER_EXCLUDED_KEYS}
+                new_member_list.append(final_member_data)
+            else:
+                # Không lấy được hồ sơ: giữ thông tin tóm tắt thay vì bỏ mất thành viên
+                app.logger.warning(f"Keeping summary data only for member {member.get('tag')}.")
+                new_member_list.append({key: value for key, value in member.items() if key not in MEMBER_EXCLUDED_KEYS})
+
+        clan_data['memberList'] = new_member_list
+    return {"data": clan_data}
+
+def _war_log_cursor_key(clan):
+    # Cursor riêng cho mỗi WARLOG_LAYOUT để lần chạy đầu sau khi đổi dạng lưu luôn đồng bộ (và chuyển đổi) toàn bộ
+    if app.config['WARLOG_LAYOUT'] == 'sharded':
+        return f"warlog_cursor:sharded:{clan.tag}"
+    return f"warlog_cursor:{clan.tag}"
+
+def _war_log_overlap_key(clan):
+    return _war_log_cursor_key(clan) + ':overlap'
+
+def war_window_hash(wars):
+    return hashlib.sha256(json.dumps(wars, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+async def save_war_log_cursor(clan, cursor, recent_wars=()):
+    """
+    Ghi nhớ endTime mới nhất đã lưu của clan cùng hash của WARLOG_CURSOR_OVERLAP trận mới nhất trong recent_wars
+    (mới nhất trước); chỉ gọi sau khi warlog (tệp đơn hoặc các shard) đã được lưu thành công.
+    Hết hạn sau WARLOG_CURSOR_TTL để định kỳ đồng bộ lại toàn bộ warlog.
+    """
+    if cursor:
+        overlap_hash = war_window_hash(list(recent_wars[:app.config['WARLOG_CURSOR_OVERLAP']]))
+        await run_blocking(state_cache.set_many, {_war_log_cursor_key(clan): cursor, _war_log_overlap_key(clan): overlap_hash},
+                           timeout=app.config['WARLOG_CURSOR_TTL'])
+
+async def _overlap_unchanged(clan, overlap_wars):
+    # So với hash đã lưu cùng cursor: khác nghĩa là API đã sửa một trận đã lưu (hoặc chưa có hash)
+    return await run_blocking(state_cache.get, _war_log_overlap_key(clan)) == war_window_hash(overlap_wars)
+
+async def fetch_new_wars(session, url, headers, budget, cursor, overlap=0):
+    """
+    Lấy các trận có endTime mới hơn cursor theo từng trang (limit/after) của CoC API, kèm tối đa overlap
+    trận đã lưu gần cursor nhất ("overlap") để cập nhật các trận được sửa sau khi lưu.
+    Dừng ngay khi đã đủ, thường chỉ tốn một request nhỏ.
+    """
+    new_wars, stored_wars = [], []
+    params = {"limit": app.config['WARLOG_PAGE_SIZE']}
+    while True:
+        page_res = await fetch_data(session, url, params=params, headers=headers, budget=budget, endpoint='/clans/{clanTag}/warlog')
+        if 'error' in page_res:
+            return page_res
+        if 'items' not in page_res['data']:
+            return {"error": "No 'items' key found in API warlog data."}
+        items = page_res['data']['items']
+        reached_cursor = False
+        for war in items:
+            if war.get('endTime', '') > cursor:
+                new_wars.append(war)
+            else:
+                reached_cursor = True
+                if len(stored_wars) < overlap:
+                    stored_wars.append(war)
+        after = page_res['data'].get('paging', {}).get('cursors', {}).get('after')
+        if (reached_cursor and len(stored_wars) >= overlap) or not after:
+            return {"data": new_wars, "overlap": stored_wars}
+        params = {"limit": app.config['WARLOG_PAGE_SIZE'], "after": after}
+
+async def fetch_war_log_changes(token, clan, budget, load_stored):
+    """
+    Phần chung của hai dạng lưu warlog: lấy từ CoC API các trận mới hơn cursor đã lưu cùng vài trận ngay trước cursor
+    (WARLOG_CURSOR_OVERLAP), hoặc toàn bộ warlog khi chưa có cursor. load_stored là coroutine function tải dữ liệu
+    đã lưu của dạng lưu tương ứng, chạy song song với request API khi chưa có cursor.
+    Trả về {"status": "unchanged", ...} (không gọi load_stored) nếu không có trận nào mới hay được sửa,
+    {"data": các trận của API, "cursor": cursor hoặc None, "stored": kết quả của load_stored} hoặc {"error": ...}.
+    """
+    if not token or not clan:
         return {"error": "Token or clan tag is missing."}
-        
-    url = f"https://api.clashofclans.com/v1/clans/{urllib.parse.quote(clan_tag)}/warlog"
+
+    url = f"{app.config['COC_API_URL']}/clans/{urllib.parse.quote(clan.tag)}/warlog"
     headers = {
         "Authorization": f"Bearer {token}"
     }
-    async with aiohttp.ClientSession() as session:
-        semaphore = asyncio.Semaphore(4)
-        api_warlog_res = await fetch_data(session, url, semaphore=semaphore, headers=headers)
+    session = await get_coc_session()
+    cursor = await run_blocking(state_cache.get, _war_log_cursor_key(clan))
 
+    if cursor:
+        api_warlog_res = await fetch_new_wars(session, url, headers, budget, cursor, app.config['WARLOG_CURSOR_OVERLAP'])
         if 'error' in api_warlog_res:
             app.logger.error(f"Failed to fetch warlog: {api_warlog_res['error']}")
             return {"error": f"Failed to fetch warlog: {api_warlog_res['error']}"}
+        if not api_warlog_res['data']:
+            if await _overlap_unchanged(clan, api_warlog_res['overlap']):
+                app.logger.info(f"No war ended for {clan.tag} since {cursor}, skipping war log update.")
+                return {"status": "unchanged", "info": f"No new war since {cursor}."}
+            app.logger.info(f"Stored wars of {clan.tag} up to {cursor} changed in the API, merging them again.")
+        # Các trận của API được ưu tiên khi trùng endTime nên bản sửa của các trận đã lưu được ghi đè
+        return {"data": api_warlog_res['data'] + api_warlog_res['overlap'], "cursor": cursor, "stored": await load_stored()}
 
-        api_warlog_data = api_warlog_res['data']
-        
-        if 'items' not in api_warlog_data:
-            app.logger.warning("No 'items' key found in API warlog data.")
-            return {"error": "No 'items' key found in API warlog data."}
+    # Chưa có cursor (lần đầu hoặc cursor hết hạn): tải toàn bộ warlog từ API và dữ liệu đã lưu song song
+    api_warlog_res, stored = await asyncio.gather(
+        fetch_data(session, url, headers=headers, budget=budget, endpoint='/clans/{clanTag}/warlog'),
+        load_stored()
+    )
+    if 'error' in api_warlog_res:
+        app.logger.error(f"Failed to fetch warlog: {api_warlog_res['error']}")
+        return {"error": f"Failed to fetch warlog: {api_warlog_res['error']}"}
+    if 'items' not in api_warlog_res['data']:
+        app.logger.warning("No 'items' key found in API warlog data.")
+        return {"error": "No 'items' key found in API warlog data."}
+    return {"data": api_warlog_res['data']['items'], "cursor": None, "stored": stored}
 
-        new_warlogs = api_warlog_data.get('items', [])
-        combined_warlogs = {}
+async def fetch_war_log(token, clan, storage, budget=None):
+    """
+    Gộp các trận mới từ CoC API vào war_log.json đã lưu. Khi đã biết endTime mới nhất đã lưu (cursor),
+    chỉ lấy các trận mới hơn cùng vài trận ngay trước cursor (WARLOG_CURSOR_OVERLAP) và trả về status "unchanged"
+    mà không đọc storage nếu không có trận nào mới hay được sửa.
+    """
+    # Có thể dùng chung một ngân sách request cho nhiều clan trong cùng một job
+    budget = budget or RequestBudget(app.config['COC_RUN_REQUEST_BUDGET'])
 
-        for war in new_warlogs:
-            war_id = war.get('endTime', str(war))
-            combined_warlogs[war_id] = war
+    async def load_stored():
+        # Nạp chỉ mục thư mục cùng lúc với việc tải war_log.json cũ
+        json_data, _ = await asyncio.gather(
+            storage.get_object(app.config.get('WARLOG_FILE_NAME'), clan.folder_id),
+            storage.preload_folder(clan.folder_id)
+        )
+        return json_data
 
-        
-        json_data = drive_service.get_json_file_from_folder(app.config.get('WARLOG_FILE_NAME'), app.config.get('DRIVE_FOLDER_ID'))
+    changes = await fetch_war_log_changes(token, clan, budget, load_stored)
+    if "data" not in changes:
+        return changes
+    json_data = changes["stored"]
+
+    combined_warlogs = {}
 
-        if "error" in json_data:
+    for war in changes["data"]:
+        war_id = war.get('endTime', str(war))
+        combined_warlogs[war_id] = war
+
+    if "error" in json_data:
+        if await storage.find_files(app.config.get('WARLOG_FILE_NAME'), clan.folder_id):
             return {"error": "An unexpected error occurred during load old war_log.json from drive"}
-        else:
-            existing_warlog_content = json_data.get('data')
-            if existing_warlog_content:
-                try:
-                    existing_warlog_data = json.loads(existing_warlog_content)
-                    if isinstance(existing_warlog_data, list):
-                        for war in existing_warlog_data:
-                            war_id = war.get('endTime', str(war))
-                            if war_id not in combined_warlogs:
-                                combined_warlogs[war_id] = war
-                    else:
-                        app.logger.warning("Old warlog file format is invalid (not a list).")
-                except json.JSONDecodeError:
-                    app.logger.error("JSON decode error when reading old warlog file.")
-                except Exception as e:
-                    app.logger.error(f"Error processing old warlog data: {e}")
+        if changes["cursor"]:
+            # Cursor còn nhưng tệp đã mất: đồng bộ lại toàn bộ thay vì chỉ ghi các trận mới
+            app.logger.warning(f"Stored war log for {clan.tag} is missing, refetching the full war log.")
+            await run_blocking(state_cache.delete, _war_log_cursor_key(clan))
+            return await fetch_war_log(token, clan, storage, budget)
+        # Clan mới chưa có war_log.json: bắt đầu từ warlog của API
+        app.logger.info(f"No stored war log for {clan.tag}, starting a new one.")
+    else:
+        existing_warlog_data = json_data.get('data')
+        if existing_warlog_data:
+            try:
+                if isinstance(existing_warlog_data, list):
+                    for war in existing_warlog_data:
+                        war_id = war.get('endTime', str(war))
+                        if war_id not in combined_warlogs:
+                            combined_warlogs[war_id] = war
+                else:
+                    app.logger.warning("Old warlog file format is invalid (not a list).")
+            except Exception as e:
+                app.logger.error(f"Error processing old warlog data: {e}")
 
-        final_warlog_list = list(combined_warlogs.values())
-        try:
-            final_warlog_list.sort(key=lambda x: x.get('endTime', ''), reverse=True)
-        except Exception as e:
-            app.logger.error(f"Could not sort warlogs: {e}")
+    final_warlog_list = list(combined_warlogs.values())
+    try:
+        final_warlog_list.sort(key=lambda x: x.get('endTime', ''), reverse=True)
+    except Exception as e:
+        app.logger.error(f"Could not sort warlogs: {e}")
 
-        return {"data": final_warlog_list, "last50": new_warlogs}
+    cursor = final_warlog_list[0].get('endTime') if final_warlog_list else None
+    return {"data": final_warlog_list, "last50": final_warlog_list[:50], "cursor": cursor}
 
-def process_wldata_and_upload(drive_service):
+async def fetch_war_log_updates(token, clan, store, budget=None):
+    """
+    Dạng shard (WARLOG_LAYOUT=sharded) của fetch_war_log: chỉ trả về các trận cần ghi vào store (ShardedWarLog),
+    không đọc lại các shard cũ. Lần đầu (chưa có manifest) gộp cả war_log.json cũ để chuyển sang dạng shard.
+    """
+    budget = budget or RequestBudget(app.config['COC_RUN_REQUEST_BUDGET'])
+    changes = await fetch_war_log_changes(token, clan, budget, store.load_manifest)
+    if "data" not in changes:
+        return changes
+    manifest_res = changes["stored"]
+    if "error" in manifest_res:
+        return {"error": f"Error loading war log manifest: {manifest_res['error']}"}
+    # append ưu tiên bản mới khi trùng endTime nên các trận đã lưu được cập nhật theo API
+    new_warlogs = changes["data"]
+    if manifest_res["data"] is not None:
+        return {"data": new_warlogs}
+    if changes["cursor"]:
+        # Cursor còn nhưng chưa có manifest (vừa đổi WARLOG_LAYOUT hoặc manifest bị xóa): đồng bộ lại toàn bộ
+        app.logger.warning(f"War log manifest for {clan.tag} is missing, refetching the full war log.")
+        await run_blocking(state_cache.delete, _war_log_cursor_key(clan))
+        return await fetch_war_log_updates(token, clan, store, budget)
+
+    legacy_file_name = app.config.get('WARLOG_FILE_NAME')
+    if not await store.storage.find_files(legacy_file_name, clan.folder_id):
+        app.logger.info(f"No stored war log for {clan.tag}, starting a new one.")
+        return {"data": new_warlogs}
+    json_data = await store.storage.get_object(legacy_file_name, clan.folder_id)
+    if "error" in json_data:
+        return {"error": "An unexpected error occurred during load old war_log.json from drive"}
+    legacy_warlog = json_data.get('data')
+    if not isinstance(legacy_warlog, list):
+        app.logger.warning("Old warlog file format is invalid (not a list).")
+        return {"data": new_warlogs}
+    app.logger.info(f"Migrating {len(legacy_warlog)} wars of {clan.tag} from {legacy_file_name} to shards.")
+    # Bản từ API được ưu tiên khi trùng endTime, giống fetch_war_log
+    return {"data": merge_wars(legacy_warlog, new_warlogs)}
+
+async def process_wldata_and_upload(storage, clan):
     current_time = datetime.datetime.now()
     season = current_time.strftime('%Y-%m')
     wl_file_name = season + '.json'
-    query = f"name='{wl_file_name}' and '{app.config['WL_DRIVE_FOLDER_ID']}' in parents and trashed=false"
-    results = drive_service.service.files().list(q=query,
-                                        spaces='drive',
-                                        fields='files(id, name, createdTime)').execute()
-    existing_files = results.get('files', [])
+    existing_files = await storage.find_files(wl_file_name, clan.wl_folder_id)
     if len(existing_files)>0:
         return {"info":"Cancel upload, file already exists in directory."}
     
     try:
-        api_url = "https://api.clashofstats.com/clans/2QCV8UJ8Q/cwl/seasons/" + season
-        response = requests.get(url=api_url)
-        response.raise_for_status()
-        data = response.json()
-        return process_wl_data(season, data, drive_service)
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching data from {api_url}: {e}")
-        return {"error": f"Error fetching data from {api_url}: {e}"}
+        report_progress(f"fetching CWL season {season} for {clan.tag}")
+        api_url = app.config['CLASHOFSTATS_API_URL'] + CLASHOFSTATS_CWL_PATH.format(clan=clan.slug, season=season)
+        # Dùng session và rate limiter clashofstats chung để nhiều clan có thể chạy đồng thời
+        session = await get_coc_session()
+        fetch_res = await fetch_data(session, api_url, timeout=30, limiter=get_clashofstats_rate_limiter(), endpoint=CLASHOFSTATS_CWL_PATH)
+        if "error" in fetch_res:
+            app.logger.error(f"Error fetching data from {api_url}: {fetch_res['error']}")
+            return {"error": f"Error fetching data from {api_url}: {fetch_res['error']}"}
+        report_progress(f"processing and uploading CWL season {season} for {clan.tag}")
+        return await process_wl_data(season, fetch_res["data"], storage, clan)
     except Exception as e:
         app.logger.error(f"An unexpected error occurred: {e}")
         return {"error": f"An unexpected error occurred: {e}"}
     
+def season_range(start_season, end_season):
+    """
+    Danh sách các mùa 'YYYY-MM' từ start_season tới end_season (bao gồm cả hai đầu).
+    """
+    start = datetime.datetime.strptime(start_season, '%Y-%m')
+    end = datetime.datetime.strptime(end_season, '%Y-%m')
+    seasons = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        seasons.append(f"{year:04d}-{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return seasons
+
+async def process_wldata_backfill(storage, clans, start_season, end_season, force=False):
+    """
+    Tải lại các mùa CWL trong khoảng cho trước cho mọi clan: lấy dữ liệu clashofstats song song
+    (dùng chung rate limiter), xử lý trên một process pool chung và lưu vào thư mục của từng clan.
+    Các mùa đã có tệp được bỏ qua (trừ khi force), dựa trên một lần liệt kê thư mục mỗi clan.
+    """
+    try:
+        seasons = season_range(start_season, end_season)
+    except (TypeError, ValueError):
+        return {"error": "Invalid season range, expected YYYY-MM."}
+    if not seasons:
+        return {"error": "Empty season range."}
+    if len(seasons) > app.config['BACKFILL_MAX_SEASONS']:
+        return {"error": f"Season range too large ({len(seasons)} > {app.config['BACKFILL_MAX_SEASONS']})."}
+
+    report_progress("listing stored CWL seasons")
+    listings = await asyncio.gather(*(storage.list_folder(clan.wl_folder_id) for clan in clans))
+    pending = {}
+    for clan, listing in zip(clans, listings):
+        if "error" not in listing:
+            pending[clan.tag] = [season for season in seasons if force or season + '.json' not in listing["data"]]
+    total = sum(len(clan_pending) for clan_pending in pending.values())
+
+    session = await get_coc_session()
+    limiter = get_clashofstats_rate_limiter()
+    loop = asyncio.get_running_loop()
+    progress = {"done": 0}
+    # spawn: tiến trình con không kế thừa các thread (event loop, thread pool) của worker
+    pool = None
+    if total:
+        pool = ProcessPoolExecutor(max_workers=app.config['BACKFILL_PROCESS_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+
+    async def backfill_season(clan, season, uploaded, failed):
+        api_url = app.config['CLASHOFSTATS_API_URL'] + CLASHOFSTATS_CWL_PATH.format(clan=clan.slug, season=season)
+        try:
+            fetch_res = await fetch_data(session, api_url, timeout=30, limiter=limiter, raw=True, endpoint=CLASHOFSTATS_CWL_PATH)
+            if "error" in fetch_res:
+                failed[season] = fetch_res["error"]
+                return
+            try:
+                built = await loop.run_in_executor(pool, build_wl_season_from_bytes, season, fetch_res["data"], clan.tag)
+            except Exception as e:
+                app.logger.error(f"Error processing CWL season {season} for {clan.tag}: {e}")
+                failed[season] = f"Error processing CWL season {season}: {e}"
+                return
+            upload_res = await upload_wl_season(season, built, storage, clan)
+            if "error" in upload_res:
+                failed[season] = upload_res["error"]
+            else:
+                uploaded.append(season)
+        finally:
+            # Mùa lỗi cũng được tính là đã xử lý để tiến độ luôn đạt total/total
+            progress["done"] += 1
+            report_progress(f"backfilled {progress['done']}/{total} CWL seasons")
+
+    async def backfill_clan(clan):
+        listing = listings[clans.index(clan)]
+        if "error" in listing:
+            return {"error": listing["error"]}
+        clan_pending = pending[clan.tag]
+        skipped = [season for season in seasons if season not in clan_pending]
+        if not clan_pending:
+            return {"info": "All seasons already exist.", "skipped": skipped}
+        uploaded, failed = [], {}
+        await asyncio.gather(*(backfill_season(clan, season, uploaded, failed) for season in clan_pending))
+        result = {"uploaded": sorted(uploaded), "skipped": skipped, "failed": failed}
+        if failed:
+            app.logger.error(f"CWL backfill for {clan.tag} failed for {len(failed)} season(s): {sorted(failed)}")
+            result["error"] = f"Failed to backfill {len(failed)} of {len(clan_pending)} seasons."
+        return result
+
+    try:
+        if total:
+            report_progress(f"backfilling {total} CWL seasons")
+        return await run_for_clans(clans, backfill_clan)
+    finally:
+        if pool is not None:
+            await run_blocking(pool.shutdown)
+
 def get_token():
     try:
         response = requests.get(url=app.config.get('API_URL'))
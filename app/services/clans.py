@@ -0,0 +1,69 @@
+import json
+import asyncio
+from .. import app
+
+class Clan:
+    """
+    Một clan được theo dõi cùng các thư mục lưu trữ riêng của nó.
+    """
+    __slots__ = ('tag', 'folder_id', 'wl_folder_id', 'wl_rp_folder_id')
+
+    def __init__(self, tag, folder_id=None, wl_folder_id=None, wl_rp_folder_id=None):
+        tag = tag.strip().upper()
+        self.tag = tag if tag.startswith('#') else '#' + tag
+        # Thiếu thư mục riêng thì dùng thư mục chung (cấu hình một clan như trước)
+        self.folder_id = folder_id or app.config['DRIVE_FOLDER_ID']
+        self.wl_folder_id = wl_folder_id or app.config['WL_DRIVE_FOLDER_ID']
+        self.wl_rp_folder_id = wl_rp_folder_id or app.config['WL_RP_DRIVE_FOLDER_ID']
+
+    @property
+    def slug(self):
+        # Tag không có '#', dùng trong đường dẫn URL (vd. clashofstats)
+        return self.tag.lstrip('#')
+
+_clans = None
+
+def load_clans():
+    """
+    Đọc danh sách clan từ CLANS (JSON: [{"tag", "folder_id", "wl_folder_id", "wl_rp_folder_id"}, ...]);
+    nếu không có thì chỉ theo dõi CLAN_TAG với các thư mục chung.
+    """
+    raw = app.config.get('CLANS')
+    if not raw:
+        return [Clan(app.config['CLAN_TAG'])]
+    entries = json.loads(raw)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("CLANS must be a non-empty JSON list.")
+    clans = [Clan(entry) if isinstance(entry, str) else Clan(**entry) for entry in entries]
+
+    seen_folders = {}
+    for clan in clans:
+        for folder_id in (clan.folder_id, clan.wl_folder_id, clan.wl_rp_folder_id):
+            other = seen_folders.setdefault(folder_id, clan.tag)
+            if other != clan.tag:
+                app.logger.warning(f"Clans {other} and {clan.tag} share storage folder {folder_id}; their files will overwrite each other.")
+    return clans
+
+def get_clans():
+    global _clans
+    if _clans is None:
+        _clans = load_clans()
+    return list(_clans)
+
+async def run_for_clans(clans, func, *args):
+    """
+    Chạy func(clan, *args) cho mọi clan đồng thời. Với một clan, trả về nguyên kết quả của clan đó;
+    với nhiều clan, trả về {"clans": {tag: kết quả}} kèm "error" nếu có clan thất bại
+    và status "unchanged" nếu không clan nào có thay đổi.
+    """
+    results = await asyncio.gather(*(func(clan, *args) for clan in clans), return_exceptions=True)
+    results = [{"error": str(result)} if isinstance(result, Exception) else result for result in results]
+    if len(clans) == 1:
+        return results[0]
+    combined = {"clans": {clan.tag: result for clan, result in zip(clans, results)}}
+    if all(isinstance(result, dict) and result.get("status") == "unchanged" for result in results):
+        combined["status"] = "unchanged"
+    failed = [clan.tag for clan, result in zip(clans, results) if isinstance(result, dict) and "error" in result]
+    if failed:
+        combined["error"] = f"Failed for clan(s): {', '.join(failed)}"
+    return combined
@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+import weakref
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from .. import app
+from .http_client import run_blocking
+from .api_service import get_token
+from .drive_service import AsyncDriveService, DriveService
+
+class CredentialManager:
+    """
+    Giữ đối tượng Credentials của Google trong bộ nhớ giữa các request. Chỉ gọi GAS Api khi chưa có
+    credentials, chỉ refresh khi gần hết hạn (single-flight) và chỉ ghi token.json lên Drive khi token thay đổi.
+    """
+    def __init__(self, scopes):
+        self.scopes = scopes
+        self._credentials = None
+        self._locks = weakref.WeakKeyDictionary()
+
+    def _get_lock(self):
+        loop = asyncio.get_running_loop()
+        lock = self._locks.get(loop)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[loop] = lock
+        return lock
+
+    def _needs_refresh(self, credentials):
+        if not credentials.token:
+            return True
+        if credentials.expiry is None:
+            return False
+        # expiry của google-auth là datetime UTC không có tzinfo
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        margin = datetime.timedelta(seconds=app.config['CREDENTIALS_REFRESH_MARGIN'])
+        return credentials.expiry - margin <= now
+
+    def _discard(self, credentials):
+        # Client Drive đã build với credentials cũ cũng không được dùng lại
+        if credentials is not None:
+            DriveService.evict(credentials.client_id, credentials.refresh_token)
+
+    def invalidate(self):
+        self._discard(self._credentials)
+        self._credentials = None
+
+    async def get_credentials(self):
+        credentials = self._credentials
+        if credentials is not None and not self._needs_refresh(credentials):
+            return {"data": credentials}
+
+        async with self._get_lock():
+            # Coroutine khác có thể vừa tải/refresh xong trong lúc chờ khóa
+            credentials = self._credentials
+            if credentials is not None and not self._needs_refresh(credentials):
+                return {"data": credentials}
+
+            if credentials is None:
+                cred_data = await run_blocking(get_token)
+                if "error" in cred_data:
+                    return {"error": cred_data.get('error')}
+                credentials = Credentials.from_authorized_user_info(cred_data.get('data'), self.scopes)
+
+            if self._needs_refresh(credentials) and credentials.refresh_token:
+                old_tokens = (credentials.token, credentials.refresh_token)
+                try:
+                    await run_blocking(credentials.refresh, Request())
+                except Exception as e:
+                    self._discard(credentials)
+                    self._credentials = None
+                    app.logger.error(f"Error refreshing Google credentials: {e}")
+                    return {"error": f"Error refreshing Google credentials: {e}"}
+                if (credentials.token, credentials.refresh_token) != old_tokens:
+                    if credentials.refresh_token != old_tokens[1]:
+                        DriveService.evict(credentials.client_id, old_tokens[1])
+                    drive_service = await AsyncDriveService.create(credentials)
+                    upload_res = await drive_service.upload_string(credentials.to_json(), 'token.json', app.config.get('DRIVE_FOLDER_ID'), num_backups_to_keep=0)
+                    if "error" in upload_res:
+                        app.logger.error(f"Error saving refreshed token.json to Drive: {upload_res['error']}")
+
+            self._credentials = credentials
+            return {"data": credentials}
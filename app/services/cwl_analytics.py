@@ -0,0 +1,257 @@
+import re
+import asyncio
+import threading
+from collections import OrderedDict
+import numpy as np
+from .. import app
+from .http_client import run_blocking
+from .job_runner import report_progress
+
+# Tệp vòng đấu của từng mùa do process_wl_data tải lên thư mục wl_rp_folder_id của clan
+ROUND_FILE_PATTERN = re.compile(r'^(\d{4}-\d{2})_round\.json$')
+# Số sao của một lượt tấn công: 0..3
+STAR_LEVELS = 4
+
+class SeasonColumns:
+    """
+    Dữ liệu một mùa CWL dạng cột: mỗi lượt tấn công, phòng thủ và lượt tham gia vòng đấu là một hàng.
+    """
+    __slots__ = ('season', 'players', 'atk_tags', 'atk_stars', 'atk_des', 'atk_th', 'def_th',
+                 'def_tags', 'def_stars', 'def_des', 'part_tags')
+
+    def __init__(self, season, rounds, players):
+        self.season = season
+        self.players = players
+        atk_tags, atk_stars, atk_des, atk_th, def_th = [], [], [], [], []
+        def_tags, def_stars, def_des = [], [], []
+        part_tags = []
+        for round_data in rounds:
+            for member in round_data.get('members', []):
+                tag = member.get('tag')
+                if not tag:
+                    continue
+                part_tags.append(tag)
+                if 'atkTag' in member:
+                    atk_tags.append(tag)
+                    atk_stars.append(member.get('atkStars') or 0)
+                    atk_des.append(member.get('atkDesPercent') or 0)
+                    atk_th.append(players.get(tag, {}).get('townHallLevel') or 0)
+                    def_th.append(players.get(member['atkTag'], {}).get('townHallLevel') or 0)
+                if 'defTag' in member:
+                    def_tags.append(tag)
+                    def_stars.append(member.get('defStars') or 0)
+                    def_des.append(member.get('defDesPercent') or 0)
+        self.atk_tags = np.array(atk_tags, dtype=object)
+        self.atk_stars = np.array(atk_stars, dtype=np.int8)
+        self.atk_des = np.array(atk_des, dtype=np.float64)
+        self.atk_th = np.array(atk_th, dtype=np.int16)
+        self.def_th = np.array(def_th, dtype=np.int16)
+        self.def_tags = np.array(def_tags, dtype=object)
+        self.def_stars = np.array(def_stars, dtype=np.int8)
+        self.def_des = np.array(def_des, dtype=np.float64)
+        self.part_tags = np.array(part_tags, dtype=object)
+
+# Cache LRU dữ liệu cột theo (clan, mùa), giới hạn CWL_SEASON_CACHE_SIZE mục;
+# mỗi mục kèm id và mã băm nội dung của các tệp nguồn để bỏ bản cũ khi tệp thay đổi
+_season_cache = OrderedDict()
+_season_cache_lock = threading.Lock()
+
+def _cached_season(key, source_key):
+    with _season_cache_lock:
+        cached = _season_cache.get(key)
+        if cached is None or cached[0] != source_key:
+            return None
+        _season_cache.move_to_end(key)
+        return cached[1]
+
+def _cache_season(key, source_key, columns):
+    with _season_cache_lock:
+        _season_cache[key] = (source_key, columns)
+        _season_cache.move_to_end(key)
+        while len(_season_cache) > app.config['CWL_SEASON_CACHE_SIZE']:
+            _season_cache.popitem(last=False)
+
+def _ratio(numerator, denominator):
+    return np.divide(numerator, denominator, out=np.full(np.shape(numerator), np.nan), where=denominator > 0)
+
+def _to_list(values, digits=2):
+    return [None if np.isnan(value) else round(float(value), digits) for value in values]
+
+def compute_cwl_analytics(columns, rolling_window=3):
+    """
+    Tính thống kê nhiều mùa CWL bằng các phép toán vector trên mảng (người chơi x mùa):
+    chỉ số sự nghiệp, trung bình trượt theo mùa, tỉ lệ 3 sao theo chênh lệch town hall và phân bố sao.
+    """
+    seasons = [column.season for column in columns]
+    n_seasons = len(seasons)
+    empty = {"seasons": seasons, "rollingWindow": rolling_window, "players": [], "thDiff": [], "starDistribution": [0] * STAR_LEVELS}
+    if not columns:
+        return empty
+    atk_tags = np.concatenate([column.atk_tags for column in columns])
+    def_tags = np.concatenate([column.def_tags for column in columns])
+    part_tags = np.concatenate([column.part_tags for column in columns])
+    if len(part_tags) == 0:
+        return empty
+
+    # Chỉ số người chơi dùng chung cho mọi bảng
+    player_tags, inverse = np.unique(np.concatenate([atk_tags, def_tags, part_tags]), return_inverse=True)
+    atk_idx, def_idx, part_idx = np.split(inverse, [len(atk_tags), len(atk_tags) + len(def_tags)])
+    n_players = len(player_tags)
+
+    atk_season = np.concatenate([np.full(len(column.atk_tags), i) for i, column in enumerate(columns)])
+    part_season = np.concatenate([np.full(len(column.part_tags), i) for i, column in enumerate(columns)])
+    atk_stars = np.concatenate([column.atk_stars for column in columns]).astype(np.int64)
+    atk_des = np.concatenate([column.atk_des for column in columns])
+    def_stars = np.concatenate([column.def_stars for column in columns]).astype(np.int64)
+    def_des = np.concatenate([column.def_des for column in columns])
+    atk_th = np.concatenate([column.atk_th for column in columns]).astype(np.int64)
+    def_th = np.concatenate([column.def_th for column in columns]).astype(np.int64)
+
+    # Chỉ số sự nghiệp
+    attacks = np.bincount(atk_idx, minlength=n_players)
+    total_stars = np.bincount(atk_idx, weights=atk_stars, minlength=n_players)
+    total_des = np.bincount(atk_idx, weights=atk_des, minlength=n_players)
+    defense = np.bincount(def_idx, minlength=n_players)
+    total_def_stars = np.bincount(def_idx, weights=def_stars, minlength=n_players)
+    total_def_des = np.bincount(def_idx, weights=def_des, minlength=n_players)
+    rounds = np.bincount(part_idx, minlength=n_players)
+    star_dist = np.zeros((n_players, STAR_LEVELS), dtype=np.int64)
+    np.add.at(star_dist, (atk_idx, np.clip(atk_stars, 0, STAR_LEVELS - 1)), 1)
+
+    # Ma trận người chơi x mùa và trung bình trượt trên rolling_window mùa gần nhất
+    participation = np.zeros((n_players, n_seasons), dtype=np.int64)
+    np.add.at(participation, (part_idx, part_season), 1)
+    season_stars = np.zeros((n_players, n_seasons))
+    np.add.at(season_stars, (atk_idx, atk_season), atk_stars)
+    season_attacks = np.zeros((n_players, n_seasons))
+    np.add.at(season_attacks, (atk_idx, atk_season), 1)
+    window_end = np.arange(1, n_seasons + 1)
+    window_start = np.maximum(0, window_end - max(1, rolling_window))
+    cum_stars = np.pad(np.cumsum(season_stars, axis=1), ((0, 0), (1, 0)))
+    cum_attacks = np.pad(np.cumsum(season_attacks, axis=1), ((0, 0), (1, 0)))
+    rolling_avg = _ratio(cum_stars[:, window_end] - cum_stars[:, window_start],
+                         cum_attacks[:, window_end] - cum_attacks[:, window_start])
+    season_avg = _ratio(season_stars, season_attacks)
+
+    # Tỉ lệ tấn công theo chênh lệch town hall (chỉ các lượt biết TH của cả hai bên)
+    known = (atk_th > 0) & (def_th > 0)
+    th_diff_values, th_inverse = np.unique(atk_th[known] - def_th[known], return_inverse=True)
+    th_attacks = np.bincount(th_inverse, minlength=len(th_diff_values))
+    th_stars = np.bincount(th_inverse, weights=atk_stars[known], minlength=len(th_diff_values))
+    th_three = np.bincount(th_inverse, weights=atk_stars[known] == STAR_LEVELS - 1, minlength=len(th_diff_values))
+    th_des = np.bincount(th_inverse, weights=atk_des[known], minlength=len(th_diff_values))
+
+    # Tên và town hall gần nhất của người chơi
+    latest = {}
+    for column in columns:
+        latest.update(column.players)
+
+    avg_stars = _to_list(_ratio(total_stars, attacks))
+    avg_des = _to_list(_ratio(total_des, attacks))
+    three_star_rate = _to_list(_ratio(star_dist[:, STAR_LEVELS - 1], attacks), 4)
+    avg_def_stars = _to_list(_ratio(total_def_stars, defense))
+    avg_def_des = _to_list(_ratio(total_def_des, defense))
+    seasons_played = (participation > 0).sum(axis=1)
+
+    players = []
+    # Sắp xếp theo tổng sao giảm dần, rồi theo tag (player_tags đã được np.unique sắp xếp)
+    for i in np.lexsort((np.arange(n_players), -total_stars)):
+        info = latest.get(player_tags[i], {})
+        players.append({
+            "tag": player_tags[i],
+            "name": info.get('name'),
+            "townHallLevel": info.get('townHallLevel'),
+            "seasons": int(seasons_played[i]),
+            "rounds": int(rounds[i]),
+            "attacks": int(attacks[i]),
+            "atkStars": int(total_stars[i]),
+            "avgStars": avg_stars[i],
+            "avgDesPercent": avg_des[i],
+            "threeStarRate": three_star_rate[i],
+            "starDistribution": star_dist[i].tolist(),
+            "defense": int(defense[i]),
+            "defStars": int(total_def_stars[i]),
+            "avgDefStars": avg_def_stars[i],
+            "avgDefDesPercent": avg_def_des[i],
+            "seasonAvgStars": _to_list(season_avg[i]),
+            "rollingAvgStars": _to_list(rolling_avg[i]),
+        })
+
+    th_avg_stars = _to_list(_ratio(th_stars, th_attacks))
+    th_three_rate = _to_list(_ratio(th_three, th_attacks), 4)
+    th_avg_des = _to_list(_ratio(th_des, th_attacks))
+    th_diff = [{
+        "thDiff": int(value),
+        "attacks": int(th_attacks[i]),
+        "avgStars": th_avg_stars[i],
+        "threeStarRate": th_three_rate[i],
+        "avgDesPercent": th_avg_des[i],
+    } for i, value in enumerate(th_diff_values)]
+
+    return {
+        "seasons": seasons,
+        "rollingWindow": rolling_window,
+        "players": players,
+        "thDiff": th_diff,
+        "starDistribution": star_dist.sum(axis=0).tolist(),
+    }
+
+async def _load_season_columns(storage, clan, season, round_files, overall_files):
+    round_file_name = season + '_round.json'
+    overall_file_name = season + '.json'
+    round_file = round_files[round_file_name][0]
+    overall_file = (overall_files.get(overall_file_name) or [{}])[0]
+    source_key = (round_file['id'], round_file.get('contentHash'), overall_file.get('id'), overall_file.get('contentHash'))
+    cached = _cached_season((clan.tag, season), source_key)
+    if cached is not None:
+        return cached
+
+    round_res, overall_res = await asyncio.gather(
+        storage.get_object(round_file_name, clan.wl_rp_folder_id),
+        storage.get_object(overall_file_name, clan.wl_folder_id)
+    )
+    if "error" in round_res:
+        app.logger.warning(f"Skipping CWL season {season} for {clan.tag}: {round_res['error']}")
+        return None
+    if not isinstance(round_res.get("data"), list):
+        app.logger.warning(f"Skipping CWL season {season} for {clan.tag}: {round_file_name} is empty or not a list.")
+        return None
+    # Thiếu tệp tổng thể chỉ làm mất thông tin town hall, vẫn tính được các chỉ số còn lại
+    overall = {} if "error" in overall_res else (overall_res.get("data") or {})
+    players = (overall.get('players') if isinstance(overall, dict) else None) or {}
+    columns = SeasonColumns(season, round_res["data"], players)
+    _cache_season((clan.tag, season), source_key, columns)
+    return columns
+
+async def process_cwl_analytics(storage, clan):
+    """
+    Nạp mọi mùa CWL đã lưu của clan, tính thống kê nhiều mùa và lưu kết quả vào thư mục wl_rp_folder_id của clan.
+    """
+    try:
+        report_progress(f"listing stored CWL seasons for {clan.tag}")
+        round_res, overall_res = await asyncio.gather(
+            storage.list_folder(clan.wl_rp_folder_id),
+            storage.list_folder(clan.wl_folder_id)
+        )
+        if "error" in round_res:
+            return {"error": round_res["error"]}
+        overall_files = overall_res.get("data", {})
+        seasons = sorted(match.group(1) for match in map(ROUND_FILE_PATTERN.match, round_res["data"]) if match)
+        if not seasons:
+            return {"info": "No stored CWL season found."}
+
+        report_progress(f"loading {len(seasons)} CWL seasons for {clan.tag}")
+        columns = await asyncio.gather(*(_load_season_columns(storage, clan, season, round_res["data"], overall_files) for season in seasons))
+        columns = [column for column in columns if column is not None]
+        if not columns:
+            # Không ghi đè cwl_analytics.json đã có bằng một kết quả rỗng
+            return {"error": f"No CWL season available for {clan.tag}: all {len(seasons)} stored season(s) failed to load."}
+
+        report_progress(f"computing CWL analytics for {clan.tag}")
+        analytics = await run_blocking(compute_cwl_analytics, columns, app.config['CWL_ROLLING_WINDOW'])
+
+        report_progress(f"uploading CWL analytics for {clan.tag}")
+        return await storage.upload_object(analytics, app.config['CWL_ANALYTICS_FILE_NAME'], clan.wl_rp_folder_id, num_backups_to_keep=0, codec='json')
+    except Exception as e:
+        app.logger.error(f"An unexpected error occurred while computing CWL analytics: {e}")
+        return {"error": f"An unexpected error occurred while computing CWL analytics: {e}"}
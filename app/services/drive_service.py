@@ -1,23 +1,281 @@
 import os
 import io
+import time
 import datetime
+import threading
+from collections import OrderedDict
+import httplib2
+import google_auth_httplib2
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+from googleapiclient.http import HttpRequest, MediaFileUpload, MediaIoBaseUpload
 from google.oauth2.credentials import Credentials
 from .. import app 
+from .http_client import run_blocking
+from .serializer import spool_encoded, decode_payload, decode_text, content_hash, CODECS_BY_MIMETYPE
+from .storage import StorageBackend
+from .metrics import DRIVE_OPERATIONS, DRIVE_OPERATION_DURATION, DRIVE_BYTES
+
+GOOGLE_API_ROOT = 'https://www.googleapis.com/'
+
+class EndpointOverrideHttp(httplib2.Http):
+    """
+    Chuyển mọi request tới GOOGLE_API_ROOT (metadata, upload, batch) sang địa chỉ khác,
+    ví dụ máy chủ Drive giả lập khi chạy benchmark.
+    """
+    def __init__(self, endpoint, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint.rstrip('/') + '/'
+
+    def request(self, uri, *args, **kwargs):
+        if uri.startswith(GOOGLE_API_ROOT):
+            uri = self.endpoint + uri[len(GOOGLE_API_ROOT):]
+        return super().request(uri, *args, **kwargs)
+
+def _drive_operation(http_request):
+    # 'drive.files.update' -> 'update'; tải nội dung (alt=media) được tính là 'download'
+    operation = (http_request.methodId or 'unknown').rsplit('.', 1)[-1]
+    if operation == 'get' and 'alt=media' in http_request.uri:
+        return 'download'
+    return operation
+
+class InstrumentedHttpRequest(HttpRequest):
+    """
+    HttpRequest ghi lại số lần, thời gian và số byte của từng thao tác Drive vào metrics.
+    """
+    def execute(self, http=None, num_retries=0):
+        operation = _drive_operation(self)
+        if self.resumable is not None:
+            DRIVE_BYTES.inc(self.resumable.size() or 0, direction='sent')
+        elif self.body:
+            DRIVE_BYTES.inc(len(self.body), direction='sent')
+        status = 'error'
+        try:
+            with DRIVE_OPERATION_DURATION.time(operation=operation):
+                result = super().execute(http=http, num_retries=num_retries)
+            status = 'ok'
+        finally:
+            DRIVE_OPERATIONS.inc(operation=operation, status=status)
+        if isinstance(result, bytes):
+            DRIVE_BYTES.inc(len(result), direction='received')
+        return result
 
 class DriveService:
+    # Chỉ mục (folder_id, file_name) -> (danh sách tệp, thời điểm hết hạn), dùng chung giữa các instance
+    _file_index = {}
+    # folder_id -> thời điểm hết hạn, khi toàn bộ thư mục đã được nạp vào chỉ mục
+    _loaded_folders = {}
+    _index_lock = threading.Lock()
+    # Các DriveService đã build, dùng lại theo tài khoản (client_id, refresh_token)
+    _instances = OrderedDict()
+    _instances_lock = threading.Lock()
+
     def __init__(self, credentials):
         if not isinstance(credentials, Credentials):
             app.logger.error("TypeError: Credentials must be a google.oauth2.credentials.Credentials object.")
             raise TypeError("Credentials must be a google.oauth2.credentials.Credentials object.")
         try:
             self.credentials = credentials
-            self.service = build('drive', 'v3', credentials=self.credentials)
+            self._local = threading.local()
+            # Dùng tài liệu discovery đóng gói sẵn trong googleapiclient, không tải qua mạng
+            self.service = build('drive', 'v3', http=self._authorized_http(), requestBuilder=self._build_request,
+                                 static_discovery=True, cache_discovery=False)
         except Exception as e:
             app.logger.critical(f"Failed to build Drive service: {e}")
             raise RuntimeError(f"Failed to build Drive service: {e}")
 
+    @classmethod
+    def for_credentials(cls, credentials):
+        """
+        Trả về DriveService đã build cho tài khoản của credentials (LRU giới hạn DRIVE_CLIENT_CACHE_SIZE),
+        nhờ đó client và kết nối HTTP đã xác thực được dùng lại giữa các request.
+        """
+        refresh_token = getattr(credentials, 'refresh_token', None)
+        if not refresh_token:
+            return cls(credentials)
+        key = (credentials.client_id, refresh_token)
+        with cls._instances_lock:
+            instance = cls._instances.get(key)
+            # Chỉ dùng lại client được build với chính credentials này (hoặc cùng access token);
+            # credentials mới (đăng nhập lại, token.json được tải lại) thì build client mới
+            if instance is not None and (instance.credentials is credentials or instance.credentials.token == credentials.token):
+                cls._instances.move_to_end(key)
+                return instance
+        instance = cls(credentials)
+        with cls._instances_lock:
+            cls._instances[key] = instance
+            while len(cls._instances) > app.config['DRIVE_CLIENT_CACHE_SIZE']:
+                cls._instances.popitem(last=False)
+        return instance
+
+    @classmethod
+    def evict(cls, client_id, refresh_token):
+        """
+        Bỏ client đã build của tài khoản khỏi cache, vd. khi credentials bị thay thế hoặc refresh thất bại.
+        """
+        with cls._instances_lock:
+            cls._instances.pop((client_id, refresh_token), None)
+
+    def _authorized_http(self):
+        # httplib2 không an toàn luồng: mỗi thread dùng một đối tượng http riêng
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            endpoint = app.config.get('GOOGLE_API_URL')
+            transport = EndpointOverrideHttp(endpoint) if endpoint else httplib2.Http()
+            http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=transport)
+            self._local.http = http
+        return http
+
+    def _build_request(self, http, *args, **kwargs):
+        return InstrumentedHttpRequest(self._authorized_http(), *args, **kwargs)
+
+    def _index_get(self, folder_id, file_name):
+        now = time.monotonic()
+        with self._index_lock:
+            entry = self._file_index.get((folder_id, file_name))
+            if entry is not None and entry[1] > now:
+                return list(entry[0])
+            # Thư mục đã được nạp đầy đủ và còn hạn: tệp không có trong chỉ mục tức là không tồn tại
+            if self._loaded_folders.get(folder_id, 0) > now:
+                return []
+        return None
+
+    @staticmethod
+    def _index_entry(file):
+        # Giữ id, tên và mã băm nội dung (lưu trong appProperties) của tệp
+        file_hash = file.get('contentHash') or file.get('appProperties', {}).get('contentHash')
+        return {'id': file['id'], 'name': file['name'], 'contentHash': file_hash}
+
+    def _index_set(self, folder_id, file_name, files):
+        expires_at = time.monotonic() + app.config['DRIVE_INDEX_TTL']
+        with self._index_lock:
+            self._file_index[(folder_id, file_name)] = ([self._index_entry(f) for f in files], expires_at)
+
+    def _index_add(self, folder_id, file_name, file_id, file_hash=None):
+        files = self._index_get(folder_id, file_name)
+        if files is None:
+            # Không biết trạng thái hiện tại của tên này, để lần tra cứu sau truy vấn lại
+            self.invalidate_file(folder_id, file_name)
+            return
+        self._index_set(folder_id, file_name, files + [{'id': file_id, 'name': file_name, 'contentHash': file_hash}])
+
+    def _index_set_hash(self, folder_id, file_name, file_id, file_hash):
+        files = self._index_get(folder_id, file_name)
+        if files is None:
+            return
+        for file in files:
+            if file['id'] == file_id:
+                file['contentHash'] = file_hash
+        self._index_set(folder_id, file_name, files)
+
+    def _index_remove(self, folder_id, file_name, file_id):
+        files = self._index_get(folder_id, file_name)
+        if files is None:
+            return
+        self._index_set(folder_id, file_name, [f for f in files if f['id'] != file_id])
+
+    def invalidate_file(self, folder_id, file_name):
+        with self._index_lock:
+            self._file_index.pop((folder_id, file_name), None)
+            self._loaded_folders.pop(folder_id, None)
+
+    def preload_folder(self, folder_id):
+        """
+        Nạp toàn bộ tên tệp của thư mục vào chỉ mục bằng một lần liệt kê (có phân trang).
+        """
+        if self._loaded_folders.get(folder_id, 0) > time.monotonic():
+            return {"info": "Folder index is still fresh."}
+        try:
+            files_by_name = {}
+            page_token = None
+            while True:
+                results = self.service.files().list(q=f"'{folder_id}' in parents and trashed=false",
+                                                    spaces='drive',
+                                                    fields='nextPageToken, files(id, name, appProperties)',
+                                                    pageSize=1000,
+                                                    pageToken=page_token).execute()
+                for file in results.get('files', []):
+                    files_by_name.setdefault(file['name'], []).append(file)
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    break
+        except Exception as e:
+            app.logger.error(f"Error listing Drive folder {folder_id}: {e}")
+            return {"error": f"Error listing Drive folder {folder_id}: {e}"}
+
+        expires_at = time.monotonic() + app.config['DRIVE_INDEX_TTL']
+        with self._index_lock:
+            for key in [key for key in self._file_index if key[0] == folder_id]:
+                del self._file_index[key]
+            for name, files in files_by_name.items():
+                self._file_index[(folder_id, name)] = ([self._index_entry(f) for f in files], expires_at)
+            self._loaded_folders[folder_id] = expires_at
+        return {"count": sum(len(files) for files in files_by_name.values())}
+
+    def list_folder(self, folder_id):
+        """
+        Trả về {tên tệp: [tệp]} của toàn bộ thư mục, dựa trên chỉ mục (liệt kê lại nếu đã hết hạn).
+        """
+        preload_res = self.preload_folder(folder_id)
+        if "error" in preload_res:
+            return preload_res
+        now = time.monotonic()
+        with self._index_lock:
+            files = {name: list(entry[0]) for (entry_folder, name), entry in self._file_index.items()
+                     if entry_folder == folder_id and entry[1] > now and entry[0]}
+        return {"data": files}
+
+    def execute_batch(self, requests):
+        """
+        Gửi nhiều thao tác metadata/xóa trong một batch request của Google API.
+        requests là danh sách (request_id, HttpRequest); trả về {request_id: lỗi} cho các thao tác thất bại.
+        """
+        errors = {}
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                errors[request_id] = exception
+
+        # Drive giới hạn tối đa 100 lệnh trong một batch
+        for start in range(0, len(requests), 100):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for request_id, http_request in requests[start:start + 100]:
+                batch.add(http_request, request_id=request_id)
+            with DRIVE_OPERATION_DURATION.time(operation='batch'):
+                batch.execute()
+
+        # Các lệnh trong batch không đi qua InstrumentedHttpRequest.execute nên được đếm tại đây
+        for request_id, http_request in requests:
+            DRIVE_OPERATIONS.inc(operation=_drive_operation(http_request), status='error' if request_id in errors else 'ok')
+        for request_id, exception in errors.items():
+            app.logger.error(f"Batch request {request_id} failed: {exception}")
+        return errors
+
+    def delete_files(self, files, folder_id):
+        """
+        Xóa danh sách tệp (id, name) bằng một batch request, trả về danh sách lỗi theo từng tệp.
+        """
+        requests = [(file['id'], self.service.files().delete(fileId=file['id'])) for file in files]
+        errors = self.execute_batch(requests)
+        for file in files:
+            if file['id'] not in errors:
+                self._index_remove(folder_id, file['name'], file['id'])
+        return [f"Failed to delete file {file_id}: {exception}" for file_id, exception in errors.items()]
+
+    def find_files(self, file_name, folder_id):
+        """
+        Trả về danh sách tệp (id, name, contentHash) có tên file_name trong thư mục, ưu tiên lấy từ chỉ mục.
+        """
+        files = self._index_get(folder_id, file_name)
+        if files is not None:
+            return files
+        query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
+        results = self.service.files().list(q=query,
+                                            spaces='drive',
+                                            fields='files(id, name, appProperties)').execute()
+        files = results.get('files', [])
+        self._index_set(folder_id, file_name, files)
+        return [self._index_entry(f) for f in files]
+
     def upload_json_to_drive(self, file_path, folder_id, num_backups_to_keep=2):
         if not os.path.exists(file_path):
             app.logger.error(f"File not found at path: {file_path}")
@@ -27,14 +285,11 @@ class DriveService:
         base_file_name, file_extension = os.path.splitext(file_name)
         backup_pattern = f"{base_file_name}_backup_"
         uploaded_file_id = None
+        batch_errors = []
 
         try:
             # 1. Tìm kiếm tệp hiện có
-            query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-            results = self.service.files().list(q=query,
-                                                spaces='drive',
-                                                fields='files(id, name, createdTime)').execute()
-            existing_files = results.get('files', [])
+            existing_files = self.find_files(file_name, folder_id)
 
             if existing_files:
                 existing_file = existing_files[0]
@@ -44,8 +299,10 @@ class DriveService:
                     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
                     backup_name = f"{base_file_name}_backup_{timestamp}{file_extension}"
                     self.service.files().update(fileId=existing_file_id, body={'name': backup_name}).execute()
+                    self._index_add(folder_id, backup_name, existing_file_id)
                 else:
                     self.service.files().delete(fileId=existing_file_id).execute()
+                self._index_remove(folder_id, file_name, existing_file_id)
 
             # 2. Tải lên tệp mới
             file_metadata = {
@@ -55,6 +312,7 @@ class DriveService:
             media = MediaFileUpload(file_path, mimetype='application/json')
             file = self.service.files().create(body=file_metadata, media_body=media, fields='id').execute()
             uploaded_file_id = file.get('id')
+            self._index_add(folder_id, file_name, uploaded_file_id)
             app.logger.info(f"New file {file_name} (ID: {uploaded_file_id}) uploaded to Drive folder.")
 
             # 3. Xóa các bản sao lưu cũ
@@ -68,35 +326,71 @@ class DriveService:
                 if len(backup_files) > num_backups_to_keep:
                     backup_files.sort(key=lambda x: x['createdTime'])
                     files_to_delete = backup_files[:-num_backups_to_keep]
-                    for old_file in files_to_delete:
-                        self.service.files().delete(fileId=old_file['id']).execute()
+                    batch_errors.extend(self.delete_files(files_to_delete, folder_id))
 
         except Exception as e:
+            self.invalidate_file(folder_id, file_name)
             app.logger.error(f"Error processing and uploading file to Drive: {e}")
             return {"error" : f"Error processing and uploading file to Drive: {e}"}
 
+        if batch_errors:
+            return {"id": uploaded_file_id, "batch_errors": batch_errors}
         return {"id": uploaded_file_id }
 
+    def _media_from_io(self, data_io, mimetype='application/json'):
+        return MediaIoBaseUpload(data_io, mimetype=mimetype,
+                                 chunksize=app.config['DRIVE_UPLOAD_CHUNK_SIZE'], resumable=True)
+
     def upload_string_to_drive(self, data_str, file_name, folder_id, num_backups_to_keep=1):
-        base_file_name, file_extension = os.path.splitext(file_name)
-        backup_pattern = f"{base_file_name}_backup_"
-        uploaded_file_id = None
-        
         # 1. Chuẩn bị dữ liệu cho việc tải lên/cập nhật
         data_bytes = data_str.encode('utf-8')
         data_io = io.BytesIO(data_bytes)
-        media_body = MediaIoBaseUpload(data_io, mimetype='application/json', resumable=True)
+        return self._upload_media(self._media_from_io(data_io), file_name, folder_id, num_backups_to_keep, content_hash(data_io))
 
+    def upload_object_to_drive(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        """
+        Mã hóa obj theo luồng vào tệp tạm rồi tải lên, tránh giữ nhiều bản sao của dữ liệu trong bộ nhớ.
+        codec mặc định lấy từ STORAGE_CODEC ('json', 'gzip' hoặc 'msgpack').
+        """
         try:
-            # 2. Tìm kiếm TẤT CẢ các tệp hiện có cùng tên
-            # Lấy thêm trường modifiedTime để đảm bảo dọn dẹp bản sao lưu sau này
-            query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-            results = self.service.files().list(
-                q=query,
-                spaces='drive',
-                fields='files(id, name, createdTime, modifiedTime)'
-            ).execute()
-            existing_files = results.get('files', [])
+            data_io, mimetype = spool_encoded(obj, codec=codec, compact=compact)
+        except Exception as e:
+            app.logger.error(f"Error serializing {file_name}: {e}")
+            return {"error": f"Error serializing {file_name}: {e}"}
+        try:
+            return self._upload_media(self._media_from_io(data_io, mimetype), file_name, folder_id, num_backups_to_keep, content_hash(data_io))
+        finally:
+            data_io.close()
+
+    @staticmethod
+    def _content_metadata(media_body, file_hash=None):
+        """
+        mimeType và appProperties (mã băm nội dung, codec) của tệp, để các công cụ bên ngoài biết tệp .json
+        thực chất là gzip hay msgpack.
+        """
+        mimetype = media_body.mimetype()
+        app_properties = {'codec': CODECS_BY_MIMETYPE.get(mimetype, 'json')}
+        if file_hash:
+            app_properties['contentHash'] = file_hash
+        return {'mimeType': mimetype, 'appProperties': app_properties}
+
+    def _upload_media(self, media_body, file_name, folder_id, num_backups_to_keep, file_hash=None):
+        """
+        Tải nội dung lên Drive theo chính sách sao lưu. Nếu mã băm nội dung trùng với tệp hiện có
+        thì bỏ qua việc ghi và xoay vòng bản sao lưu, trả về status "unchanged".
+        """
+        base_file_name, file_extension = os.path.splitext(file_name)
+        backup_pattern = f"{base_file_name}_backup_"
+        uploaded_file_id = None
+        batch_errors = []
+
+        try:
+            # 2. Tìm kiếm TẤT CẢ các tệp hiện có cùng tên (ưu tiên lấy từ chỉ mục)
+            existing_files = self.find_files(file_name, folder_id)
+
+            if file_hash and len(existing_files) == 1 and existing_files[0].get('contentHash') == file_hash:
+                app.logger.info(f"File {file_name} (ID: {existing_files[0]['id']}) is unchanged, skipping upload.")
+                return {"id": existing_files[0]['id'], "status": "unchanged"}
 
             if existing_files:
                 # Lấy ID của tệp đầu tiên (hoặc tệp duy nhất) để thực hiện thao tác Cập nhật/Sao lưu
@@ -108,28 +402,40 @@ class DriveService:
                 if num_backups_to_keep > 0:
                     app.logger.info(f"Backup policy active (keep {num_backups_to_keep}). Renaming {len(existing_files)} existing file(s) to backup.")
                     
-                    # Lặp qua tất cả các tệp hiện có có cùng tên
+                    # Đổi tên tất cả các tệp hiện có cùng tên trong một batch request
+                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+                    backup_name = f"{base_file_name}_backup_{timestamp}{file_extension}"
+                    # Cập nhật tên và thêm metadata is_backup: true cho tệp
+                    metadata_body = {
+                        'name': backup_name,
+                        'properties': {'is_backup': 'true'}
+                    }
+                    rename_requests = [
+                        (existing_file['id'], self.service.files().update(fileId=existing_file['id'], body=metadata_body))
+                        for existing_file in existing_files
+                    ]
+                    rename_errors = self.execute_batch(rename_requests)
                     for existing_file in existing_files:
-                        existing_file_id = existing_file['id']
-                        
-                        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                        backup_name = f"{base_file_name}_backup_{timestamp}{file_extension}"
-                        
-                        # Cập nhật tên và thêm metadata is_backup: true cho tệp
-                        metadata_body = {
-                            'name': backup_name,
-                            'properties': {'is_backup': 'true'}
-                        }
-                        self.service.files().update(fileId=existing_file_id, body=metadata_body).execute()
+                        if existing_file['id'] in rename_errors:
+                            continue
+                        self._index_remove(folder_id, file_name, existing_file['id'])
+                        self._index_add(folder_id, backup_name, existing_file['id'])
                         app.logger.info(f"File {existing_file['name']} renamed to backup {backup_name} and marked as backup.")
+
+                    # Không tạo tệp mới nếu còn tệp chưa được đổi tên, tránh sinh tệp trùng tên
+                    if rename_errors:
+                        errors = "; ".join(f"{file_id}: {exception}" for file_id, exception in rename_errors.items())
+                        raise RuntimeError(f"Failed to rename existing file(s) to backup: {errors}")
                     
                     # Sau khi sao lưu, ta TẠO TỆP MỚI
                     file_metadata = {
                         'name': file_name,
-                        'parents': [folder_id]
+                        'parents': [folder_id],
+                        **self._content_metadata(media_body, file_hash)
                     }
                     file = self.service.files().create(body=file_metadata, media_body=media_body, fields='id').execute()
                     uploaded_file_id = file.get('id')
+                    self._index_add(folder_id, file_name, uploaded_file_id, file_hash)
                     app.logger.info(f"New file {file_name} (ID: {uploaded_file_id}) created from string to Drive folder.")
 
                 # B. Chính sách Ghi đè (num_backups_to_keep = 0): Chỉ cập nhật tệp đầu tiên, xóa các tệp trùng tên còn lại
@@ -138,28 +444,29 @@ class DriveService:
                     # 3a. Cập nhật/Ghi đè tệp đầu tiên (An toàn hơn Xóa và Tạo mới)
                     file = self.service.files().update(
                         fileId=file_to_overwrite_id, 
+                        body=self._content_metadata(media_body, file_hash),
                         media_body=media_body, 
                         fields='id'
                     ).execute()
                     uploaded_file_id = file.get('id')
+                    self._index_set_hash(folder_id, file_name, uploaded_file_id, file_hash)
                     app.logger.info(f"Existing file {file_name} (ID: {uploaded_file_id}) updated (overwritten) with new string content.")
                     
-                    # 3b. Xóa bất kỳ tệp trùng tên nào khác (Nếu có)
+                    # 3b. Xóa bất kỳ tệp trùng tên nào khác (Nếu có) trong một batch request
                     if len(existing_files) > 1:
                         app.logger.warning(f"Found {len(existing_files)} files with name '{file_name}'. Deleting redundant files.")
-                        for i, existing_file in enumerate(existing_files):
-                            if i > 0: # Bắt đầu từ tệp thứ hai
-                                self.service.files().delete(fileId=existing_file['id']).execute()
-                                app.logger.info(f"Deleted redundant file with ID: {existing_file['id']}.")
+                        batch_errors.extend(self.delete_files(existing_files[1:], folder_id))
 
             else:
                 # 3. (Nếu tệp chưa tồn tại): Tải lên tệp mới
                 file_metadata = {
                     'name': file_name,
-                    'parents': [folder_id]
+                    'parents': [folder_id],
+                    **self._content_metadata(media_body, file_hash)
                 }
                 file = self.service.files().create(body=file_metadata, media_body=media_body, fields='id').execute()
                 uploaded_file_id = file.get('id')
+                self._index_add(folder_id, file_name, uploaded_file_id, file_hash)
                 app.logger.info(f"New file {file_name} (ID: {uploaded_file_id}) uploaded from string to Drive folder.")
 
             # 4. Dọn dẹp các bản sao lưu cũ
@@ -185,23 +492,23 @@ class DriveService:
                     backup_files.sort(key=lambda x: x['modifiedTime'])
                     
                     files_to_delete = backup_files[:-num_backups_to_keep]
-                    for old_file in files_to_delete:
-                        self.service.files().delete(fileId=old_file['id']).execute()
-                        app.logger.info(f"Deleted old backup file with ID: {old_file['id']} (Modified: {old_file['modifiedTime']}).")
+                    delete_errors = self.delete_files(files_to_delete, folder_id)
+                    app.logger.info(f"Deleted {len(files_to_delete) - len(delete_errors)} old backup file(s) in one batch request.")
+                    batch_errors.extend(delete_errors)
 
         except Exception as e:
+            self.invalidate_file(folder_id, file_name)
             app.logger.error(f"Error processing and uploading string to Drive: {e}")
             return {"error" : f"Error processing and uploading string to Drive: {e}"}
 
+        # Lỗi xóa từng tệp không làm hỏng lần tải lên, chỉ được báo cáo kèm kết quả
+        if batch_errors:
+            return {"id": uploaded_file_id, "batch_errors": batch_errors}
         return {"id": uploaded_file_id}
 
-    def get_json_file_from_folder(self, file_name, folder_id):
+    def _download_file(self, file_name, folder_id):
         try:
-            query = f"name='{file_name}' and '{folder_id}' in parents and trashed=false"
-            results = self.service.files().list(q=query,
-                                                spaces='drive',
-                                                fields='files(id)').execute()
-            items = results.get('files', [])
+            items = self.find_files(file_name, folder_id)
             if not items:
                 app.logger.warning(f"File '{file_name}' not found in Drive folder.")
                 return {"error": f"File '{file_name}' not found in Drive folder."}
@@ -210,7 +517,70 @@ class DriveService:
             request = self.service.files().get_media(fileId=file_id)
             file_content = request.execute()
             
-            return {"data": file_content.decode('utf-8')}
+            return {"data": file_content}
         except Exception as e:
+            # ID trong chỉ mục có thể đã cũ (tệp bị xóa bên ngoài), bỏ để lần sau truy vấn lại
+            self.invalidate_file(folder_id, file_name)
             app.logger.error(f"Error downloading file from Drive: {e}")
-            return {"error": f"Error downloading file from Drive: {e}"}
\ No newline at end of file
+            return {"error": f"Error downloading file from Drive: {e}"}
+
+    def get_json_file_from_folder(self, file_name, folder_id):
+        download_res = self._download_file(file_name, folder_id)
+        if "error" in download_res:
+            return download_res
+        try:
+            return {"data": decode_text(download_res["data"])}
+        except Exception as e:
+            app.logger.error(f"Error decoding file '{file_name}' from Drive: {e}")
+            return {"error": f"Error decoding file '{file_name}' from Drive: {e}"}
+
+    def get_object_from_folder(self, file_name, folder_id):
+        """
+        Tải và giải mã tệp (JSON, gzip JSON hoặc msgpack, tự nhận dạng), trả về đối tượng Python.
+        """
+        download_res = self._download_file(file_name, folder_id)
+        if "error" in download_res:
+            return download_res
+        try:
+            return {"data": decode_payload(download_res["data"])}
+        except Exception as e:
+            app.logger.error(f"Error decoding file '{file_name}' from Drive: {e}")
+            return {"error": f"Error decoding file '{file_name}' from Drive: {e}"}
+
+
+class AsyncDriveService(StorageBackend):
+    """
+    Giao diện async cho DriveService: các lệnh gọi Drive chạy trên thread pool giới hạn,
+    cho phép tải lên/tải xuống chạy song song với các lệnh gọi CoC API.
+    """
+    def __init__(self, drive_service):
+        self.drive_service = drive_service
+
+    @classmethod
+    async def create(cls, credentials):
+        drive_service = await run_blocking(DriveService.for_credentials, credentials)
+        return cls(drive_service)
+
+    async def preload_folder(self, folder_id):
+        return await run_blocking(self.drive_service.preload_folder, folder_id)
+
+    async def list_folder(self, folder_id):
+        return await run_blocking(self.drive_service.list_folder, folder_id)
+
+    async def find_files(self, file_name, folder_id):
+        return await run_blocking(self.drive_service.find_files, file_name, folder_id)
+
+    async def delete_files(self, files, folder_id):
+        return await run_blocking(self.drive_service.delete_files, files, folder_id)
+
+    async def upload_string(self, data_str, file_name, folder_id, num_backups_to_keep=1):
+        return await run_blocking(self.drive_service.upload_string_to_drive, data_str, file_name, folder_id, num_backups_to_keep=num_backups_to_keep)
+
+    async def upload_object(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        return await run_blocking(self.drive_service.upload_object_to_drive, obj, file_name, folder_id, num_backups_to_keep=num_backups_to_keep, compact=compact, codec=codec)
+
+    async def get_text(self, file_name, folder_id):
+        return await run_blocking(self.drive_service.get_json_file_from_folder, file_name, folder_id)
+
+    async def get_object(self, file_name, folder_id):
+        return await run_blocking(self.drive_service.get_object_from_folder, file_name, folder_id)
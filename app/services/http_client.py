@@ -0,0 +1,87 @@
+import asyncio
+import atexit
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from .. import app
+from .profiler import record_blocking
+
+# Event loop nền dùng chung cho toàn bộ tiến trình (worker)
+_loop = None
+_loop_lock = threading.Lock()
+# Mỗi event loop giữ một ClientSession riêng (aiohttp gắn session với loop tạo ra nó)
+_sessions = weakref.WeakKeyDictionary()
+# Thread pool giới hạn cho các lệnh gọi blocking (Drive, GAS, refresh credentials)
+_io_executor = ThreadPoolExecutor(max_workers=app.config['BLOCKING_IO_WORKERS'], thread_name_prefix='blocking-io')
+
+def get_background_loop():
+    """
+    Trả về event loop nền của tiến trình, khởi tạo thread chạy loop nếu chưa có.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name='coc-event-loop', daemon=True)
+            thread.start()
+    return _loop
+
+def async_to_sync(func):
+    """
+    Chạy các view async trên event loop nền thay vì tạo loop mới cho mỗi request,
+    nhờ đó pool kết nối tới API được giữ lại giữa các lần gọi.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        future = asyncio.run_coroutine_threadsafe(func(*args, **kwargs), get_background_loop())
+        return future.result()
+    return wrapper
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Chạy hàm blocking trên thread pool giới hạn để không chặn event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, record_blocking(functools.partial(func, *args, **kwargs)))
+
+async def get_coc_session():
+    """
+    Trả về ClientSession dùng chung (keep-alive, giới hạn số kết nối) cho loop hiện tại.
+    """
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=app.config['COC_POOL_SIZE'],
+            limit_per_host=app.config['COC_POOL_SIZE'],
+            ttl_dns_cache=300,
+            keepalive_timeout=app.config['COC_KEEPALIVE_TIMEOUT'],
+        )
+        session = aiohttp.ClientSession(connector=connector)
+        _sessions[loop] = session
+        app.logger.info("Created shared aiohttp session for CoC API.")
+    return session
+
+async def close_coc_session():
+    loop = asyncio.get_running_loop()
+    session = _sessions.pop(loop, None)
+    if session is not None and not session.closed:
+        await session.close()
+
+def shutdown_background_loop():
+    """
+    Đóng session dùng chung và dừng event loop nền khi worker tắt.
+    """
+    loop = _loop
+    if loop is None or not loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_coc_session(), loop).result(timeout=5)
+    except Exception as e:
+        app.logger.error(f"Error closing shared aiohttp session: {e}")
+    loop.call_soon_threadsafe(loop.stop)
+    _io_executor.shutdown(wait=False)
+
+atexit.register(shutdown_background_loop)
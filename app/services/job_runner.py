@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+import uuid
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+from .. import app, cache
+from .http_client import get_background_loop, run_blocking
+
+# Job đang chạy trong task hiện tại, dùng để báo cáo tiến độ từ bên trong pipeline
+_current_job = contextvars.ContextVar('current_job', default=None)
+ACTIVE_STATUSES = ('queued', 'running')
+
+def job_status_key(job_id):
+    return f"job:{job_id}"
+
+def job_dedupe_key(job_type, params):
+    # Job cùng loại nhưng khác tham số (vd. khoảng mùa backfill, force) là các job khác nhau
+    return f"job_active:{job_type}:{json.dumps(list(params), sort_keys=True)}"
+
+def _acquire_claim_lock():
+    # Khóa file dùng chung giữa các worker: FileSystemCache.add chỉ kiểm tra rồi ghi nên không nguyên tử
+    lock_dir = cache.config.get('CACHE_DIR') or tempfile.gettempdir()
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = open(os.path.join(lock_dir, 'job_active.lock'), 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def _release_claim_lock(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+def claim_job(job):
+    """
+    Giành khóa chống chạy trùng của job trong cache dùng chung. Trả về None nếu giành được
+    (trạng thái 'queued' của job được ghi ngay trong khóa), hoặc trạng thái của job đang giữ khóa.
+    """
+    lock_file = _acquire_claim_lock()
+    try:
+        if not cache.add(job.dedupe_key, job.id, timeout=app.config['JOB_ACTIVE_TTL']):
+            holder = cache.get(job.dedupe_key)
+            status = cache.get(job_status_key(holder)) if holder else None
+            if isinstance(status, dict) and status.get("status") in ACTIVE_STATUSES:
+                return status
+            # Khóa đã hết hạn (tệp cache còn), hoặc job giữ khóa đã kết thúc/worker đã chết: giành lại
+            cache.set(job.dedupe_key, job.id, timeout=app.config['JOB_ACTIVE_TTL'])
+        cache.set(job_status_key(job.id), job.to_dict(), timeout=app.config['JOB_STATUS_TTL'])
+        return None
+    finally:
+        _release_claim_lock(lock_file)
+
+class Job:
+    def __init__(self, job_type, params=()):
+        self.id = uuid.uuid4().hex
+        self.job_type = job_type
+        self.params = list(params)
+        self.dedupe_key = job_dedupe_key(job_type, params)
+        self.status = 'queued'
+        self.progress = None
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Ghi trạng thái vào cache dùng chung: một task ghi tuần tự cho mỗi job
+        self._writer = None
+        self._dirty = False
+
+    @property
+    def is_active(self):
+        return self.status in ACTIVE_STATUSES
+
+    def to_dict(self):
+        duration = None
+        if self.started_at is not None:
+            duration = (self.finished_at or time.time()) - self.started_at
+        return {
+            "job_id": self.id,
+            "type": self.job_type,
+            "params": self.params,
+            "status": self.status,
+            "progress": self.progress,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "duration": duration,
+            "result": self.result,
+        }
+
+class JobRunner:
+    """
+    Chạy các pipeline dài trên event loop nền của tiến trình, giới hạn số job chạy đồng thời
+    và giữ lịch sử trạng thái của các job gần nhất. Trạng thái được ghi thêm vào cache dùng chung
+    để worker gunicorn khác cũng truy vấn được và không chạy trùng job đang chạy ở worker khác.
+    """
+    def __init__(self, max_workers, max_history):
+        self.max_workers = max_workers
+        self.max_history = max_history
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._semaphore = None
+
+    def _find_local_active(self, dedupe_key):
+        # Gọi khi đang giữ self._lock
+        return next((job for job in self._jobs.values() if job.dedupe_key == dedupe_key and job.is_active), None)
+
+    async def submit(self, job_type, coro_func, *args, params=()):
+        """
+        Đưa job vào hàng đợi và trả về ngay trạng thái của nó (dict như Job.to_dict). Nếu job cùng loại
+        và cùng params đang chờ/chạy (ở worker này hoặc worker khác) thì trả về trạng thái của job đó.
+        """
+        dedupe_key = job_dedupe_key(job_type, params)
+        with self._lock:
+            job = self._find_local_active(dedupe_key)
+        if job is not None:
+            return job.to_dict()
+        job = Job(job_type, params)
+        # Kiểm tra và giành khóa trong một bước, để hai worker nhận cùng lúc một request cron không cùng chạy job
+        holder = await run_blocking(claim_job, job)
+        if holder is not None:
+            return holder
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_history()
+        # Chạy trong context rỗng để job không giữ tham chiếu tới request context của Flask
+        contextvars.Context().run(asyncio.run_coroutine_threadsafe, self._run(job, coro_func, args), get_background_loop())
+        app.logger.info(f"Job {job.id} ({job_type}) queued.")
+        return job.to_dict()
+
+    def get(self, job_id):
+        """
+        Trạng thái job (dict) từ worker này, hoặc từ cache dùng chung nếu job do worker khác chạy.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        status = cache.get(job_status_key(job_id))
+        return status if isinstance(status, dict) else None
+
+    def _publish(self, job):
+        """
+        Ghi trạng thái hiện tại của job vào cache dùng chung qua thread pool. Các lần ghi của một job
+        chạy tuần tự trong một task nên bản ghi sau cùng luôn là trạng thái mới nhất.
+        """
+        job._dirty = True
+        if job._writer is None or job._writer.done():
+            job._writer = asyncio.ensure_future(self._write_status(job))
+        return job._writer
+
+    async def _write_status(self, job):
+        while job._dirty:
+            job._dirty = False
+            try:
+                await run_blocking(cache.set, job_status_key(job.id), job.to_dict(), timeout=app.config['JOB_STATUS_TTL'])
+            except Exception as e:
+                app.logger.warning(f"Could not store status of job {job.id}: {e}")
+
+    def _trim_history(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.is_active]
+        for job_id in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job_id]
+
+    async def _run(self, job, coro_func, args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        async with self._semaphore:
+            job.status = 'running'
+            job.started_at = time.time()
+            self._publish(job)
+            token = _current_job.set(job)
+            try:
+                result = await coro_func(*args)
+                job.result = result
+                job.status = 'failed' if isinstance(result, dict) and 'error' in result else 'succeeded'
+            except Exception as e:
+                app.logger.error(f"Job {job.id} ({job.job_type}) failed: {e}")
+                job.result = {"error": str(e)}
+                job.status = 'failed'
+            finally:
+                _current_job.reset(token)
+                job.finished_at = time.time()
+            await self._publish(job)
+            try:
+                await run_blocking(cache.delete, job.dedupe_key)
+            except Exception as e:
+                app.logger.warning(f"Could not release job key of job {job.id}: {e}")
+            app.logger.info(f"Job {job.id} ({job.job_type}) {job.status} in {job.finished_at - job.started_at:.2f}s.")
+
+def report_progress(message):
+    job = _current_job.get()
+    if job is not None:
+        job.progress = message
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Gọi từ thread khác (không có event loop): chỉ cập nhật trong bộ nhớ
+            return
+        job_runner._publish(job)
+
+job_runner = JobRunner(max_workers=app.config['JOB_MAX_WORKERS'], max_history=app.config['JOB_HISTORY_SIZE'])
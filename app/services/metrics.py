@@ -0,0 +1,143 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Mốc mặc định (giây) của histogram, từ các lệnh gọi API nhanh tới cả pipeline
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines += self._render_samples(items)
+        return lines
+
+class Counter(_Metric):
+    """
+    Bộ đếm chỉ tăng, tách theo nhãn.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    """
+    Histogram theo các mốc cố định (tích lũy khi xuất), kèm tổng và số lần quan sát.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [số lần theo từng mốc (mốc cuối là +Inf), tổng, số lần]
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render_metrics():
+    """
+    Xuất mọi metric của tiến trình theo định dạng văn bản của Prometheus.
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+# Lệnh gọi API (CoC, clashofstats) qua fetch_data
+API_REQUESTS = Counter('mkclan_api_requests_total', "HTTP attempts made by fetch_data.", ('endpoint', 'status'))
+API_RETRIES = Counter('mkclan_api_retries_total', "Retries scheduled by fetch_data.", ('endpoint',))
+API_REQUEST_DURATION = Histogram('mkclan_api_request_duration_seconds', "Total fetch_data duration including retries and rate limiting.", ('endpoint', 'status'))
+API_RATE_LIMIT_WAIT = Histogram('mkclan_api_rate_limit_wait_seconds', "Time spent waiting for the rate limiter.", ('endpoint',))
+
+# Thao tác Google Drive
+DRIVE_OPERATIONS = Counter('mkclan_drive_operations_total', "Google Drive API operations.", ('operation', 'status'))
+DRIVE_OPERATION_DURATION = Histogram('mkclan_drive_operation_duration_seconds', "Google Drive API operation duration.", ('operation',))
+DRIVE_BYTES = Counter('mkclan_drive_bytes_total', "Payload bytes transferred to and from Google Drive.", ('direction',))
+
+# Mã hóa/giải mã dữ liệu
+SERIALIZATION_DURATION = Histogram('mkclan_serialization_duration_seconds', "Time spent encoding and decoding payloads.", ('operation', 'codec'),
+                                   buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+SERIALIZATION_BYTES = Counter('mkclan_serialization_bytes_total', "Bytes produced by encoding or consumed by decoding.", ('operation', 'codec'))
+
+# Token CoC
+COC_TOKEN_CACHE = Counter('mkclan_coc_token_cache_total', "CoC API token lookups by result (hit, stale, miss).", ('result',))
+COC_LOGINS = Counter('mkclan_coc_logins_total', "CoC developer site logins.", ('status',))
+
+# Cache của các endpoint đọc /data/*
+READ_CACHE_LOOKUPS = Counter('mkclan_read_cache_lookups_total', "Read API cache lookups by dataset and result.", ('dataset', 'result'))
+
+# Pipeline
+PIPELINE_DURATION = Histogram('mkclan_pipeline_duration_seconds', "Total pipeline duration per job type.", ('job_type', 'status'))
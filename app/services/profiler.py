@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import datetime
+import threading
+import functools
+import contextvars
+from collections import Counter
+from .. import app
+
+# Phiên profile của pipeline hiện tại, được các task con kế thừa qua context
+_current_profile = contextvars.ContextVar('current_profile', default=None)
+_factory_lock = threading.Lock()
+# loop -> [số phiên đang chạy, task factory trước đó], để trả lại factory cũ khi phiên cuối kết thúc
+_installed_factories = {}
+
+class ProfileSession:
+    """
+    Một lần profile pipeline: luồng lấy mẫu stack của mọi thread (dạng collapsed cho flame graph)
+    và dòng thời gian các task asyncio/lệnh blocking (định dạng Chrome trace).
+    """
+    def __init__(self, name, interval):
+        self.name = name
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.stacks = Counter()
+        self.samples = 0
+        self.events = []
+        self._events_lock = threading.Lock()
+        self._task_seq = 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f'profiler-{name}', daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _sample_loop(self):
+        sampler_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                # Định dạng collapsed: các frame ngăn cách bởi ';', số mẫu sau khoảng trắng cuối cùng
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def _timestamp(self, moment):
+        return round((moment - self.started) * 1e6)
+
+    def add_span(self, category, name, started, finished, lane, lane_name):
+        with self._events_lock:
+            self.events.append({
+                "name": name, "cat": category, "ph": "X",
+                "ts": self._timestamp(started), "dur": round((finished - started) * 1e6),
+                "pid": 1 if category == 'task' else 2, "tid": lane,
+                "args": {"lane": lane_name},
+            })
+
+    def track_task(self, task):
+        with self._events_lock:
+            self._task_seq += 1
+            lane = self._task_seq
+        started = time.perf_counter()
+        coro = task.get_coro()
+        name = getattr(coro, '__qualname__', None) or task.get_name()
+        task.add_done_callback(lambda _: self.add_span('task', name, started, time.perf_counter(), lane, task.get_name()))
+
+    def trace(self):
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "asyncio tasks"}},
+            {"name": "process_name", "ph": "M", "pid": 2, "args": {"name": "blocking calls"}},
+        ]
+        with self._events_lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms",
+                "otherData": {"name": self.name, "samples": self.samples, "interval": self.interval}}
+
+    def save(self, profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(profile_dir, f"{stamp}_{self.name}_{uuid.uuid4().hex[:8]}")
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(base + '.trace.json', 'w', encoding='utf-8') as f:
+            json.dump(self.trace(), f)
+        return base
+
+def _task_factory(previous, loop, coro, **kwargs):
+    if previous is not None:
+        task = previous(loop, coro, **kwargs)
+    else:
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+    session = _current_profile.get()
+    if session is not None:
+        session.track_task(task)
+    return task
+
+def _install_task_factory(loop):
+    with _factory_lock:
+        state = _installed_factories.get(loop)
+        if state is None:
+            previous = loop.get_task_factory()
+            state = _installed_factories[loop] = [0, previous]
+            loop.set_task_factory(functools.partial(_task_factory, previous))
+        state[0] += 1
+
+def _uninstall_task_factory(loop):
+    with _factory_lock:
+        state = _installed_factories[loop]
+        state[0] -= 1
+        if state[0] == 0:
+            del _installed_factories[loop]
+            loop.set_task_factory(state[1])
+
+def profiling_requested(flag=None):
+    """
+    Bật profile khi PROFILE_CRON_JOBS được bật hoặc request có ?profile=1 (các endpoint cron đã kiểm tra khóa).
+    """
+    return app.config['PROFILE_CRON_JOBS'] or flag == '1'
+
+def record_blocking(func):
+    """
+    Bọc hàm sẽ chạy trên thread pool để ghi lại thời gian chạy vào phiên profile hiện tại (nếu có).
+    """
+    session = _current_profile.get()
+    if session is None:
+        return func
+    name = getattr(func, '__qualname__', None) or getattr(getattr(func, 'func', None), '__qualname__', repr(func))
+
+    def wrapper():
+        started = time.perf_counter()
+        try:
+            return func()
+        finally:
+            thread = threading.current_thread()
+            session.add_span('blocking', name, started, time.perf_counter(), thread.ident, thread.name)
+    return wrapper
+
+def _prune_profiles(profile_dir, max_profiles):
+    # Mỗi lần profile gồm hai tệp cùng tên gốc (.folded và .trace.json)
+    bases = {}
+    for entry in os.scandir(profile_dir):
+        if entry.name.endswith('.folded'):
+            bases[entry.path[:-len('.folded')]] = entry.stat().st_mtime
+    for base in sorted(bases, key=bases.get)[:max(0, len(bases) - max_profiles)]:
+        for suffix in ('.folded', '.trace.json'):
+            try:
+                os.remove(base + suffix)
+            except FileNotFoundError:
+                pass
+
+def _finish_session(session, name, started):
+    # Dừng luồng lấy mẫu (join) và ghi tệp là thao tác blocking, được chạy trên thread pool
+    session.stop()
+    try:
+        base = session.save(app.config['PROFILE_DIR'])
+        _prune_profiles(app.config['PROFILE_DIR'], app.config['PROFILE_MAX_FILES'])
+        app.logger.info(f"Profile of {name} ({time.perf_counter() - started:.2f}s, {session.samples} samples) written to {base}.folded")
+        return base
+    except OSError as e:
+        app.logger.error(f"Error writing profile of {name}: {e}")
+        return None
+
+async def run_profiled(name, coro_func, *args):
+    """
+    Chạy coro_func(*args) trong một phiên profile rồi ghi kết quả ra PROFILE_DIR,
+    chỉ giữ PROFILE_MAX_FILES lần profile gần nhất. Đường dẫn được thêm vào kết quả dạng dict.
+    """
+    # http_client import module này để bọc các lệnh blocking
+    from .http_client import run_blocking
+    loop = asyncio.get_running_loop()
+    _install_task_factory(loop)
+    session = ProfileSession(name, app.config['PROFILE_SAMPLE_INTERVAL'])
+    token = _current_profile.set(session)
+    session.start()
+    started = time.perf_counter()
+    try:
+        # Chạy trong task riêng để chính pipeline cũng xuất hiện trên dòng thời gian
+        result = await asyncio.ensure_future(coro_func(*args))
+    finally:
+        _current_profile.reset(token)
+        _uninstall_task_factory(loop)
+        base = await run_blocking(_finish_session, session, name, started)
+    if isinstance(result, dict) and base is not None:
+        result = dict(result, profile=os.path.basename(base))
+    return result
@@ -0,0 +1,107 @@
+import time
+import random
+import asyncio
+from .. import app
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket dùng chung cho mọi lệnh gọi CoC API. Tốc độ tăng dần khi các lệnh gọi thành công
+    và giảm một nửa khi bị giới hạn (429/503), đồng thời tạm dừng theo header Retry-After.
+    """
+    def __init__(self, rate, min_rate, max_rate, burst, increase_step=1.0):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = float(burst)
+        self.increase_step = increase_step
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + self.increase_step / self.rate)
+
+    def on_throttle(self, retry_after=None):
+        now = time.monotonic()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+        # Nhiều request bị giới hạn cùng lúc chỉ tính là một lần giảm tốc
+        if now - self.last_decrease >= 1.0:
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 1.0)
+            self.last_decrease = now
+            app.logger.warning(f"CoC API throttled, rate limit lowered to {self.rate:.2f} req/s.")
+
+class RequestBudget:
+    """
+    Giới hạn tổng số request (kể cả retry) trong một lần chạy pipeline.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def consume(self):
+        if self.used >= self.limit:
+            return False
+        self.used += 1
+        return True
+
+    @property
+    def remaining(self):
+        return self.limit - self.used
+
+_coc_rate_limiter = None
+
+def get_coc_rate_limiter():
+    global _coc_rate_limiter
+    if _coc_rate_limiter is None:
+        _coc_rate_limiter = AdaptiveRateLimiter(
+            rate=app.config['COC_RATE_LIMIT'],
+            min_rate=app.config['COC_MIN_RATE_LIMIT'],
+            max_rate=app.config['COC_MAX_RATE_LIMIT'],
+            burst=app.config['COC_RATE_BURST'],
+        )
+    return _coc_rate_limiter
+
+_clashofstats_rate_limiter = None
+
+def get_clashofstats_rate_limiter():
+    # clashofstats là dịch vụ khác, không dùng chung hạn mức với CoC API
+    global _clashofstats_rate_limiter
+    if _clashofstats_rate_limiter is None:
+        rate = app.config['CLASHOFSTATS_RATE_LIMIT']
+        _clashofstats_rate_limiter = AdaptiveRateLimiter(
+            rate=rate,
+            min_rate=min(rate, app.config['COC_MIN_RATE_LIMIT']),
+            max_rate=rate,
+            burst=max(1, int(rate)),
+        )
+    return _clashofstats_rate_limiter
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+    # Exponential backoff với "full jitter" để các request retry không dồn vào cùng thời điểm
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,145 @@
+import gzip
+import time
+import bisect
+import asyncio
+import hashlib
+import threading
+from .. import app
+from .serializer import dumps_json
+from .metrics import READ_CACHE_LOOKUPS
+
+# Nội dung nhỏ hơn ngưỡng này không đáng để nén
+GZIP_MIN_SIZE = 1024
+
+def encode_body(data):
+    return dumps_json(data, compact=True).encode('utf-8')
+
+def compress_body(body):
+    return gzip.compress(body, compresslevel=6, mtime=0)
+
+def body_etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+class CachedDataset:
+    """
+    Bản mới nhất của một tệp đầu ra (clan_info, war_log, mùa CWL) giữ trong bộ nhớ,
+    kèm nội dung JSON/gzip và ETag được tính khi cần rồi giữ lại.
+    """
+    __slots__ = ('data', 'source_hash', 'checked_at', '_body', '_gzip_body', '_etag', '_end_times')
+
+    def __init__(self, data, source_hash=None):
+        self.data = data
+        self.source_hash = source_hash
+        self.checked_at = time.monotonic()
+        self._body = None
+        self._gzip_body = None
+        self._etag = None
+        self._end_times = None
+
+    def body(self):
+        if self._body is None:
+            self._body = encode_body(self.data)
+        return self._body
+
+    def etag(self):
+        if self._etag is None:
+            self._etag = body_etag(self.body())
+        return self._etag
+
+    def gzip_body(self):
+        if self._gzip_body is None:
+            self._gzip_body = compress_body(self.body())
+        return self._gzip_body
+
+    def wars_after(self, since):
+        """
+        Số trận ở đầu danh sách warlog (đã sắp xếp endTime giảm dần) có endTime lớn hơn since.
+        """
+        if self._end_times is None:
+            # Đảo về thứ tự tăng dần để tìm kiếm nhị phân
+            self._end_times = [war.get('endTime', '') for war in reversed(self.data)]
+        return len(self._end_times) - bisect.bisect_right(self._end_times, since)
+
+class ReadCache:
+    """
+    Cache trong tiến trình cho các endpoint đọc /data/*. Mỗi lần chạy pipeline ghi đè bản mới (publish);
+    khi chưa có hoặc đã quá READ_CACHE_TTL thì đối chiếu mã băm với storage và chỉ tải lại nếu tệp đã đổi
+    (ví dụ do worker khác ghi).
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def publish(self, key, data, source_hash=None):
+        with self._lock:
+            self._entries[key] = CachedDataset(data, source_hash)
+
+    def peek(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def _get_loading_lock(self, key):
+        lock = self._loading.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._loading[key] = lock
+        return lock
+
+    async def get(self, key, file_name, folder_id, storage_factory, loader=None):
+        """
+        Trả về {"data": CachedDataset} hoặc {"error": ...}; storage_factory là coroutine tạo StorageBackend,
+        chỉ được gọi khi cần đối chiếu hoặc tải từ storage. loader(storage, folder_id) thay cho việc đọc
+        file_name khi dữ liệu gồm nhiều tệp (file_name khi đó là tệp đại diện, vd. manifest warlog dạng shard).
+        """
+        dataset_name = key[1]
+        entry = self.peek(key)
+        if entry is not None and time.monotonic() - entry.checked_at < app.config['READ_CACHE_TTL']:
+            READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='hit')
+            return {"data": entry}
+
+        # Single-flight: các request cùng khóa chờ một lần tải
+        async with self._get_loading_lock(key):
+            entry = self.peek(key)
+            if entry is not None and time.monotonic() - entry.checked_at < app.config['READ_CACHE_TTL']:
+                READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='hit')
+                return {"data": entry}
+            try:
+                storage = await storage_factory()
+                files = await storage.find_files(file_name, folder_id)
+                if not files:
+                    READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='not_found')
+                    return {"error": f"File '{file_name}' not found.", "not_found": True}
+                source_hash = files[0].get('contentHash')
+                if entry is not None and source_hash and entry.source_hash == source_hash:
+                    entry.checked_at = time.monotonic()
+                    READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='revalidated')
+                    return {"data": entry}
+                load_res = await (loader(storage, folder_id) if loader else storage.get_object(file_name, folder_id))
+            except Exception as e:
+                load_res = {"error": f"Error loading {file_name}: {e}"}
+            if "error" in load_res:
+                if entry is not None:
+                    # Storage lỗi: vẫn phục vụ bản cũ thay vì trả lỗi
+                    app.logger.warning(f"Serving stale {file_name} after error: {load_res['error']}")
+                    READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='stale')
+                    return {"data": entry}
+                READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='error')
+                return {"error": load_res["error"]}
+            self.publish(key, load_res["data"], source_hash)
+            READ_CACHE_LOOKUPS.inc(dataset=dataset_name, result='miss')
+            return {"data": self.peek(key)}
+
+read_cache = ReadCache()
+
+async def publish_output(storage, key, data, file_name, folder_id):
+    """
+    Đưa dữ liệu vừa được pipeline lưu vào cache đọc, kèm mã băm nội dung của tệp trong storage (lấy từ chỉ mục).
+    key có dạng (tag clan, tên dataset, ...), vd. (tag, 'warlog') hoặc (tag, 'cwl', '2024-05').
+    """
+    try:
+        files = await storage.find_files(file_name, folder_id)
+    except Exception as e:
+        app.logger.warning(f"Could not look up {file_name} after upload: {e}")
+        files = []
+    read_cache.publish(key, data, files[0].get('contentHash') if files else None)
@@ -0,0 +1,123 @@
+import json
+import gzip
+import hashlib
+import tempfile
+from .. import app
+from .metrics import SERIALIZATION_DURATION, SERIALIZATION_BYTES
+
+# Gom các đoạn nhỏ do iterencode sinh ra trước khi ghi ra tệp tạm
+WRITE_BUFFER_SIZE = 64 * 1024
+
+# Các định dạng lưu trữ hỗ trợ và mimetype tương ứng khi tải lên Drive
+STORAGE_MIMETYPES = {
+    'json': 'application/json',
+    'gzip': 'application/gzip',
+    'msgpack': 'application/x-msgpack',
+}
+CODECS_BY_MIMETYPE = {mimetype: codec for codec, mimetype in STORAGE_MIMETYPES.items()}
+GZIP_MAGIC = b'\x1f\x8b'
+UTF8_BOM = b'\xef\xbb\xbf'
+# Byte đầu tiên hợp lệ của một tài liệu JSON
+JSON_FIRST_BYTES = b'{["-0123456789tfn'
+# Byte đầu tiên của msgpack cho các giá trị gốc mà ứng dụng ghi: fixmap/fixarray, array/map 16/32 bit và nil
+MSGPACK_FIRST_BYTES = frozenset(range(0x80, 0xa0)) | {0xc0, 0xdc, 0xdd, 0xde, 0xdf}
+
+def json_dump_options(compact=None):
+    if compact is None:
+        compact = app.config['JSON_COMPACT']
+    if compact:
+        return {"separators": (',', ':')}
+    return {"indent": 4}
+
+def dumps_json(obj, compact=None):
+    return json.dumps(obj, **json_dump_options(compact))
+
+def _write_json_chunks(obj, fp, compact=None):
+    encoder = json.JSONEncoder(**json_dump_options(compact))
+    buffer = []
+    buffered = 0
+    for chunk in encoder.iterencode(obj):
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= WRITE_BUFFER_SIZE:
+            fp.write(''.join(buffer).encode('utf-8'))
+            buffer.clear()
+            buffered = 0
+    fp.write(''.join(buffer).encode('utf-8'))
+
+def spool_encoded(obj, codec=None, compact=None):
+    """
+    Mã hóa obj theo codec ('json', 'gzip' hoặc 'msgpack') và ghi thẳng vào SpooledTemporaryFile
+    (tràn ra đĩa khi vượt JSON_SPOOL_MAX_SIZE). Trả về (tệp tạm, mimetype).
+    """
+    codec = codec or app.config['STORAGE_CODEC']
+    if codec not in STORAGE_MIMETYPES:
+        raise ValueError(f"Unknown storage codec: {codec}")
+    spool = tempfile.SpooledTemporaryFile(max_size=app.config['JSON_SPOOL_MAX_SIZE'])
+    try:
+        with SERIALIZATION_DURATION.time(operation='encode', codec=codec):
+            if codec == 'json':
+                _write_json_chunks(obj, spool, compact)
+            elif codec == 'gzip':
+                with gzip.GzipFile(fileobj=spool, mode='wb', compresslevel=6, mtime=0) as gz:
+                    _write_json_chunks(obj, gz, compact)
+            else:
+                import msgpack
+                spool.write(msgpack.packb(obj, use_bin_type=True))
+        SERIALIZATION_BYTES.inc(spool.tell(), operation='encode', codec=codec)
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool, STORAGE_MIMETYPES[codec]
+
+def content_hash(fp):
+    """
+    Tính SHA-256 của nội dung tệp theo từng đoạn rồi đưa con trỏ về đầu tệp.
+    """
+    digest = hashlib.sha256()
+    fp.seek(0)
+    for chunk in iter(lambda: fp.read(WRITE_BUFFER_SIZE), b''):
+        digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+def detect_codec(payload):
+    """
+    Nhận dạng định dạng của nội dung đã lưu: 'gzip', 'json' (kể cả có BOM UTF-8) hoặc 'msgpack'.
+    Nội dung không khớp định dạng nào thì báo lỗi thay vì đoán.
+    """
+    head = bytes(payload[:64])
+    if head[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if head[:1] and head[0] in MSGPACK_FIRST_BYTES:
+        return 'msgpack'
+    text_head = head[len(UTF8_BOM):] if head.startswith(UTF8_BOM) else head
+    first_byte = text_head.lstrip()[:1]
+    if not first_byte or first_byte in JSON_FIRST_BYTES:
+        return 'json'
+    raise ValueError(f"Unrecognized payload format (first bytes {head[:8]!r})")
+
+def decode_payload(payload):
+    """
+    Giải mã nội dung tải về từ Drive (hoặc đọc qua mmap), tự nhận dạng định dạng để các tệp JSON cũ vẫn đọc được.
+    """
+    if not payload:
+        return None
+    codec = detect_codec(payload)
+    SERIALIZATION_BYTES.inc(len(payload), operation='decode', codec=codec)
+    with SERIALIZATION_DURATION.time(operation='decode', codec=codec):
+        if codec == 'gzip':
+            return json.loads(gzip.decompress(payload))
+        if codec == 'json':
+            # json.loads không nhận mmap/memoryview; với bytes, json.loads tự bỏ qua BOM UTF-8
+            return json.loads(payload if isinstance(payload, (bytes, bytearray)) else bytes(payload))
+        import msgpack
+        return msgpack.unpackb(payload, raw=False)
+
+def decode_text(payload):
+    # Giữ tương thích cho các chỗ cần nội dung JSON dạng chuỗi; nhận cả bytes, mmap và memoryview
+    if payload[:2] == GZIP_MAGIC:
+        payload = gzip.decompress(payload)
+    text = str(payload, 'utf-8')
+    return text[1:] if text.startswith('\ufeff') else text
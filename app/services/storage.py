@@ -0,0 +1,427 @@
+import os
+import io
+import mmap
+import time
+import shutil
+import sqlite3
+import asyncio
+import datetime
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from .. import app
+from .http_client import run_blocking
+from .serializer import spool_encoded, decode_payload, decode_text, content_hash
+
+class StorageBackend(ABC):
+    """
+    Giao diện lưu trữ async dùng chung cho các pipeline. folder_id là id thư mục trên Drive,
+    các backend khác dùng nó làm khóa thư mục. Các hàm trả về dict {"data"/"id"/...} hoặc {"error"}
+    giống DriveService.
+    """
+    @abstractmethod
+    async def preload_folder(self, folder_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def list_folder(self, folder_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def find_files(self, file_name, folder_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def delete_files(self, files, folder_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upload_string(self, data_str, file_name, folder_id, num_backups_to_keep=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def upload_object(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_text(self, file_name, folder_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def get_object(self, file_name, folder_id):
+        raise NotImplementedError
+
+    async def shared_file_id(self, file_name, folder_id, result):
+        """
+        Id để tệp khác tham chiếu tới tệp vừa ghi (ví dụ urls trong tệp tổng thể CWL).
+        result là kết quả của lần ghi upload_string/upload_object.
+        """
+        return result.get("id")
+
+class LocalStorage(StorageBackend):
+    """
+    Lưu tệp trên đĩa cục bộ (root_dir/<folder_id>/<file_name>) với chỉ mục metadata trong SQLite.
+    Ghi nguyên tử (tệp tạm + fsync + os.replace), đọc qua mmap, bỏ qua lần ghi khi nội dung không đổi
+    và giữ bản sao lưu theo cùng chính sách num_backups_to_keep như DriveService.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self._local = threading.local()
+        # Ghi/đổi tên cùng một tệp từ nhiều thread phải tuần tự
+        self._write_lock = threading.Lock()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS files (folder_id TEXT NOT NULL, name TEXT NOT NULL, content_hash TEXT, "
+                     "size INTEGER, is_backup INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL, "
+                     "mirrored_hash TEXT, mirror_id TEXT, PRIMARY KEY (folder_id, name))")
+        # Chỉ mục tạo trước khi có WriteThroughStorage chưa có các cột trạng thái mirror
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(files)")}
+        for column in ('mirrored_hash', 'mirror_id'):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        conn.commit()
+
+    def _connect(self):
+        # sqlite3.Connection không dùng chung được giữa các thread: mỗi thread một kết nối
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root_dir, 'index.sqlite3'), timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _path(self, folder_id, file_name):
+        for part in (folder_id, file_name):
+            if not part or part in ('.', '..') or os.sep in part or (os.altsep and os.altsep in part):
+                raise ValueError(f"Invalid storage path component: {part!r}")
+        return os.path.join(self.root_dir, folder_id, file_name)
+
+    @staticmethod
+    def _file_id(folder_id, file_name):
+        return f"{folder_id}/{file_name}"
+
+    def _entry(self, folder_id, name, file_hash):
+        return {'id': self._file_id(folder_id, name), 'name': name, 'contentHash': file_hash}
+
+    def list_folder_sync(self, folder_id):
+        rows = self._connect().execute("SELECT name, content_hash FROM files WHERE folder_id = ?", (folder_id,)).fetchall()
+        return {"data": {name: [self._entry(folder_id, name, file_hash)] for name, file_hash in rows}}
+
+    def find_files_sync(self, file_name, folder_id):
+        row = self._connect().execute("SELECT content_hash FROM files WHERE folder_id = ? AND name = ?", (folder_id, file_name)).fetchone()
+        if row is None or not os.path.exists(self._path(folder_id, file_name)):
+            return []
+        return [self._entry(folder_id, file_name, row[0])]
+
+    def delete_files_sync(self, files, folder_id):
+        errors = []
+        conn = self._connect()
+        with self._write_lock:
+            for file in files:
+                try:
+                    path = self._path(folder_id, file['name'])
+                    if os.path.exists(path):
+                        os.remove(path)
+                    conn.execute("DELETE FROM files WHERE folder_id = ? AND name = ?", (folder_id, file['name']))
+                except Exception as e:
+                    errors.append(f"Failed to delete file {file['id']}: {e}")
+            conn.commit()
+        return errors
+
+    def _atomic_write(self, path, data_io):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                data_io.seek(0)
+                shutil.copyfileobj(data_io, tmp)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return os.path.getsize(path)
+
+    def write_sync(self, data_io, file_name, folder_id, num_backups_to_keep=1, file_hash=None):
+        try:
+            path = self._path(folder_id, file_name)
+            file_hash = file_hash or content_hash(data_io)
+            conn = self._connect()
+            with self._write_lock:
+                existing = self.find_files_sync(file_name, folder_id)
+                if existing and existing[0]['contentHash'] == file_hash:
+                    app.logger.info(f"Local file {file_name} is unchanged, skipping write.")
+                    return {"id": existing[0]['id'], "status": "unchanged", "contentHash": file_hash}
+
+                now = time.time()
+                if existing and num_backups_to_keep > 0:
+                    base_file_name, file_extension = os.path.splitext(file_name)
+                    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+                    backup_name = f"{base_file_name}_backup_{timestamp}{file_extension}"
+                    os.replace(path, self._path(folder_id, backup_name))
+                    conn.execute("UPDATE files SET name = ?, is_backup = 1, updated_at = ? WHERE folder_id = ? AND name = ?",
+                                 (backup_name, now, folder_id, file_name))
+
+                size = self._atomic_write(path, data_io)
+                conn.execute("INSERT OR REPLACE INTO files (folder_id, name, content_hash, size, is_backup, updated_at) VALUES (?, ?, ?, ?, 0, ?)",
+                             (folder_id, file_name, file_hash, size, now))
+                conn.commit()
+
+            if num_backups_to_keep > 0:
+                base_file_name, _ = os.path.splitext(file_name)
+                backups = conn.execute("SELECT name FROM files WHERE folder_id = ? AND is_backup = 1 AND name LIKE ? ORDER BY updated_at DESC",
+                                       (folder_id, f"{base_file_name}_backup_%")).fetchall()
+                old_backups = [{'id': self._file_id(folder_id, name), 'name': name} for (name,) in backups[num_backups_to_keep:]]
+                if old_backups:
+                    errors = self.delete_files_sync(old_backups, folder_id)
+                    if errors:
+                        return {"id": self._file_id(folder_id, file_name), "contentHash": file_hash, "batch_errors": errors}
+            return {"id": self._file_id(folder_id, file_name), "contentHash": file_hash}
+        except Exception as e:
+            app.logger.error(f"Error writing local file {file_name}: {e}")
+            return {"error": f"Error writing local file {file_name}: {e}"}
+
+    def read_sync(self, file_name, folder_id, decode=decode_payload):
+        try:
+            path = self._path(folder_id, file_name)
+            with open(path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return {"data": decode(b'')}
+                # Ánh xạ tệp vào bộ nhớ thay vì đọc vào buffer trung gian
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return {"data": decode(mapped)}
+        except FileNotFoundError:
+            app.logger.warning(f"File '{file_name}' not found in local storage.")
+            return {"error": f"File '{file_name}' not found in local storage."}
+        except Exception as e:
+            app.logger.error(f"Error reading local file '{file_name}': {e}")
+            return {"error": f"Error reading local file '{file_name}': {e}"}
+
+    def mirror_state_sync(self, file_name, folder_id):
+        """
+        (mirrored_hash, mirror_id) của lần đồng bộ sang mirror thành công gần nhất, (None, None) nếu chưa có.
+        """
+        row = self._connect().execute("SELECT mirrored_hash, mirror_id FROM files WHERE folder_id = ? AND name = ?",
+                                      (folder_id, file_name)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def set_mirrored_sync(self, file_name, folder_id, file_hash, mirror_id):
+        # Chỉ ghi nhận khi tệp chưa bị ghi đè bằng nội dung khác trong lúc đồng bộ
+        conn = self._connect()
+        with self._write_lock:
+            conn.execute("UPDATE files SET mirrored_hash = ?, mirror_id = ? WHERE folder_id = ? AND name = ? AND content_hash = ?",
+                         (file_hash, mirror_id, folder_id, file_name, file_hash))
+            conn.commit()
+
+    def upload_object_sync(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        try:
+            data_io, _ = spool_encoded(obj, codec=codec, compact=compact)
+        except Exception as e:
+            app.logger.error(f"Error serializing {file_name}: {e}")
+            return {"error": f"Error serializing {file_name}: {e}"}
+        try:
+            return self.write_sync(data_io, file_name, folder_id, num_backups_to_keep)
+        finally:
+            data_io.close()
+
+    async def preload_folder(self, folder_id):
+        return {"info": "Local storage does not need preloading."}
+
+    async def list_folder(self, folder_id):
+        return await run_blocking(self.list_folder_sync, folder_id)
+
+    async def find_files(self, file_name, folder_id):
+        return await run_blocking(self.find_files_sync, file_name, folder_id)
+
+    async def delete_files(self, files, folder_id):
+        return await run_blocking(self.delete_files_sync, files, folder_id)
+
+    async def upload_string(self, data_str, file_name, folder_id, num_backups_to_keep=1):
+        return await run_blocking(self.write_sync, io.BytesIO(data_str.encode('utf-8')), file_name, folder_id, num_backups_to_keep)
+
+    async def upload_object(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        return await run_blocking(self.upload_object_sync, obj, file_name, folder_id, num_backups_to_keep, compact, codec)
+
+    async def get_text(self, file_name, folder_id):
+        return await run_blocking(self.read_sync, file_name, folder_id, decode_text)
+
+    async def get_object(self, file_name, folder_id):
+        return await run_blocking(self.read_sync, file_name, folder_id)
+
+    async def mirror_state(self, file_name, folder_id):
+        return await run_blocking(self.mirror_state_sync, file_name, folder_id)
+
+    async def set_mirrored(self, file_name, folder_id, file_hash, mirror_id):
+        return await run_blocking(self.set_mirrored_sync, file_name, folder_id, file_hash, mirror_id)
+
+class WriteThroughStorage(StorageBackend):
+    """
+    Ghi vào primary (local) rồi đồng bộ sang mirror (Drive) ở nền; đọc từ primary, nếu chưa có
+    thì đọc từ mirror và lưu lại vào primary. Id trả về khi ghi là id của primary.
+    Primary ghi nhận hash của lần đồng bộ thành công gần nhất cho từng tệp, nên tệp có lần đồng bộ
+    thất bại được đồng bộ lại ở lần ghi sau kể cả khi nội dung trên primary không đổi.
+    """
+    # Các lần đồng bộ đang chạy, dùng chung cho mọi instance trên event loop nền
+    _pending = set()
+    # (folder_id, file_name) -> (hash, task) của lần đồng bộ tệp gần nhất, để các lần ghi cùng tệp sang mirror chạy tuần tự
+    _pending_files = {}
+
+    def __init__(self, primary, mirror):
+        self.primary = primary
+        self.mirror = mirror
+
+    def _mirror_in_background(self, description, coro):
+        async def run():
+            try:
+                result = await coro
+                if isinstance(result, dict) and "error" in result:
+                    app.logger.error(f"Mirror write of {description} failed: {result['error']}")
+                return result
+            except Exception as e:
+                app.logger.error(f"Mirror write of {description} failed: {e}")
+                return {"error": str(e)}
+        task = asyncio.ensure_future(run())
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return task
+
+    async def _mirror_file(self, file_name, folder_id, result, upload):
+        """
+        Đồng bộ tệp vừa ghi vào primary sang mirror nếu hash đã đồng bộ khác hash hiện tại.
+        upload là hàm không đối số tạo coroutine ghi tệp lên mirror.
+        """
+        file_hash = result.get("contentHash")
+        key = (folder_id, file_name)
+        pending = self._pending_files.get(key)
+        if pending is not None and not pending[1].done() and pending[0] == file_hash:
+            return
+        mirrored_hash, _ = await self.primary.mirror_state(file_name, folder_id)
+        if file_hash is not None and mirrored_hash == file_hash:
+            return
+        previous = pending[1] if pending is not None else None
+
+        async def mirror():
+            if previous is not None:
+                await asyncio.wait([previous])
+            mirror_res = await upload()
+            if "error" not in mirror_res:
+                await self.primary.set_mirrored(file_name, folder_id, file_hash, mirror_res.get("id"))
+            return mirror_res
+
+        def forget(done):
+            if key in self._pending_files and self._pending_files[key][1] is done:
+                del self._pending_files[key]
+
+        task = self._mirror_in_background(file_name, mirror())
+        self._pending_files[key] = (file_hash, task)
+        task.add_done_callback(forget)
+
+    @classmethod
+    async def flush(cls):
+        """
+        Chờ các lần đồng bộ sang mirror đang chạy hoàn tất.
+        """
+        if cls._pending:
+            await asyncio.gather(*list(cls._pending), return_exceptions=True)
+
+    async def preload_folder(self, folder_id):
+        return await self.mirror.preload_folder(folder_id)
+
+    async def list_folder(self, folder_id):
+        primary_res, mirror_res = await asyncio.gather(self.primary.list_folder(folder_id), self.mirror.list_folder(folder_id))
+        if "error" in primary_res:
+            return primary_res
+        # Tệp chỉ có trên mirror (trước khi bật chế độ này) vẫn được coi là tồn tại
+        files = dict(mirror_res.get("data", {}))
+        files.update(primary_res["data"])
+        return {"data": files}
+
+    async def find_files(self, file_name, folder_id):
+        files = await self.primary.find_files(file_name, folder_id)
+        if files:
+            return files
+        return await self.mirror.find_files(file_name, folder_id)
+
+    async def delete_files(self, files, folder_id):
+        errors = await self.primary.delete_files(files, folder_id)
+        mirror_files = []
+        for file_name in {file['name'] for file in files}:
+            mirror_files.extend(await self.mirror.find_files(file_name, folder_id))
+        if mirror_files:
+            self._mirror_in_background(f"deletion of {len(mirror_files)} file(s)", self.mirror.delete_files(mirror_files, folder_id))
+        return errors
+
+    async def upload_string(self, data_str, file_name, folder_id, num_backups_to_keep=1):
+        result = await self.primary.upload_string(data_str, file_name, folder_id, num_backups_to_keep)
+        if "error" not in result:
+            await self._mirror_file(file_name, folder_id, result,
+                                    lambda: self.mirror.upload_string(data_str, file_name, folder_id, num_backups_to_keep))
+        return result
+
+    async def upload_object(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        result = await self.primary.upload_object(obj, file_name, folder_id, num_backups_to_keep, compact, codec)
+        if "error" not in result:
+            await self._mirror_file(file_name, folder_id, result,
+                                    lambda: self.mirror.upload_object(obj, file_name, folder_id, num_backups_to_keep, compact, codec))
+        return result
+
+    async def shared_file_id(self, file_name, folder_id, result):
+        # Người đọc dữ liệu trên Drive cần id trên mirror: chờ lần đồng bộ đang chạy của tệp
+        pending = self._pending_files.get((folder_id, file_name))
+        if pending is not None:
+            await asyncio.wait([pending[1]])
+        mirrored_hash, mirror_id = await self.primary.mirror_state(file_name, folder_id)
+        if mirror_id and mirrored_hash == result.get("contentHash"):
+            return mirror_id
+        mirror_files = await self.mirror.find_files(file_name, folder_id)
+        if mirror_files:
+            return mirror_files[0]['id']
+        app.logger.warning(f"{file_name} is not on the mirror yet, referencing the primary id.")
+        return result.get("id")
+
+    async def get_text(self, file_name, folder_id):
+        result = await self.primary.get_text(file_name, folder_id)
+        if "error" not in result:
+            return result
+        result = await self.mirror.get_text(file_name, folder_id)
+        if "error" not in result:
+            await self.primary.upload_string(result["data"], file_name, folder_id, num_backups_to_keep=0)
+        return result
+
+    async def get_object(self, file_name, folder_id):
+        result = await self.primary.get_object(file_name, folder_id)
+        if "error" not in result:
+            return result
+        result = await self.mirror.get_object(file_name, folder_id)
+        if "error" not in result:
+            await self.primary.upload_object(result["data"], file_name, folder_id, num_backups_to_keep=0)
+        return result
+
+_local_storage = None
+_local_storage_lock = threading.Lock()
+
+def get_local_storage():
+    global _local_storage
+    with _local_storage_lock:
+        if _local_storage is None:
+            _local_storage = LocalStorage(app.config['LOCAL_STORAGE_DIR'])
+    return _local_storage
+
+async def create_storage(credentials):
+    """
+    Tạo backend lưu trữ theo STORAGE_BACKEND: 'drive' (mặc định), 'local' hoặc 'write_through'
+    (local là nguồn chính, đồng bộ sang Drive ở nền).
+    """
+    backend = app.config['STORAGE_BACKEND']
+    if backend == 'local':
+        return get_local_storage()
+    from .drive_service import AsyncDriveService
+    drive_storage = await AsyncDriveService.create(credentials)
+    if backend == 'write_through':
+        return WriteThroughStorage(get_local_storage(), drive_storage)
+    if backend != 'drive':
+        app.logger.warning(f"Unknown STORAGE_BACKEND '{backend}', using Drive.")
+    return drive_storage
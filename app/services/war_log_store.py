@@ -0,0 +1,141 @@
+import os
+import asyncio
+from .. import app
+
+MANIFEST_VERSION = 1
+
+def _file_stem():
+    return os.path.splitext(app.config['WARLOG_FILE_NAME'])[0]
+
+def shard_key(war):
+    # Mỗi năm một shard, theo endTime dạng 'YYYYMMDDTHHMMSS.000Z'
+    return war.get('endTime', '')[:4] or 'unknown'
+
+def shard_file_name(key):
+    return f"{_file_stem()}_{key}.json"
+
+def manifest_file_name():
+    return f"{_file_stem()}_manifest.json"
+
+def merge_wars(wars, new_wars):
+    """
+    Gộp new_wars vào wars (khử trùng theo endTime, bản mới được ưu tiên), sắp xếp endTime giảm dần.
+    """
+    combined = {war.get('endTime', str(war)): war for war in wars}
+    for war in new_wars:
+        combined[war.get('endTime', str(war))] = war
+    return sorted(combined.values(), key=lambda war: war.get('endTime', ''), reverse=True)
+
+class ShardedWarLog:
+    """
+    Warlog của một clan lưu thành các shard theo năm ({stem}_{năm}.json) cùng một manifest nhỏ
+    ({stem}_manifest.json) mô tả các shard. Mỗi lần cập nhật chỉ đọc và ghi lại các shard có trận mới.
+    """
+    def __init__(self, storage, folder_id):
+        self.storage = storage
+        self.folder_id = folder_id
+        self.manifest = None
+        # Các shard đã đọc hoặc vừa ghi trong lần chạy này
+        self._shards = {}
+
+    async def load_manifest(self):
+        """
+        Trả về {"data": manifest} hoặc {"data": None} nếu chưa có manifest.
+        """
+        if not await self.storage.find_files(manifest_file_name(), self.folder_id):
+            return {"data": None}
+        manifest_res = await self.storage.get_object(manifest_file_name(), self.folder_id)
+        if "error" in manifest_res:
+            return manifest_res
+        self.manifest = manifest_res["data"]
+        return {"data": self.manifest}
+
+    @property
+    def newest(self):
+        return self.manifest.get('newest') if self.manifest else None
+
+    def _shard_names(self):
+        # Các shard theo thứ tự mới nhất trước
+        shards = (self.manifest or {}).get('shards', [])
+        return [shard['name'] for shard in sorted(shards, key=lambda shard: shard['key'], reverse=True)]
+
+    async def _read_shard(self, name):
+        if name not in self._shards:
+            shard_res = await self.storage.get_object(name, self.folder_id)
+            if "error" in shard_res:
+                raise RuntimeError(f"Error reading war log shard {name}: {shard_res['error']}")
+            self._shards[name] = shard_res["data"] or []
+        return self._shards[name]
+
+    async def append(self, new_wars, num_backups_to_keep=1):
+        """
+        Ghi các trận mới vào shard tương ứng (đọc lại shard hiện có nếu cần) rồi cập nhật manifest.
+        Manifest được ghi sau cùng nên một lần chạy lỗi giữa chừng chỉ khiến lần sau lấy lại các trận đó.
+        """
+        by_shard = {}
+        for war in new_wars:
+            by_shard.setdefault(shard_key(war), []).append(war)
+        known = {shard['key']: shard for shard in (self.manifest or {}).get('shards', [])}
+
+        async def write_shard(key, wars):
+            name = shard_file_name(key)
+            existing = await self._read_shard(name) if key in known else []
+            merged = merge_wars(existing, wars)
+            upload_res = await self.storage.upload_object(merged, name, self.folder_id, num_backups_to_keep=num_backups_to_keep)
+            if "error" in upload_res:
+                raise RuntimeError(f"Error writing war log shard {name}: {upload_res['error']}")
+            self._shards[name] = merged
+            return {"key": key, "name": name, "count": len(merged),
+                    "newest": merged[0].get('endTime') if merged else None,
+                    "oldest": merged[-1].get('endTime') if merged else None}
+
+        written = await asyncio.gather(*(write_shard(key, wars) for key, wars in by_shard.items()))
+        for shard in written:
+            known[shard['key']] = shard
+        shards = sorted(known.values(), key=lambda shard: shard['key'], reverse=True)
+        self.manifest = {
+            "version": MANIFEST_VERSION,
+            "newest": max((shard['newest'] for shard in shards if shard['newest']), default=None),
+            "total": sum(shard['count'] for shard in shards),
+            "shards": shards,
+        }
+        manifest_res = await self.storage.upload_object(self.manifest, manifest_file_name(), self.folder_id, num_backups_to_keep=0, codec='json')
+        if "error" in manifest_res:
+            raise RuntimeError(f"Error writing war log manifest: {manifest_res['error']}")
+        return dict(manifest_res, shards=[shard['name'] for shard in written])
+
+    async def iter_wars(self):
+        """
+        Duyệt các trận theo endTime giảm dần, chỉ đọc shard tiếp theo khi cần.
+        """
+        for name in self._shard_names():
+            for war in await self._read_shard(name):
+                yield war
+
+    async def read(self, limit=None):
+        """
+        Trả về danh sách trận mới nhất trước (tối đa limit trận nếu có), đọc các shard một cách lười biếng.
+        """
+        wars = []
+        if limit is not None and limit <= 0:
+            return wars
+        async for war in self.iter_wars():
+            wars.append(war)
+            if limit is not None and len(wars) >= limit:
+                break
+        return wars
+
+async def load_war_log_view(storage, folder_id):
+    """
+    Ghép toàn bộ warlog dạng shard thành danh sách đã sắp xếp (dùng cho cache đọc /data/warlog).
+    """
+    store = ShardedWarLog(storage, folder_id)
+    manifest_res = await store.load_manifest()
+    if "error" in manifest_res:
+        return manifest_res
+    if manifest_res["data"] is None:
+        return {"error": f"File '{manifest_file_name()}' not found."}
+    try:
+        return {"data": await store.read()}
+    except RuntimeError as e:
+        return {"error": str(e)}
@@ -0,0 +1,402 @@
+"""
+Máy chủ giả lập cho benchmark offline: CoC API (kèm đăng nhập developer), clashofstats và các
+endpoint Google Drive v3 mà DriveService sử dụng (list, get media, resumable upload, batch).
+
+Máy chủ chạy trong tiến trình riêng để số liệu bộ nhớ/CPU của pipeline không bị lẫn, và ghi lại
+số request, số byte vào/ra theo từng dịch vụ (đọc qua GET /_stats, đặt lại qua POST /_reset).
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import datetime
+import multiprocessing
+import urllib.parse
+import urllib.request
+from email.parser import BytesParser
+from aiohttp import web
+
+CLAN_TAG = '#2QCV8UJ8Q'
+
+DEFAULT_OPTIONS = {
+    "coc_latency_ms": 30,
+    "cos_latency_ms": 200,
+    "drive_latency_ms": 80,
+    # Tỉ lệ request CoC API bị trả về 429 và giá trị Retry-After (giây) đi kèm
+    "throttle_rate": 0.0,
+    "throttle_retry_after": 0.2,
+    "members": 50,
+    "profile_achievements": 80,
+    "warlog_page": 50,
+    "history": 2000,
+    "new_wars": 2,
+    "cwl_clans": 8,
+    "cwl_team": 15,
+    "seed": 1,
+    "drive_folder_id": "bench-root",
+    "warlog_file_name": "war_log.json",
+}
+
+def _service_of(path):
+    if path.startswith('/coc'):
+        return 'coc'
+    if path.startswith('/cos'):
+        return 'clashofstats'
+    if path.startswith('/google'):
+        return 'drive'
+    return None
+
+def _end_time(index):
+    # endTime theo định dạng của CoC API, index càng nhỏ càng mới
+    moment = datetime.datetime(2026, 9, 1) - datetime.timedelta(days=2 * index)
+    return moment.strftime('%Y%m%dT%H%M%S.000Z')
+
+class Payloads:
+    """
+    Dữ liệu giả có kích thước điều chỉnh được, sinh một lần và cố định theo seed.
+    """
+    def __init__(self, options):
+        rnd = random.Random(options['seed'])
+        self.options = options
+        self.members = [{
+            "tag": f"#P{index:05d}",
+            "name": f"player{index}",
+            "role": rnd.choice(['member', 'admin', 'coLeader']),
+            "expLevel": rnd.randint(100, 300),
+            "league": {"id": 29000022, "name": "Legend League"},
+            "trophies": rnd.randint(3000, 6000),
+            "builderBaseTrophies": rnd.randint(2000, 5000),
+            "donations": rnd.randint(0, 2000),
+            "donationsReceived": rnd.randint(0, 2000),
+            "townHallLevel": rnd.randint(10, 16),
+        } for index in range(options['members'])]
+        self.clan = {
+            "tag": CLAN_TAG,
+            "name": "Bench Clan",
+            "clanLevel": 25,
+            "members": len(self.members),
+            "memberList": self.members,
+        }
+        self.profiles = {member['tag']: self._profile(member, rnd) for member in self.members}
+        total_wars = options['history'] + options['new_wars']
+        self.wars = [self._war(index, rnd) for index in range(total_wars)]
+        self.cwl_season = self._cwl_season(rnd)
+
+    def _profile(self, member, rnd):
+        profile = dict(member)
+        profile.update({
+            "warStars": rnd.randint(100, 2000),
+            "attackWins": rnd.randint(0, 300),
+            "defenseWins": rnd.randint(0, 50),
+            "clan": {"tag": CLAN_TAG, "name": "Bench Clan"},
+            "labels": [{"id": 57000000 + i, "name": f"label{i}"} for i in range(3)],
+            "achievements": [{"name": f"achievement{i}", "stars": 3, "value": rnd.randint(0, 10 ** 6),
+                              "target": 10 ** 6, "info": "x" * 40} for i in range(self.options['profile_achievements'])],
+            "troops": [{"name": f"troop{i}", "level": rnd.randint(1, 12), "maxLevel": 12, "village": "home"} for i in range(40)],
+            "heroes": [{"name": f"hero{i}", "level": rnd.randint(1, 95), "maxLevel": 95, "village": "home"} for i in range(5)],
+            "spells": [{"name": f"spell{i}", "level": rnd.randint(1, 11), "maxLevel": 11, "village": "home"} for i in range(12)],
+        })
+        return profile
+
+    def _war(self, index, rnd):
+        return {
+            "result": rnd.choice(['win', 'lose', 'tie']),
+            "endTime": _end_time(index),
+            "teamSize": 15,
+            "attacksPerMember": 2,
+            "battleModifier": "none",
+            "clan": {"tag": CLAN_TAG, "name": "Bench Clan", "clanLevel": 25, "attacks": rnd.randint(20, 30),
+                     "stars": rnd.randint(20, 45), "destructionPercentage": rnd.random() * 100, "expEarned": 300},
+            "opponent": {"tag": f"#O{index:05d}", "name": f"opponent{index}", "clanLevel": rnd.randint(5, 30),
+                         "stars": rnd.randint(20, 45), "destructionPercentage": rnd.random() * 100},
+        }
+
+    def _cwl_season(self, rnd):
+        team = self.options['cwl_team']
+        tags = [CLAN_TAG] + [f'#C{index}' for index in range(1, self.options['cwl_clans'])]
+        clans = [{"tag": tag, "name": tag, "clanLevel": 20, "badgeUrls": {"small": "badge"},
+                  "members": [{"tag": f"{tag}P{j}", "name": f"p{j}", "townHallLevel": rnd.randint(10, 16), "mapPosition": j}
+                              for j in range(team + 3)]} for tag in tags]
+        rounds = []
+        for _ in range(7):
+            order = tags[:]
+            rnd.shuffle(order)
+            wars = []
+            for clan_tag, opponent_tag in zip(order[::2], order[1::2]):
+                wars.append({"teamSize": team,
+                             "clan": self._cwl_side(clan_tag, opponent_tag, team, rnd),
+                             "opponent": self._cwl_side(opponent_tag, clan_tag, team, rnd)})
+            rounds.append({"wars": wars})
+        return {"state": "ended", "season": "bench", "leagueId": 48000010, "clans": clans, "rounds": rounds}
+
+    @staticmethod
+    def _cwl_side(tag, opponent_tag, team, rnd):
+        members = []
+        for j in range(team):
+            member = {"tag": f"{tag}P{j}", "mapPosition": j + 1}
+            if rnd.random() < 0.9:
+                member["attack"] = {"defenderTag": f"{opponent_tag}P{rnd.randint(0, team - 1)}",
+                                    "stars": rnd.randint(0, 3), "destructionPercentage": rnd.randint(0, 100)}
+            if rnd.random() < 0.8:
+                member["bestOpponentAttack"] = {"attackerTag": f"{opponent_tag}P{rnd.randint(0, team - 1)}",
+                                                "stars": rnd.randint(0, 3), "destructionPercentage": rnd.randint(0, 100)}
+            members.append(member)
+        return {"tag": tag, "stars": rnd.randint(10, 45), "destructionPercentage": rnd.random() * 100,
+                "attacks": team, "isWinning": rnd.random() < 0.5, "members": members}
+
+class FakeDrive:
+    """
+    Drive v3 trong bộ nhớ, đủ cho các lệnh gọi của DriveService.
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.files = {}
+        self.uploads = {}
+        self.counter = 0
+
+    def _new_id(self, prefix='file'):
+        self.counter += 1
+        return f"{prefix}{self.counter:06d}"
+
+    def _timestamp(self):
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def add_file(self, name, folder_id, content, app_properties=None, properties=None):
+        file_id = self._new_id()
+        now = self._timestamp()
+        self.files[file_id] = {"id": file_id, "name": name, "parents": [folder_id], "content": content,
+                               "appProperties": app_properties or {}, "properties": properties or {},
+                               "createdTime": now, "modifiedTime": now}
+        return file_id
+
+    def _apply_metadata(self, file, metadata):
+        if 'name' in metadata:
+            file['name'] = metadata['name']
+        file['appProperties'].update(metadata.get('appProperties') or {})
+        file['properties'].update(metadata.get('properties') or {})
+        file['modifiedTime'] = self._timestamp()
+
+    @staticmethod
+    def _json(status, body):
+        return status, {"Content-Type": "application/json"}, json.dumps(body).encode('utf-8')
+
+    def _list(self, query):
+        q = query.get('q', '')
+        name = re.search(r"(?:^|\s)name\s*=\s*'([^']*)'", q)
+        contains = re.search(r"name contains '([^']*)'", q)
+        parent = re.search(r"'([^']*)' in parents", q)
+        prop = re.search(r"properties has \{key='([^']*)' and value='([^']*)'\}", q)
+        matches = []
+        for file in self.files.values():
+            if name and file['name'] != name.group(1):
+                continue
+            if contains and contains.group(1) not in file['name']:
+                continue
+            if parent and parent.group(1) not in file['parents']:
+                continue
+            if prop and file['properties'].get(prop.group(1)) != prop.group(2):
+                continue
+            matches.append({key: file[key] for key in ('id', 'name', 'appProperties', 'createdTime', 'modifiedTime')})
+        page_size = int(query.get('pageSize', 100))
+        offset = int(query.get('pageToken') or 0)
+        body = {"files": matches[offset:offset + page_size]}
+        if offset + page_size < len(matches):
+            body["nextPageToken"] = str(offset + page_size)
+        return self._json(200, body)
+
+    def _start_upload(self, file_id, body):
+        upload_id = self._new_id('upload')
+        self.uploads[upload_id] = {"file_id": file_id, "metadata": json.loads(body or b'{}'), "content": bytearray()}
+        location = f"{self.base_url}upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+        return 200, {"Location": location}, b''
+
+    def _upload_chunk(self, upload_id, headers, body):
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            return self._json(404, {"error": {"code": 404, "message": "Upload session not found"}})
+        upload['content'] += body
+        total = headers.get('Content-Range', '').rsplit('/', 1)[-1]
+        if total.isdigit() and len(upload['content']) < int(total):
+            return 308, {"Range": f"bytes=0-{len(upload['content']) - 1}"}, b''
+        del self.uploads[upload_id]
+        metadata = upload['metadata']
+        if upload['file_id'] is None:
+            parents = metadata.get('parents') or ['root']
+            file_id = self.add_file(metadata.get('name'), parents[0], bytes(upload['content']),
+                                    metadata.get('appProperties'), metadata.get('properties'))
+        else:
+            file_id = upload['file_id']
+            file = self.files.get(file_id)
+            if file is None:
+                return self._json(404, {"error": {"code": 404, "message": "File not found"}})
+            file['content'] = bytes(upload['content'])
+            self._apply_metadata(file, metadata)
+        return self._json(200, {"id": file_id})
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Xử lý một request Drive (path tính từ gốc Google API), trả về (status, headers, body).
+        """
+        parts = path.strip('/').split('/')
+        if parts[:3] == ['batch', 'drive', 'v3']:
+            return self._batch(headers, body)
+        if parts[:4] == ['upload', 'drive', 'v3', 'files']:
+            if 'upload_id' in query:
+                return self._upload_chunk(query['upload_id'], headers, body)
+            return self._start_upload(parts[4] if len(parts) > 4 else None, body)
+        if parts[:3] != ['drive', 'v3', 'files']:
+            return self._json(404, {"error": {"code": 404, "message": f"Unknown path {path}"}})
+        if len(parts) == 3:
+            return self._list(query)
+        file = self.files.get(parts[3])
+        if file is None:
+            return self._json(404, {"error": {"code": 404, "message": "File not found"}})
+        if method == 'GET':
+            if query.get('alt') == 'media':
+                return 200, {"Content-Type": "application/octet-stream"}, file['content']
+            return self._json(200, {key: file[key] for key in ('id', 'name', 'appProperties')})
+        if method == 'DELETE':
+            del self.files[file['id']]
+            return 204, {}, b''
+        if method == 'PATCH':
+            self._apply_metadata(file, json.loads(body or b'{}'))
+            return self._json(200, {"id": file['id']})
+        return self._json(405, {"error": {"code": 405, "message": "Method not allowed"}})
+
+    def _batch(self, headers, body):
+        message = BytesParser().parsebytes(b"Content-Type: " + headers['Content-Type'].encode() + b"\r\n\r\n" + body)
+        boundary = f"batch_{self._new_id('')}"
+        chunks = []
+        for part in message.get_payload():
+            payload = part.get_payload(decode=True).replace(b'\r\n', b'\n')
+            head, _, inner_body = payload.partition(b'\n\n')
+            request_line, *header_lines = head.decode('utf-8').split('\n')
+            method, target = request_line.split(' ')[:2]
+            inner_headers = dict(line.split(': ', 1) for line in header_lines if ': ' in line)
+            parsed = urllib.parse.urlsplit(target)
+            status, response_headers, response_body = self.handle(method, parsed.path, dict(urllib.parse.parse_qsl(parsed.query)), inner_headers, inner_body)
+            content_id = part['Content-ID'].strip('<>')
+            response_headers = "".join(f"{key}: {value}\r\n" for key, value in response_headers.items())
+            chunks.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                          f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n{response_headers}\r\n".encode('utf-8') + response_body + b"\r\n")
+        chunks.append(f"--{boundary}--\r\n".encode('utf-8'))
+        return 200, {"Content-Type": f"multipart/mixed; boundary={boundary}"}, b"".join(chunks)
+
+class FakeServices:
+    def __init__(self, base_url, options):
+        self.options = options
+        self.payloads = Payloads(options)
+        self.drive = FakeDrive(base_url + 'google/')
+        self.rnd = random.Random(options['seed'])
+        self.reset_stats()
+        # war_log.json cũ trên Drive: toàn bộ lịch sử trừ các trận mới nhất
+        history = self.payloads.wars[options['new_wars']:]
+        self.drive.add_file(options['warlog_file_name'], options['drive_folder_id'], json.dumps(history).encode('utf-8'))
+
+    def reset_stats(self):
+        self.stats = {service: {"requests": 0, "bytes_in": 0, "bytes_out": 0, "throttled": 0, "status": {}}
+                      for service in ('coc', 'clashofstats', 'drive')}
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        service = _service_of(request.path)
+        if service is None:
+            return await handler(request)
+        body = await request.read()
+        stats = self.stats[service]
+        stats["requests"] += 1
+        stats["bytes_in"] += len(body)
+        latency = self.options['cos_latency_ms' if service == 'clashofstats' else f'{service}_latency_ms']
+        await asyncio.sleep(latency / 1000)
+        if service == 'coc' and self.rnd.random() < self.options['throttle_rate']:
+            stats["throttled"] += 1
+            response = web.json_response({"reason": "requestThrottled"}, status=429,
+                                         headers={"Retry-After": str(self.options['throttle_retry_after'])})
+        else:
+            response = await handler(request)
+        stats["bytes_out"] += len(response.body or b'')
+        stats["status"][str(response.status)] = stats["status"].get(str(response.status), 0) + 1
+        return response
+
+    async def coc_login(self, request):
+        return web.json_response({"temporaryAPIToken": "bench-token", "status": {"code": 0}})
+
+    async def coc_clan(self, request):
+        return web.json_response(self.payloads.clan)
+
+    async def coc_warlog(self, request):
+        # Không có limit: trang mặc định; có limit/after: phân trang với cursor là vị trí bắt đầu
+        if 'limit' not in request.query:
+            return web.json_response({"items": self.payloads.wars[:self.options['warlog_page']], "paging": {"cursors": {}}})
+        limit = int(request.query['limit'])
+        start = int(request.query.get('after', 0))
+        page = self.payloads.wars[start:start + limit]
+        cursors = {"after": str(start + limit)} if start + limit < len(self.payloads.wars) else {}
+        return web.json_response({"items": page, "paging": {"cursors": cursors}})
+
+    async def coc_player(self, request):
+        profile = self.payloads.profiles.get(request.match_info['tag'])
+        if profile is None:
+            return web.json_response({"reason": "notFound"}, status=404)
+        etag = '"' + hashlib.sha1(profile['tag'].encode('utf-8')).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.json_response(profile, headers={"ETag": etag})
+
+    async def cos_season(self, request):
+        return web.json_response(dict(self.payloads.cwl_season, season=request.match_info['season']))
+
+    async def google(self, request):
+        path = request.path[len('/google'):]
+        status, headers, body = self.drive.handle(request.method, path, dict(request.query), request.headers, await request.read())
+        return web.Response(status=status, headers=headers, body=body)
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    async def post_reset(self, request):
+        self.reset_stats()
+        return web.json_response({"ok": True})
+
+    def make_app(self):
+        application = web.Application(middlewares=[self.middleware], client_max_size=1024 ** 3)
+        application.router.add_post('/coc-dev/login', self.coc_login)
+        application.router.add_get('/coc/clans/{tag}/warlog', self.coc_warlog)
+        application.router.add_get('/coc/clans/{tag}', self.coc_clan)
+        application.router.add_get('/coc/players/{tag}', self.coc_player)
+        application.router.add_get('/cos/clans/{clan}/cwl/seasons/{season}', self.cos_season)
+        application.router.add_route('*', '/google/{path:.*}', self.google)
+        application.router.add_get('/_stats', self.get_stats)
+        application.router.add_post('/_reset', self.post_reset)
+        return application
+
+def _serve(port, options):
+    base_url = f"http://127.0.0.1:{port}/"
+    services = FakeServices(base_url, options)
+    web.run_app(services.make_app(), host='127.0.0.1', port=port, print=None, access_log=None)
+
+def start_fake_services(port, **options):
+    """
+    Khởi động máy chủ giả lập trong tiến trình con và chờ tới khi sẵn sàng.
+    """
+    merged = dict(DEFAULT_OPTIONS, **options)
+    process = multiprocessing.get_context('spawn').Process(target=_serve, args=(port, merged), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/_stats", timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"Fake services did not start on port {port}.")
+
+def get_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stats", timeout=5) as response:
+        return json.loads(response.read())
+
+def reset_stats(port):
+    urllib.request.urlopen(urllib.request.Request(f"http://127.0.0.1:{port}/_reset", method='POST'), timeout=5).read()
@@ -0,0 +1,143 @@
+"""
+Benchmark offline cho các pipeline cron, dùng máy chủ giả lập trong benchmarks/fake_services.py.
+
+    python -m benchmarks.run [--clans 3] [--members 50] [--history 2000] [--coc-latency-ms 30] [--throttle-rate 0.05] [--json]
+
+Mỗi giai đoạn (clan_info lần đầu/lần sau, war_log, war_log khi không có trận mới, current_war_league) được đo thời gian thực,
+thời gian CPU, bộ nhớ đỉnh (tracemalloc, chỉ tính tiến trình ứng dụng) và số request/byte theo từng dịch vụ.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+from .fake_services import CLAN_TAG, DEFAULT_OPTIONS, start_fake_services, get_stats, reset_stats
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the cron pipelines.")
+    parser.add_argument('--port', type=int, default=18765)
+    parser.add_argument('--repeat', type=int, default=1, help="Number of times to run each stage after the first clan_info run.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON.")
+    parser.add_argument('--clans', type=int, default=1, help="Number of clans processed by each pipeline run.")
+    parser.add_argument('--warlog-layout', choices=('single', 'sharded'), default='single', help="War log storage layout (WARLOG_LAYOUT).")
+    for key, value in DEFAULT_OPTIONS.items():
+        if key in ('drive_folder_id', 'warlog_file_name'):
+            continue
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    return parser.parse_args(argv)
+
+def clan_config(count):
+    # Clan đầu tiên dùng các thư mục chung, các clan còn lại (#C1, #C2... cũng có trong dữ liệu CWL giả) có thư mục riêng
+    clans = [{"tag": CLAN_TAG}]
+    for index in range(1, count):
+        clans.append({"tag": f"#C{index}", "folder_id": f"bench-c{index}", "wl_folder_id": f"bench-c{index}-wl", "wl_rp_folder_id": f"bench-c{index}-wl-rp"})
+    return json.dumps(clans)
+
+def configure_environment(port, options, clans=1, warlog_layout='single'):
+    # Phải được gọi trước khi import app: cấu hình được đọc khi khởi tạo ứng dụng
+    base_url = f"http://127.0.0.1:{port}"
+    os.environ.update({
+        "COC_API_URL": f"{base_url}/coc",
+        "COC_DEVELOPER_URL": f"{base_url}/coc-dev",
+        "CLASHOFSTATS_API_URL": f"{base_url}/cos",
+        "GOOGLE_API_URL": f"{base_url}/google/",
+        "COC_EMAIL": "bench@example.com",
+        "COC_PASSWORD": "bench",
+        "DRIVE_FOLDER_ID": options['drive_folder_id'],
+        "WL_DRIVE_FOLDER_ID": "bench-wl",
+        "WL_RP_DRIVE_FOLDER_ID": "bench-wl-rp",
+        "WARLOG_FILE_NAME": options['warlog_file_name'],
+        "CLAN_INFO_FILE_NAME": "clan_info.json",
+        # Cache riêng cho mỗi lần chạy để lần clan_info đầu tiên luôn là "cold"
+        "CACHE_DIR": tempfile.mkdtemp(prefix='mkclan-bench-cache-'),
+        "STATE_DIR": tempfile.mkdtemp(prefix='mkclan-bench-state-'),
+        "CLANS": clan_config(clans),
+        "WARLOG_LAYOUT": warlog_layout,
+    })
+
+def run_stage(name, func, port):
+    reset_stats(port)
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    result = func()
+    wall = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    _, peak = tracemalloc.get_traced_memory()
+    if not isinstance(result, dict):
+        result = {}
+    status = "error" if "error" in result else result.get("status", "ok")
+    return {
+        "stage": name,
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "peak_mb": round(peak / 1024 / 1024, 2),
+        "status": status,
+        "error": result.get("error"),
+        "services": get_stats(port),
+    }
+
+def print_table(results):
+    header = f"{'stage':<24}{'status':<11}{'wall s':>8}{'cpu s':>8}{'peak MB':>9}  {'service':<13}{'reqs':>6}{'429':>5}{'KB in':>10}{'KB out':>10}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        first = True
+        for service, stats in result["services"].items():
+            if not stats["requests"] and not first:
+                continue
+            prefix = f"{result['stage']:<24}{result['status']:<11}{result['wall_s']:>8.3f}{result['cpu_s']:>8.3f}{result['peak_mb']:>9.2f}" if first else ' ' * 60
+            print(f"{prefix}  {service:<13}{stats['requests']:>6}{stats['throttled']:>5}{stats['bytes_in'] / 1024:>10.1f}{stats['bytes_out'] / 1024:>10.1f}")
+            first = False
+        if result["error"]:
+            print(f"{'':<24}error: {result['error']}")
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = dict(DEFAULT_OPTIONS, **{key: getattr(args, key) for key in DEFAULT_OPTIONS if hasattr(args, key)})
+    configure_environment(args.port, options, args.clans, args.warlog_layout)
+    server = start_fake_services(args.port, **options)
+    try:
+        from google.oauth2.credentials import Credentials
+        from app.routes import process_data_and_upload
+        from app.services.api_service import process_wldata_and_upload
+        from app.services.clans import get_clans, run_for_clans
+        from app.services.drive_service import AsyncDriveService
+        from app.services.http_client import async_to_sync
+
+        credentials = Credentials(token='bench-token', refresh_token='bench-refresh', client_id='bench',
+                                  client_secret='bench', token_uri=f"http://127.0.0.1:{args.port}/google/token")
+
+        async def current_war_league():
+            storage = await AsyncDriveService.create(credentials)
+            return await run_for_clans(get_clans(), lambda clan: process_wldata_and_upload(storage, clan))
+
+        run_pipeline = async_to_sync(process_data_and_upload)
+        stages = [("clan_info (cold)", lambda: run_pipeline('clan_info', credentials))]
+        for _ in range(args.repeat):
+            stages += [
+                ("clan_info", lambda: run_pipeline('clan_info', credentials)),
+                ("war_log", lambda: run_pipeline('war_log', credentials)),
+                ("war_log (no new war)", lambda: run_pipeline('war_log', credentials)),
+            ]
+        stages.append(("current_war_league", async_to_sync(current_war_league)))
+
+        tracemalloc.start()
+        results = [run_stage(name, func, args.port) for name, func in stages]
+        tracemalloc.stop()
+    finally:
+        server.terminate()
+        server.join(timeout=5)
+
+    if args.json:
+        json.dump({"options": options, "results": results}, sys.stdout, indent=2)
+        print()
+    else:
+        print_table(results)
+    return 1 if any(result["status"] == "error" for result in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
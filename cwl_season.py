@@ -0,0 +1,291 @@
+"""
+Dựng các tệp của một mùa CWL từ dữ liệu clashofstats. Module thuần, nằm ngoài package app để
+process con của backfill (spawn) import được mà không khởi tạo Flask app, cache và log của app.log.
+"""
+import json
+import logging
+
+# Trong worker web, app/__init__.py gắn handler app.log vào logger này; trong process con chỉ ghi ra stderr
+logger = logging.getLogger(__name__)
+
+class MemberRound:
+    """
+    Kết quả tấn công/phòng thủ của một thành viên trong một vòng đấu.
+    """
+    __slots__ = ('tag', 'mapPosition', 'has_attack', 'atkTag', 'atkStars', 'atkDesPercent',
+                 'has_defense', 'defTag', 'defStars', 'defDesPercent')
+
+    def __init__(self, member):
+        self.tag = member.get('tag')
+        self.mapPosition = member.get('mapPosition')
+        attack = member.get('attack')
+        self.has_attack = attack is not None
+        if self.has_attack:
+            self.atkTag = attack.get('defenderTag')
+            self.atkStars = attack.get('stars')
+            self.atkDesPercent = attack.get('destructionPercentage')
+        defense = member.get('bestOpponentAttack')
+        self.has_defense = defense is not None
+        if self.has_defense:
+            self.defTag = defense.get('attackerTag')
+            self.defStars = defense.get('stars')
+            self.defDesPercent = defense.get('destructionPercentage')
+
+    def to_dict(self):
+        result = {'tag': self.tag, 'mapPosition': self.mapPosition}
+        if self.has_attack:
+            result['atkTag'] = self.atkTag
+            result['atkStars'] = self.atkStars
+            result['atkDesPercent'] = self.atkDesPercent
+        if self.has_defense:
+            result['defTag'] = self.defTag
+            result['defStars'] = self.defStars
+            result['defDesPercent'] = self.defDesPercent
+        return result
+
+class ClanRound:
+    """
+    Kết quả của một clan trong một trận của vòng đấu, nhìn từ phía clan đó.
+    """
+    __slots__ = ('tag', 'stars', 'desPercent', 'attacks', 'isWinning', 'opponentTag',
+                 'opponentStars', 'opponentDesPercent', 'opponentAttacks', 'teamSize', 'side', 'members')
+
+    def __init__(self, side, opponent, team_size):
+        self.tag = side.get('tag')
+        self.stars = side.get('stars')
+        self.desPercent = side.get('destructionPercentage')
+        self.attacks = side.get('attacks')
+        self.isWinning = side.get('isWinning')
+        self.opponentTag = opponent.get('tag')
+        self.opponentStars = opponent.get('stars')
+        self.opponentDesPercent = opponent.get('destructionPercentage')
+        self.opponentAttacks = opponent.get('attacks')
+        self.teamSize = team_size
+        # Chỉ giữ tham chiếu tới dữ liệu gốc; danh sách thành viên chỉ được dựng cho clan cần theo dõi
+        self.side = side
+        self.members = None
+
+    def to_round_dict(self):
+        return {
+            "stars": self.stars,
+            "desPercent": self.desPercent,
+            "attacks": self.attacks,
+            "isWinning": self.isWinning,
+            "opponentStars": self.opponentStars,
+            "opponentDesPercent": self.opponentDesPercent,
+            "opponentAttacks": self.opponentAttacks,
+        }
+
+    def to_dict(self):
+        return {
+            "tag": self.tag,
+            "stars": self.stars,
+            "desPercent": self.desPercent,
+            "attacks": self.attacks,
+            "isWinning": self.isWinning,
+            "opponentTag": self.opponentTag,
+            "opponentStars": self.opponentStars,
+            "opponentDesPercent": self.opponentDesPercent,
+            "opponentAttacks": self.opponentAttacks,
+            "teamSize": self.teamSize,
+            "members": [member.to_dict() for member in self.members or []],
+        }
+
+class PlayerStats:
+    __slots__ = ('atkStars', 'atkDesPercent', 'attacks', 'defStars', 'defDesPercent', 'defense', 'rounds')
+
+    def __init__(self):
+        self.atkStars = 0
+        self.atkDesPercent = 0
+        self.attacks = 0
+        self.defStars = 0
+        self.defDesPercent = 0
+        self.defense = 0
+        self.rounds = 0
+
+    def to_dict(self, tag):
+        return {
+            "tag": tag,
+            "atkStars": self.atkStars,
+            "atkDesPercent": self.atkDesPercent,
+            "attacks": self.attacks,
+            "defStars": self.defStars,
+            "defDesPercent": self.defDesPercent,
+            "defense": self.defense,
+            "rounds": self.rounds,
+        }
+
+class ClanTotals:
+    __slots__ = ('totalStars', 'atkStars', 'atkDesPercent', 'attacks', 'defStars', 'defDesPercent', 'defense')
+
+    def __init__(self):
+        self.totalStars = 0
+        self.atkStars = 0
+        self.atkDesPercent = 0
+        self.attacks = 0
+        self.defStars = 0
+        self.defDesPercent = 0
+        self.defense = 0
+
+    def add_round(self, clan_round):
+        self.atkStars += clan_round.stars or 0
+        self.atkDesPercent += clan_round.desPercent or 0
+        self.attacks += clan_round.attacks or 0
+        self.defStars += clan_round.opponentStars or 0
+        self.defDesPercent += clan_round.opponentDesPercent or 0
+        self.defense += clan_round.opponentAttacks or 0
+        self.totalStars += clan_round.stars or 0
+        if clan_round.isWinning:
+            self.totalStars += 10
+
+    def to_dict(self):
+        return {
+            "totalStars": self.totalStars,
+            "atkStars": self.atkStars,
+            "atkDesPercent": self.atkDesPercent,
+            "attacks": self.attacks,
+            "defStars": self.defStars,
+            "defDesPercent": self.defDesPercent,
+            "defense": self.defense,
+        }
+
+class CwlSeason:
+    """
+    Kết quả trích xuất một mùa CWL cho clan_tag: thông tin clan, người chơi liên quan,
+    các vòng của clan, kết quả mọi clan theo vòng, thống kê từng người chơi và tổng của clan.
+    """
+    __slots__ = ('clans', 'players', 'clan_rounds', 'overall_rounds', 'player_stats', 'result')
+
+    def __init__(self):
+        self.clans = {}
+        self.players = {}
+        self.clan_rounds = []
+        self.overall_rounds = []
+        self.player_stats = {}
+        self.result = ClanTotals()
+
+def _handle_member_rounds(members, player_stats, join_war_player):
+    """
+    Dựng bản ghi của các thành viên trong một vòng và cộng dồn thống kê người chơi trong cùng lượt duyệt.
+    """
+    member_rounds = []
+    if not isinstance(members, list):
+        logger.warning("Warning: memberList is not a list.")
+        return member_rounds
+    for member in members:
+        try:
+            member_round = MemberRound(member)
+        except Exception as e:
+            logger.error(f"An unexpected error occurred while processing member data: {e} in member: {member}")
+            continue
+        member_rounds.append(member_round)
+        player_tag = member_round.tag
+        if not player_tag:
+            continue
+        join_war_player.add(player_tag)
+        stats = player_stats.get(player_tag)
+        if stats is None:
+            stats = player_stats[player_tag] = PlayerStats()
+        if member_round.has_attack:
+            join_war_player.add(member_round.atkTag)
+            stats.atkStars += member_round.atkStars or 0
+            stats.atkDesPercent += member_round.atkDesPercent or 0
+            stats.attacks += 1
+        if member_round.has_defense:
+            join_war_player.add(member_round.defTag)
+            stats.defStars += member_round.defStars or 0
+            stats.defDesPercent += member_round.defDesPercent or 0
+            stats.defense += 1
+        stats.rounds += 1
+    return member_rounds
+
+def extract_cwl_season(data, clan_tag):
+    """
+    Duyệt dữ liệu CWL của clashofstats một lần duy nhất, đồng thời tổng hợp kết quả theo vòng
+    và theo người chơi của clan_tag.
+    """
+    season = CwlSeason()
+    if not isinstance(data, dict) or not isinstance(data.get('clans'), list):
+        logger.warning("Warning: Invalid data structure for getting clans and players.")
+        return season
+
+    all_players = {}
+    for clan in data['clans']:
+        try:
+            if 'tag' in clan:
+                season.clans[clan['tag']] = {
+                    "name": clan.get('name'),
+                    "clanLevel": clan.get('clanLevel'),
+                    "badgeUrl" : clan.get('badgeUrls', {}).get('small'),
+                }
+            else:
+                logger.warning("Warning: Clan without a tag found.")
+            for member in clan.get('members', []):
+                if 'tag' in member:
+                    all_players[member['tag']] = {
+                        key: value for key, value in member.items() if key in ('name', 'townHallLevel')
+                    }
+                else:
+                    logger.warning(f"Warning: Member without a tag found in clan: {clan.get('tag')}")
+        except Exception as e:
+            logger.error(f"An unexpected error occurred while processing clan data: {e}")
+
+    rounds = data.get('rounds')
+    if not isinstance(rounds, list):
+        logger.warning("Warning: Invalid data structure for getting rounds.")
+        rounds = []
+
+    join_war_player = set()
+    for index, round_data in enumerate(rounds):
+        clans_in_round = {}
+        wars = round_data.get('wars', []) if isinstance(round_data, dict) else []
+        for war in wars:
+            try:
+                clan1_info = war.get('clan', {})
+                clan2_info = war.get('opponent', {})
+                if clan1_info.get('tag') and clan2_info.get('tag'):
+                    clan1 = ClanRound(clan1_info, clan2_info, war.get('teamSize'))
+                    clan2 = ClanRound(clan2_info, clan1_info, war.get('teamSize'))
+                    clans_in_round[clan1.tag] = clan1
+                    clans_in_round[clan2.tag] = clan2
+                else:
+                    logger.warning(f"Warning: War data missing clan or opponent tag in round: {index}")
+            except Exception as e:
+                logger.error(f"An unexpected error occurred while processing war data: {e} in war: {war}")
+
+        own_round = clans_in_round.get(clan_tag)
+        if own_round is None:
+            logger.warning(f"Cảnh báo: Phần tử tại chỉ mục {index} không phải là dictionary hợp lệ hoặc thiếu clan tag. Bỏ qua.")
+            continue
+
+        # Chỉ dựng danh sách thành viên (và thống kê người chơi) cho clan được theo dõi
+        own_round.members = _handle_member_rounds(own_round.side.get('members', []), season.player_stats, join_war_player)
+        season.clan_rounds.append(own_round)
+        season.result.add_round(own_round)
+        season.overall_rounds.append({tag: clan_round.to_round_dict() for tag, clan_round in clans_in_round.items()})
+
+    season.players = {tag: info for tag, info in all_players.items() if tag in join_war_player}
+    return season
+
+def build_wl_season(season, data, clan_tag):
+    """
+    Tạo nội dung ba tệp của một mùa CWL (rounds, players, tổng thể) từ dữ liệu clashofstats.
+    Hàm thuần, không gọi Drive, nên có thể chạy trong process pool.
+    """
+    cwl_season = extract_cwl_season(data, clan_tag)
+    mk_rounds = [clan_round.to_dict() for clan_round in cwl_season.clan_rounds]
+    mk_players_rank = [stats.to_dict(tag) for tag, stats in cwl_season.player_stats.items()]
+    mk_overall = {
+        "state": data.get('state'),
+        "season": data.get('season'),
+        "leagueId": data.get('leagueId'),
+        "clans": cwl_season.clans,
+        "players": cwl_season.players,
+        "rounds": cwl_season.overall_rounds,
+        "result": cwl_season.result.to_dict(),
+    }
+    return mk_rounds, mk_players_rank, mk_overall
+
+def build_wl_season_from_bytes(season, payload, clan_tag):
+    # Nhận nội dung thô để việc giải mã JSON cũng diễn ra trong process con
+    return build_wl_season(season, json.loads(payload), clan_tag)
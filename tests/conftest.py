@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+# Cấu hình phải có trước khi import app: các giá trị được đọc khi khởi tạo ứng dụng
+_test_dir = tempfile.mkdtemp(prefix='mkclan-tests-')
+os.environ.update({
+    "STORAGE_BACKEND": "local",
+    "LOCAL_STORAGE_DIR": os.path.join(_test_dir, 'storage'),
+    "CACHE_DIR": os.path.join(_test_dir, 'cache'),
+    "STATE_DIR": os.path.join(_test_dir, 'state'),
+    "PROFILE_DIR": os.path.join(_test_dir, 'profiles'),
+    "DRIVE_FOLDER_ID": "test-root",
+    "WL_DRIVE_FOLDER_ID": "test-wl",
+    "WL_RP_DRIVE_FOLDER_ID": "test-wl-rp",
+    "WARLOG_FILE_NAME": "war_log.json",
+    "CLAN_INFO_FILE_NAME": "clan_info.json",
+})
+
+import pytest
+from app import app as flask_app
+from app.services.http_client import async_to_sync
+
+@pytest.fixture
+def app():
+    return flask_app
+
+@pytest.fixture
+def run():
+    """
+    Chạy coroutine trên event loop nền dùng chung của ứng dụng (giống các view async).
+    """
+    def run_coro(coro_func, *args, **kwargs):
+        return async_to_sync(coro_func)(*args, **kwargs)
+    return run_coro
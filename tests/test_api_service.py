@@ -0,0 +1,195 @@
+import json
+import asyncio
+from app.services import api_service
+from app.services.clans import Clan
+from app.services.storage import get_local_storage
+from app.services.rate_limiter import AdaptiveRateLimiter, RequestBudget, backoff_delay
+
+class FakeResponse:
+    def __init__(self, status, body=None, headers=None):
+        self.status = status
+        self.reason = 'Fake'
+        self.headers = headers or {}
+        self.body = json.dumps(body).encode('utf-8')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+class FakeSession:
+    """
+    Session aiohttp giả trả lần lượt các response cho trước; response cuối được lặp lại.
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, params=None, headers=None, timeout=None):
+        response = self.responses[min(self.calls, len(self.responses) - 1)]
+        self.calls += 1
+        return response
+
+def make_limiter(rate=10):
+    return AdaptiveRateLimiter(rate=rate, min_rate=1, max_rate=30, burst=10)
+
+def record_sleeps(monkeypatch):
+    sleeps = []
+    real_sleep = asyncio.sleep
+    async def recording_sleep(delay, *args, **kwargs):
+        sleeps.append(delay)
+        await real_sleep(delay, *args, **kwargs)
+    monkeypatch.setattr(asyncio, 'sleep', recording_sleep)
+    return sleeps
+
+def test_retry_after_is_honored(run, monkeypatch):
+    sleeps = record_sleeps(monkeypatch)
+    session = FakeSession(FakeResponse(429, headers={'Retry-After': '0.05'}), FakeResponse(200, {"ok": True}))
+    limiter = make_limiter()
+    result = run(api_service.fetch_data, session, 'https://coc.test/clans', limiter=limiter)
+    assert result["data"] == {"ok": True}
+    assert session.calls == 2
+    assert 0.05 in sleeps
+    assert limiter.blocked_until > 0
+
+def test_throttle_halves_rate_and_success_recovers(run, monkeypatch):
+    monkeypatch.setattr(api_service, 'backoff_delay', lambda attempt: 0)
+    limiter = make_limiter(rate=8)
+    session = FakeSession(FakeResponse(429), FakeResponse(200, {"ok": True}))
+    run(api_service.fetch_data, session, 'https://coc.test/clans', limiter=limiter)
+    # Giảm một nửa khi bị giới hạn, rồi tăng cộng dồn 1/rate sau lần thành công
+    assert limiter.rate == 4 + 1 / 4
+
+def test_aimd_bounds():
+    limiter = make_limiter(rate=2)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    # Các lần bị giới hạn trong cùng một giây chỉ giảm một lần, và không xuống dưới min_rate
+    assert limiter.rate == 1
+    limiter.last_decrease = 0
+    limiter.on_throttle()
+    assert limiter.rate == 1
+    for _ in range(2000):
+        limiter.on_success()
+    assert limiter.rate == 30
+
+def test_budget_exhaustion_stops_requests(run, monkeypatch):
+    monkeypatch.setattr(api_service, 'backoff_delay', lambda attempt: 0)
+    session = FakeSession(FakeResponse(503))
+    budget = RequestBudget(2)
+    result = run(api_service.fetch_data, session, 'https://coc.test/clans', budget=budget, limiter=make_limiter())
+    assert "budget exhausted" in result["error"]
+    assert session.calls == 2
+    assert budget.remaining == 0
+
+def test_retries_give_up_after_max(run, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'COC_MAX_RETRIES', 2)
+    attempts = []
+    def no_delay(attempt):
+        attempts.append(attempt)
+        return 0
+    monkeypatch.setattr(api_service, 'backoff_delay', no_delay)
+    session = FakeSession(FakeResponse(502))
+    result = run(api_service.fetch_data, session, 'https://coc.test/clans', limiter=make_limiter())
+    assert result["error"].startswith("Failed to fetch data")
+    assert session.calls == 3
+    assert attempts == [0, 1]
+
+def test_backoff_delay_is_jittered_and_capped():
+    delays = [backoff_delay(attempt, base=0.5, cap=4.0) for attempt in range(10) for _ in range(20)]
+    assert all(0 <= delay <= 4.0 for delay in delays)
+    assert len(set(delays)) > 1
+    assert all(backoff_delay(0, base=0.5) <= 0.5 for _ in range(20))
+
+def test_backfill_progress_counts_failed_seasons(run, monkeypatch):
+    progress = []
+    async def fetch_error(session, url, **kwargs):
+        return {"error": f"404 for {url}"}
+    monkeypatch.setattr(api_service, 'fetch_data', fetch_error)
+    monkeypatch.setattr(api_service, 'report_progress', progress.append)
+
+    clan = Clan('#BACKFILL1', folder_id='bf-root', wl_folder_id='bf-wl', wl_rp_folder_id='bf-wl-rp')
+    result = run(api_service.process_wldata_backfill, get_local_storage(), [clan], '2024-01', '2024-03')
+    assert sorted(result["failed"]) == ['2024-01', '2024-02', '2024-03']
+    assert progress[-1] == "backfilled 3/3 CWL seasons"
+
+def war(end_time, stars=3):
+    return {"endTime": end_time, "result": "win", "clan": {"stars": stars}}
+
+def serve_war_log(monkeypatch, items):
+    # CoC API giả: phân trang theo limit/after như /clans/{clanTag}/warlog
+    requests_made = []
+    async def fetch_pages(session, url, params=None, **kwargs):
+        params = params or {}
+        requests_made.append(params)
+        start = int(params.get('after', 0))
+        end = start + params['limit'] if 'limit' in params else len(items)
+        paging = {"cursors": {"after": str(end)}} if end < len(items) else {"cursors": {}}
+        return {"data": {"items": items[start:end], "paging": paging}}
+    monkeypatch.setattr(api_service, 'fetch_data', fetch_pages)
+    return requests_made
+
+def test_war_log_cursor_remerges_corrected_wars(run, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'WARLOG_PAGE_SIZE', 2)
+    monkeypatch.setitem(app.config, 'WARLOG_CURSOR_OVERLAP', 2)
+    storage = get_local_storage()
+    clan = Clan('#WARLOG1', folder_id='wl1-root', wl_folder_id='wl1-wl', wl_rp_folder_id='wl1-wl-rp')
+    items = [war('20240103T000000.000Z'), war('20240102T000000.000Z'), war('20240101T000000.000Z')]
+    serve_war_log(monkeypatch, items)
+
+    first = run(api_service.fetch_war_log, 'token', clan, storage)
+    assert [w["endTime"] for w in first["data"]] == [w["endTime"] for w in items]
+    run(storage.upload_object, first["data"], app.config['WARLOG_FILE_NAME'], clan.folder_id)
+    run(api_service.save_war_log_cursor, clan, first["cursor"], first["data"])
+
+    requests_made = serve_war_log(monkeypatch, items)
+    assert run(api_service.fetch_war_log, 'token', clan, storage)["status"] == "unchanged"
+    assert len(requests_made) == 1
+
+    # API sửa kết quả của trận đã lưu ngay trước cursor
+    corrected = [war('20240103T000000.000Z'), war('20240102T000000.000Z', stars=2), war('20240101T000000.000Z')]
+    serve_war_log(monkeypatch, corrected)
+    result = run(api_service.fetch_war_log, 'token', clan, storage)
+    assert result["data"] == corrected
+
+def test_war_log_overlap_is_merged_with_new_wars(run, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'WARLOG_PAGE_SIZE', 2)
+    monkeypatch.setitem(app.config, 'WARLOG_CURSOR_OVERLAP', 1)
+    storage = get_local_storage()
+    clan = Clan('#WARLOG2', folder_id='wl2-root', wl_folder_id='wl2-wl', wl_rp_folder_id='wl2-wl-rp')
+    stored = [war('20240102T000000.000Z'), war('20240101T000000.000Z')]
+    run(storage.upload_object, stored, app.config['WARLOG_FILE_NAME'], clan.folder_id)
+    run(api_service.save_war_log_cursor, clan, stored[0]["endTime"], stored)
+
+    requests_made = serve_war_log(monkeypatch, [war('20240104T000000.000Z'), war('20240103T000000.000Z'),
+                                                war('20240102T000000.000Z', stars=1), war('20240101T000000.000Z')])
+    result = run(api_service.fetch_war_log, 'token', clan, storage)
+    assert [(w["endTime"][:8], w["clan"]["stars"]) for w in result["data"]] == [
+        ('20240104', 3), ('20240103', 3), ('20240102', 1), ('20240101', 3)]
+    # Trang thứ hai chứa trận overlap; trang cuối không cần tải
+    assert len(requests_made) == 2
+
+def test_unreadable_war_log_is_looked_up_once(run, app, monkeypatch):
+    storage = get_local_storage()
+    clan = Clan('#WARLOG3', folder_id='wl3-root', wl_folder_id='wl3-wl', wl_rp_folder_id='wl3-wl-rp')
+    run(storage.upload_string, '<html>', app.config['WARLOG_FILE_NAME'], clan.folder_id)
+    run(api_service.save_war_log_cursor, clan, '20240101T000000.000Z', [])
+    serve_war_log(monkeypatch, [war('20240102T000000.000Z'), war('20240101T000000.000Z')])
+
+    lookups = []
+    find_files = storage.find_files
+    async def counting_find_files(file_name, folder_id):
+        lookups.append(file_name)
+        return await find_files(file_name, folder_id)
+    monkeypatch.setattr(storage, 'find_files', counting_find_files)
+
+    result = run(api_service.fetch_war_log, 'token', clan, storage)
+    assert "error" in result
+    assert lookups == [app.config['WARLOG_FILE_NAME']]
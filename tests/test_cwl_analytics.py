@@ -0,0 +1,80 @@
+from app.services import cwl_analytics
+from app.services.cwl_analytics import SeasonColumns, compute_cwl_analytics, process_cwl_analytics
+from app.services.clans import Clan
+from app.services.storage import get_local_storage
+
+def test_no_seasons_gives_empty_result():
+    result = compute_cwl_analytics([], rolling_window=3)
+    assert result == {"seasons": [], "rollingWindow": 3, "players": [], "thDiff": [], "starDistribution": [0, 0, 0, 0]}
+
+def test_seasons_without_members_give_empty_result():
+    result = compute_cwl_analytics([SeasonColumns('2024-01', [{"members": []}], {})])
+    assert result["seasons"] == ['2024-01']
+    assert result["players"] == []
+
+def test_partial_season_data():
+    # Mùa 2024-01 thiếu tệp tổng thể (không biết town hall), người chơi #B chỉ phòng thủ
+    rounds = [{"members": [
+        {"tag": "#A", "atkTag": "#X", "atkStars": 3, "atkDesPercent": 100},
+        {"tag": "#B", "defTag": "#Y", "defStars": 2, "defDesPercent": 80},
+        {"tag": "#C"},
+    ]}]
+    players = {"#A": {"name": "a", "townHallLevel": 15}, "#X": {"townHallLevel": 14}}
+    result = compute_cwl_analytics([
+        SeasonColumns('2024-01', rounds, {}),
+        SeasonColumns('2024-02', rounds, players),
+    ], rolling_window=2)
+
+    by_tag = {player["tag"]: player for player in result["players"]}
+    assert set(by_tag) == {"#A", "#B", "#C"}
+    assert by_tag["#A"]["attacks"] == 2
+    assert by_tag["#A"]["avgStars"] == 3.0
+    assert by_tag["#A"]["rollingAvgStars"] == [3.0, 3.0]
+    assert by_tag["#A"]["townHallLevel"] == 15
+    assert by_tag["#B"]["avgStars"] is None
+    assert by_tag["#B"]["avgDefStars"] == 2.0
+    assert by_tag["#C"]["rounds"] == 2 and by_tag["#C"]["attacks"] == 0
+    # Chỉ mùa có town hall của cả hai bên được tính theo chênh lệch TH
+    assert result["thDiff"] == [{"thDiff": 1, "attacks": 1, "avgStars": 3.0, "threeStarRate": 1.0, "avgDesPercent": 100.0}]
+    assert result["starDistribution"] == [0, 0, 0, 2]
+
+def test_all_seasons_failing_to_load_is_an_error(run):
+    storage = get_local_storage()
+    clan = Clan('#ANALYTICS1', folder_id='an-root', wl_folder_id='an-wl', wl_rp_folder_id='an-wl-rp')
+    # Tệp vòng đấu hỏng: không giải mã được
+    run(storage.upload_string, '<html>', '2024-01_round.json', clan.wl_rp_folder_id, num_backups_to_keep=0)
+    result = run(process_cwl_analytics, storage, clan)
+    assert "No CWL season available" in result["error"]
+    assert run(storage.find_files, 'cwl_analytics.json', clan.wl_rp_folder_id) == []
+
+def test_analytics_are_uploaded(run):
+    storage = get_local_storage()
+    clan = Clan('#ANALYTICS2', folder_id='an2-root', wl_folder_id='an2-wl', wl_rp_folder_id='an2-wl-rp')
+    rounds = [{"members": [{"tag": "#A", "atkTag": "#X", "atkStars": 2, "atkDesPercent": 70}]}]
+    run(storage.upload_object, rounds, '2024-01_round.json', clan.wl_rp_folder_id, num_backups_to_keep=0)
+    assert "error" not in run(process_cwl_analytics, storage, clan)
+    analytics = run(storage.get_object, 'cwl_analytics.json', clan.wl_rp_folder_id)["data"]
+    assert analytics["seasons"] == ['2024-01']
+    assert analytics["players"][0]["atkStars"] == 2
+
+def test_season_cache_is_bounded(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'CWL_SEASON_CACHE_SIZE', 2)
+    monkeypatch.setattr(cwl_analytics, '_season_cache', type(cwl_analytics._season_cache)())
+    for season in ('2024-01', '2024-02', '2024-03'):
+        cwl_analytics._cache_season(('#T', season), ('id', season), SeasonColumns(season, [], {}))
+    assert list(cwl_analytics._season_cache) == [('#T', '2024-02'), ('#T', '2024-03')]
+    assert cwl_analytics._cached_season(('#T', '2024-03'), ('id', 'other-hash')) is None
+    assert cwl_analytics._cached_season(('#T', '2024-03'), ('id', '2024-03')).season == '2024-03'
+
+def test_null_season_files_are_skipped(run):
+    storage = get_local_storage()
+    clan = Clan('#ANALYTICS3', folder_id='an3-root', wl_folder_id='an3-wl', wl_rp_folder_id='an3-wl-rp')
+    rounds = [{"members": [{"tag": "#A", "atkTag": "#X", "atkStars": 1, "atkDesPercent": 50}]}]
+    # 2024-01: tệp vòng đấu rỗng (null); 2024-02: tệp tổng thể rỗng (null) nhưng vòng đấu hợp lệ
+    run(storage.upload_string, 'null', '2024-01_round.json', clan.wl_rp_folder_id, num_backups_to_keep=0)
+    run(storage.upload_object, rounds, '2024-02_round.json', clan.wl_rp_folder_id, num_backups_to_keep=0)
+    run(storage.upload_string, 'null', '2024-02.json', clan.wl_folder_id, num_backups_to_keep=0)
+    assert "error" not in run(process_cwl_analytics, storage, clan)
+    analytics = run(storage.get_object, 'cwl_analytics.json', clan.wl_rp_folder_id)["data"]
+    assert analytics["seasons"] == ['2024-02']
+    assert analytics["players"][0]["townHallLevel"] is None
@@ -0,0 +1,62 @@
+import os
+import sys
+import json
+import subprocess
+from cwl_season import build_wl_season
+from app.services import api_service
+from app.services.clans import Clan
+from app.services.storage import get_local_storage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEASON_DATA = {
+    "state": "ended", "season": "2024-01", "leagueId": 48000010,
+    "clans": [
+        {"tag": "#A", "name": "A", "clanLevel": 10, "members": [{"tag": "#P1", "name": "p1", "townHallLevel": 15, "trophies": 1}]},
+        {"tag": "#B", "name": "B", "members": [{"tag": "#Q1", "name": "q1", "townHallLevel": 14}]},
+    ],
+    "rounds": [{"wars": [{
+        "teamSize": 1,
+        "clan": {"tag": "#A", "stars": 3, "destructionPercentage": 100, "attacks": 1, "isWinning": True,
+                 "members": [{"tag": "#P1", "mapPosition": 1, "attack": {"defenderTag": "#Q1", "stars": 3, "destructionPercentage": 100}}]},
+        "opponent": {"tag": "#B", "stars": 0, "destructionPercentage": 10, "attacks": 1, "members": []},
+    }]}],
+}
+
+def test_builder_imports_without_the_app():
+    # Process con của backfill chỉ import module này: không được kéo theo Flask app và log app.log
+    output = subprocess.run([sys.executable, '-c', "import sys, cwl_season; print('app' in sys.modules, 'flask' in sys.modules)"],
+                            cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['False', 'False']
+
+def test_build_wl_season():
+    mk_rounds, mk_players_rank, mk_overall = build_wl_season('2024-01', SEASON_DATA, '#A')
+    assert mk_rounds[0]["members"] == [{"tag": "#P1", "mapPosition": 1, "atkTag": "#Q1", "atkStars": 3, "atkDesPercent": 100}]
+    assert mk_players_rank[0]["tag"] == "#P1" and mk_players_rank[0]["attacks"] == 1
+    assert mk_overall["players"] == {"#P1": {"name": "p1", "townHallLevel": 15}, "#Q1": {"name": "q1", "townHallLevel": 14}}
+    assert mk_overall["result"]["totalStars"] == 13
+
+def test_backfill_builds_seasons_in_child_processes(run, monkeypatch):
+    async def fetch_season(session, url, **kwargs):
+        return {"data": json.dumps(SEASON_DATA).encode('utf-8')}
+    monkeypatch.setattr(api_service, 'fetch_data', fetch_season)
+
+    storage = get_local_storage()
+    clan = Clan('#A', folder_id='cs-root', wl_folder_id='cs-wl', wl_rp_folder_id='cs-wl-rp')
+    result = run(api_service.process_wldata_backfill, storage, [clan], '2024-01', '2024-01', True)
+    assert result["uploaded"] == ['2024-01'], result
+    overall = run(storage.get_object, '2024-01.json', clan.wl_folder_id)["data"]
+    assert overall["urls"] == {"round": 'cs-wl-rp/2024-01_round.json', "player": 'cs-wl-rp/2024-01_player.json'}
+
+def test_process_wl_data_builds_off_the_loop(run, monkeypatch):
+    from app.services import data_processor
+    calls = []
+    async def recording_run_blocking(func, *args, **kwargs):
+        calls.append(func)
+        return func(*args, **kwargs)
+    monkeypatch.setattr(data_processor, 'run_blocking', recording_run_blocking)
+
+    clan = Clan('#A', folder_id='pw-root', wl_folder_id='pw-wl', wl_rp_folder_id='pw-wl-rp')
+    result = run(data_processor.process_wl_data, '2024-01', SEASON_DATA, get_local_storage(), clan)
+    assert "error" not in result
+    assert calls == [build_wl_season]
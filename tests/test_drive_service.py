@@ -0,0 +1,116 @@
+import io
+from google.oauth2.credentials import Credentials
+from app.services.drive_service import DriveService
+from app.services.serializer import content_hash
+
+def make_credentials(token='access-1', refresh_token='refresh-1'):
+    return Credentials(token=token, refresh_token=refresh_token, client_id='client', client_secret='secret',
+                       token_uri='https://oauth2.googleapis.com/token')
+
+def test_client_is_reused_for_the_same_credentials():
+    credentials = make_credentials(refresh_token='reuse')
+    assert DriveService.for_credentials(credentials) is DriveService.for_credentials(credentials)
+    # Cùng tài khoản và cùng access token (vd. đọc lại từ session) vẫn dùng lại client
+    assert DriveService.for_credentials(make_credentials(refresh_token='reuse')) is DriveService.for_credentials(credentials)
+
+def test_new_credentials_get_a_new_client():
+    old = DriveService.for_credentials(make_credentials(token='old', refresh_token='replace'))
+    new_credentials = make_credentials(token='new', refresh_token='replace')
+    new = DriveService.for_credentials(new_credentials)
+    assert new is not old
+    assert new.credentials is new_credentials
+
+def test_evict_drops_cached_client():
+    credentials = make_credentials(refresh_token='evict')
+    first = DriveService.for_credentials(credentials)
+    DriveService.evict(credentials.client_id, credentials.refresh_token)
+    assert DriveService.for_credentials(credentials) is not first
+
+class FakeRequest:
+    def __init__(self, calls, method, result, **kwargs):
+        self.methodId = f"drive.files.{method}"
+        self.uri = ''
+        self.calls = calls
+        self.method = method
+        self.kwargs = kwargs
+        self.result = result
+
+    def execute(self):
+        self.calls.append((self.method, self.kwargs))
+        return self.result
+
+class FakeBatch:
+    def __init__(self):
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append(request)
+
+    def execute(self):
+        for request in self.requests:
+            request.execute()
+
+class FakeFiles:
+    """
+    Tài nguyên files() giả của Drive API: list trả về tệp cho trước, mọi lệnh được ghi lại theo thứ tự.
+    """
+    def __init__(self, calls, stored):
+        self.calls = calls
+        self.stored = stored
+
+    def list(self, **kwargs):
+        return FakeRequest(self.calls, 'list', {"files": self.stored if 'is_backup' not in kwargs['q'] else []}, **kwargs)
+
+    def create(self, **kwargs):
+        return FakeRequest(self.calls, 'create', {"id": "created-id"}, **kwargs)
+
+    def update(self, **kwargs):
+        return FakeRequest(self.calls, 'update', {"id": kwargs['fileId']}, **kwargs)
+
+    def delete(self, **kwargs):
+        return FakeRequest(self.calls, 'delete', {}, **kwargs)
+
+class FakeDriveApi:
+    def __init__(self, stored):
+        self.calls = []
+        self._files = FakeFiles(self.calls, stored)
+
+    def files(self):
+        return self._files
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch()
+
+def drive_with_files(folder_id, stored):
+    drive = DriveService.__new__(DriveService)
+    drive.service = FakeDriveApi(stored)
+    drive.invalidate_file(folder_id, 'clan_info.json')
+    return drive
+
+def test_unchanged_hash_skips_upload_and_backup_rotation():
+    data = '{"tag": "#CLAN"}'
+    stored = [{'id': 'file-1', 'name': 'clan_info.json', 'appProperties': {'contentHash': content_hash(io.BytesIO(data.encode('utf-8')))}}]
+    drive = drive_with_files('hash-same', stored)
+    result = drive.upload_string_to_drive(data, 'clan_info.json', 'hash-same', num_backups_to_keep=1)
+    assert result == {"id": "file-1", "status": "unchanged"}
+    assert [method for method, _ in drive.service.calls] == ['list']
+
+def test_changed_hash_is_uploaded_with_backup():
+    stored = [{'id': 'file-1', 'name': 'clan_info.json', 'appProperties': {'contentHash': 'old-hash'}}]
+    drive = drive_with_files('hash-changed', stored)
+    result = drive.upload_string_to_drive('{"tag": "#NEW"}', 'clan_info.json', 'hash-changed', num_backups_to_keep=1)
+    assert result == {"id": "created-id"}
+    methods = [method for method, _ in drive.service.calls]
+    # Tệp cũ được đổi tên thành bản sao lưu rồi mới tạo tệp mới
+    assert methods == ['list', 'update', 'create', 'list']
+    assert drive.service.calls[1][1]['body']['properties'] == {'is_backup': 'true'}
+
+def test_changed_hash_overwrites_without_backup():
+    stored = [{'id': 'file-1', 'name': 'clan_info.json', 'appProperties': {'contentHash': 'old-hash'}}]
+    drive = drive_with_files('hash-overwrite', stored)
+    data = '{"tag": "#NEW"}'
+    result = drive.upload_string_to_drive(data, 'clan_info.json', 'hash-overwrite', num_backups_to_keep=0)
+    assert result == {"id": "file-1"}
+    assert [method for method, _ in drive.service.calls] == ['list', 'update']
+    # Lần ghi lại cùng nội dung được bỏ qua nhờ mã băm mới trong chỉ mục
+    assert drive.upload_string_to_drive(data, 'clan_info.json', 'hash-overwrite', num_backups_to_keep=0)["status"] == "unchanged"
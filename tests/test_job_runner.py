@@ -0,0 +1,123 @@
+import asyncio
+import pytest
+from app import cache
+from app.services.job_runner import JobRunner, report_progress, job_dedupe_key
+
+@pytest.fixture
+def runner():
+    return JobRunner(max_workers=2, max_history=10)
+
+async def set_event(event):
+    # asyncio.Event chỉ được đặt từ event loop của nó
+    event.set()
+
+def wait_for(run, runner, job_id, statuses=('succeeded', 'failed'), timeout=5):
+    async def poll():
+        for _ in range(int(timeout / 0.01)):
+            job = runner.get(job_id)
+            if job is not None and job["status"] in statuses:
+                return job
+            await asyncio.sleep(0.01)
+        raise AssertionError(f"Job {job_id} did not reach {statuses}")
+    return run(poll)
+
+def test_same_params_are_deduplicated(run, runner):
+    release = asyncio.Event()
+
+    async def pipeline(value):
+        await release.wait()
+        return {"value": value}
+
+    first = run(runner.submit, 'dedupe_same', pipeline, 1, params=('2024-01', '2024-03', False))
+    second = run(runner.submit, 'dedupe_same', pipeline, 1, params=('2024-01', '2024-03', False))
+    assert second["job_id"] == first["job_id"]
+
+    # Tham số khác là một job khác
+    other = run(runner.submit, 'dedupe_same', pipeline, 2, params=('2024-01', '2024-03', True))
+    assert other["job_id"] != first["job_id"]
+
+    run(set_event, release)
+    assert wait_for(run, runner, first["job_id"])["result"] == {"value": 1}
+    assert wait_for(run, runner, other["job_id"])["result"] == {"value": 2}
+
+def test_status_and_dedupe_are_shared_between_workers(run, runner):
+    release = asyncio.Event()
+
+    async def pipeline():
+        report_progress("halfway")
+        await release.wait()
+        return {"id": "x"}
+
+    job = run(runner.submit, 'dedupe_shared', pipeline)
+    # Một JobRunner khác mô phỏng worker gunicorn khác dùng chung cache
+    other_worker = JobRunner(max_workers=2, max_history=10)
+    running = wait_for(run, other_worker, job["job_id"], statuses=('running',))
+    assert running["type"] == 'dedupe_shared'
+    assert run(other_worker.submit, 'dedupe_shared', pipeline)["job_id"] == job["job_id"]
+
+    run(set_event, release)
+    finished = wait_for(run, other_worker, job["job_id"])
+    assert finished["status"] == 'succeeded'
+    assert finished["progress"] == "halfway"
+
+    # Job đã xong không còn chặn lần chạy tiếp theo
+    assert run(other_worker.submit, 'dedupe_shared', pipeline)["job_id"] != job["job_id"]
+    run(set_event, release)
+
+def test_failed_job_reports_error(run, runner):
+    async def pipeline():
+        raise RuntimeError("boom")
+
+    job = run(runner.submit, 'failing', pipeline)
+    finished = wait_for(run, runner, job["job_id"])
+    assert finished["status"] == 'failed'
+    assert finished["result"] == {"error": "boom"}
+
+def test_unknown_job(runner):
+    assert runner.get('missing') is None
+
+async def submit_concurrently(runners, job_type, pipeline):
+    return await asyncio.gather(*(runner.submit(job_type, pipeline) for runner in runners))
+
+def test_concurrent_submits_from_workers_start_one_job(run):
+    release = asyncio.Event()
+    started = []
+
+    async def pipeline():
+        started.append(1)
+        await release.wait()
+        return {}
+
+    workers = [JobRunner(max_workers=2, max_history=10) for _ in range(4)]
+    jobs = run(submit_concurrently, workers, 'dedupe_race', pipeline)
+    assert len({job["job_id"] for job in jobs}) == 1
+    run(set_event, release)
+    owner = next(worker for worker in workers if worker._jobs)
+    wait_for(run, owner, jobs[0]["job_id"])
+    assert started == [1]
+
+def test_stale_claim_is_taken_over(run, runner):
+    # Worker giữ khóa đã chết mà không ghi trạng thái
+    cache.set(job_dedupe_key('dedupe_stale', ()), 'dead-job')
+
+    async def pipeline():
+        return {"ok": True}
+
+    job = run(runner.submit, 'dedupe_stale', pipeline)
+    assert job["job_id"] != 'dead-job'
+    assert wait_for(run, runner, job["job_id"])["status"] == 'succeeded'
+
+def test_status_url_keeps_cron_key(app, monkeypatch):
+    from app import routes
+
+    async def pipeline(data_type, *args):
+        return {"status": "unchanged"}
+    monkeypatch.setattr(routes, 'run_cron_pipeline', pipeline)
+    monkeypatch.setitem(app.config, 'CRON_SECRET_KEY', 'secret')
+    client = app.test_client()
+
+    response = client.get('/api/update-cwl-analytics?key=secret')
+    assert response.status_code == 202
+    status_url = response.get_json()["status_url"]
+    assert 'key=secret' in status_url
+    assert client.get(status_url).status_code == 200
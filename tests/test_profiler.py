@@ -0,0 +1,35 @@
+import os
+import asyncio
+from app.services import profiler
+
+async def pipeline():
+    await asyncio.gather(asyncio.sleep(0.01), asyncio.sleep(0.01))
+    return {"status": "ok"}
+
+async def get_task_factory():
+    return asyncio.get_running_loop().get_task_factory()
+
+async def set_task_factory(factory):
+    asyncio.get_running_loop().set_task_factory(factory)
+
+def test_run_profiled_writes_profile(app, run):
+    result = run(profiler.run_profiled, 'test_pipeline', pipeline)
+    assert result["status"] == "ok"
+    base = os.path.join(app.config['PROFILE_DIR'], result["profile"])
+    assert os.path.exists(base + '.folded') and os.path.exists(base + '.trace.json')
+
+def test_task_factory_is_restored(run):
+    created = []
+    def custom_factory(loop, coro, **kwargs):
+        created.append(coro)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    original = run(get_task_factory)
+    run(set_task_factory, custom_factory)
+    try:
+        run(profiler.run_profiled, 'test_factory', pipeline)
+        # Task của pipeline vẫn đi qua factory có sẵn, và factory đó được trả lại sau phiên
+        assert created
+        assert run(get_task_factory) is custom_factory
+    finally:
+        run(set_task_factory, original)
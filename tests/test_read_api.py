@@ -0,0 +1,80 @@
+import gzip
+import json
+import pytest
+from app.services.read_cache import read_cache
+from app.services.storage import get_local_storage
+
+def war(day):
+    return {"endTime": f"2024{day // 28 + 1:02d}{day % 28 + 1:02d}T000000.000Z", "result": "win"}
+
+@pytest.fixture
+def client(app, run, monkeypatch):
+    # Mỗi test bắt đầu với cache đọc trống và dữ liệu riêng trong storage local
+    monkeypatch.setattr(read_cache, '_entries', {})
+    storage = get_local_storage()
+    clan_info = {"tag": "#2QCV8UJ8Q", "memberList": [{"tag": f"#P{i}", "name": f"player {i}"} for i in range(100)]}
+    wars = sorted((war(day) for day in range(120)), key=lambda w: w["endTime"], reverse=True)
+    run(storage.upload_object, clan_info, app.config['CLAN_INFO_FILE_NAME'], app.config['DRIVE_FOLDER_ID'], num_backups_to_keep=0)
+    run(storage.upload_object, wars, app.config['WARLOG_FILE_NAME'], app.config['DRIVE_FOLDER_ID'], num_backups_to_keep=0)
+    run(storage.upload_object, {"season": "2024-01"}, '2024-01.json', app.config['WL_DRIVE_FOLDER_ID'], num_backups_to_keep=0)
+    return app.test_client()
+
+def test_etag_revalidation(client):
+    response = client.get('/data/clan')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.get_json()["tag"] == "#2QCV8UJ8Q"
+
+    not_modified = client.get('/data/clan', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert not_modified.data == b''
+    assert not_modified.headers['ETag'] == etag
+    assert client.get('/data/clan', headers={'If-None-Match': '"other"'}).status_code == 200
+
+def test_gzip_negotiation(client):
+    plain = client.get('/data/clan')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.headers['Vary'] == 'Accept-Encoding'
+
+    compressed = client.get('/data/clan', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(compressed.data)) == plain.get_json()
+    assert compressed.headers['ETag'] == plain.headers['ETag']
+
+    # Nội dung nhỏ không được nén
+    small = client.get('/data/cwl/2024-01', headers={'Accept-Encoding': 'gzip'})
+    assert small.status_code == 200
+    assert 'Content-Encoding' not in small.headers
+
+def test_cwl_season_validation(client):
+    assert client.get('/data/cwl/2024-13').status_code == 400
+    assert client.get('/data/cwl/2023-12').status_code == 404
+    assert client.get('/data/cwl/2024-01').get_json() == {"season": "2024-01"}
+    assert client.get('/data/cwl/2024-01?clan=UNKNOWN').status_code == 404
+
+@pytest.mark.parametrize("query, offset, limit, count, next_offset", [
+    ('', 0, 50, 50, 50),
+    ('?offset=100', 100, 50, 20, None),
+    ('?offset=500', 500, 50, 0, None),
+    ('?offset=-5&limit=0', 0, 1, 1, 1),
+    ('?limit=1000', 0, 100, 100, 100),
+    ('?offset=110&limit=10', 110, 10, 10, None),
+])
+def test_warlog_pagination_bounds(client, app, monkeypatch, query, offset, limit, count, next_offset):
+    monkeypatch.setitem(app.config, 'READ_API_MAX_LIMIT', 100)
+    page = client.get('/data/warlog' + query).get_json()
+    assert page["paging"] == {"total": 120, "offset": offset, "limit": limit, "next_offset": next_offset}
+    assert len(page["items"]) == count
+
+def test_warlog_since_and_invalid_params(client):
+    wars = client.get('/data/warlog?limit=500').get_json()["items"]
+    since = wars[9]["endTime"]
+    page = client.get(f'/data/warlog?since={since}').get_json()
+    assert page["paging"]["total"] == 9
+    assert page["items"] == wars[:9]
+    assert client.get('/data/warlog?limit=abc').status_code == 400
+
+def test_warlog_page_etag(client):
+    first = client.get('/data/warlog?limit=5')
+    assert client.get('/data/warlog?limit=5', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert client.get('/data/warlog?limit=6').headers['ETag'] != first.headers['ETag']
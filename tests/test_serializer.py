@@ -0,0 +1,53 @@
+import io
+import json
+import gzip
+import pytest
+from app.services.serializer import spool_encoded, decode_payload, decode_text, detect_codec, content_hash
+
+SAMPLE = {"items": [{"endTime": "20240101T000000.000Z", "stars": 30}], "name": "clan", "ok": True, "none": None}
+
+@pytest.mark.parametrize("codec", ["json", "gzip", "msgpack"])
+def test_codec_round_trip(codec):
+    spool, mimetype = spool_encoded(SAMPLE, codec=codec)
+    with spool:
+        payload = spool.read()
+    assert detect_codec(payload) == codec
+    assert decode_payload(payload) == SAMPLE
+    assert decode_payload(memoryview(payload)) == SAMPLE
+
+@pytest.mark.parametrize("compact", [True, False])
+def test_json_layout(compact):
+    spool, _ = spool_encoded(SAMPLE, codec='json', compact=compact)
+    with spool:
+        text = spool.read().decode('utf-8')
+    assert json.loads(text) == SAMPLE
+    assert ('\n' in text) is not compact
+
+def test_msgpack_list_root():
+    spool, _ = spool_encoded([1, 2, 3], codec='msgpack')
+    with spool:
+        assert decode_payload(spool.read()) == [1, 2, 3]
+
+def test_json_with_utf8_bom_is_detected_as_json():
+    payload = b'\xef\xbb\xbf' + json.dumps(SAMPLE).encode('utf-8')
+    assert detect_codec(payload) == 'json'
+    assert decode_payload(payload) == SAMPLE
+    assert decode_text(payload) == json.dumps(SAMPLE)
+
+def test_unknown_prefix_is_rejected_instead_of_decoded_as_msgpack():
+    with pytest.raises(ValueError):
+        decode_payload(b'<html>not json</html>')
+
+def test_empty_payload():
+    assert decode_payload(b'') is None
+
+def test_decode_text_handles_gzip_and_memoryview():
+    raw = json.dumps(SAMPLE).encode('utf-8')
+    assert decode_text(gzip.compress(raw)) == raw.decode('utf-8')
+    assert decode_text(memoryview(raw)) == raw.decode('utf-8')
+
+def test_content_hash_rewinds():
+    data_io = io.BytesIO(b'abc')
+    first = content_hash(data_io)
+    assert data_io.tell() == 0
+    assert content_hash(data_io) == first
@@ -0,0 +1,116 @@
+import sqlite3
+from app.services.storage import StorageBackend, LocalStorage, WriteThroughStorage
+
+class FlakyMirror(StorageBackend):
+    """
+    Mirror giả: các lần ghi đầu tiên thất bại, sau đó ghi nhận nội dung theo tên tệp.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        self.writes = []
+        self.files = {}
+
+    async def preload_folder(self, folder_id):
+        return {"info": "noop"}
+
+    async def list_folder(self, folder_id):
+        return {"data": {}}
+
+    async def find_files(self, file_name, folder_id):
+        return [{'id': f"drive-{file_name}", 'name': file_name}] if file_name in self.files else []
+
+    async def delete_files(self, files, folder_id):
+        return []
+
+    async def upload_string(self, data_str, file_name, folder_id, num_backups_to_keep=1):
+        return await self.upload_object(data_str, file_name, folder_id, num_backups_to_keep)
+
+    async def upload_object(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+        self.writes.append(file_name)
+        if self.failures:
+            self.failures -= 1
+            return {"error": "Drive unavailable"}
+        self.files[file_name] = obj
+        return {"id": f"drive-{file_name}"}
+
+    async def get_text(self, file_name, folder_id):
+        return {"error": "not found"}
+
+    async def get_object(self, file_name, folder_id):
+        return {"error": "not found"}
+
+def test_failed_mirror_write_is_retried_when_unchanged(tmp_path, run):
+    mirror = FlakyMirror(failures=1)
+    storage = WriteThroughStorage(LocalStorage(str(tmp_path)), mirror)
+    data = {"wars": [1, 2, 3]}
+
+    first = run(storage.upload_object, data, 'war_log.json', 'wt', num_backups_to_keep=0)
+    run(WriteThroughStorage.flush)
+    assert "error" not in first and mirror.files == {}
+
+    second = run(storage.upload_object, data, 'war_log.json', 'wt', num_backups_to_keep=0)
+    run(WriteThroughStorage.flush)
+    assert second["status"] == "unchanged"
+    assert mirror.files == {'war_log.json': data}
+
+    run(storage.upload_object, data, 'war_log.json', 'wt', num_backups_to_keep=0)
+    run(WriteThroughStorage.flush)
+    assert mirror.writes == ['war_log.json', 'war_log.json']
+
+def test_shared_file_id_is_the_mirror_id(tmp_path, run):
+    storage = WriteThroughStorage(LocalStorage(str(tmp_path)), FlakyMirror(failures=0))
+    result = run(storage.upload_string, '{"a": 1}', '2024-01_round.json', 'wt')
+    assert result["id"] == 'wt/2024-01_round.json'
+    assert run(storage.shared_file_id, '2024-01_round.json', 'wt', result) == 'drive-2024-01_round.json'
+
+def test_shared_file_id_falls_back_to_primary_id(tmp_path, run):
+    storage = WriteThroughStorage(LocalStorage(str(tmp_path)), FlakyMirror(failures=1))
+    result = run(storage.upload_string, '{"a": 1}', '2024-01_round.json', 'wt')
+    assert run(storage.shared_file_id, '2024-01_round.json', 'wt', result) == 'wt/2024-01_round.json'
+
+def test_index_without_mirror_columns_is_migrated(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'index.sqlite3'))
+    conn.execute("CREATE TABLE files (folder_id TEXT NOT NULL, name TEXT NOT NULL, content_hash TEXT, "
+                 "size INTEGER, is_backup INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL, PRIMARY KEY (folder_id, name))")
+    conn.commit()
+    conn.close()
+    storage = LocalStorage(str(tmp_path))
+    assert storage.mirror_state_sync('missing.json', 'wt') == (None, None)
+
+def test_get_text_decodes_mapped_file(tmp_path, run):
+    storage = LocalStorage(str(tmp_path))
+    run(storage.upload_string, '\ufeff{"tên": "clan"}', 'clan_info.json', 'local')
+    assert run(storage.get_text, 'clan_info.json', 'local') == {"data": '{"tên": "clan"}'}
+
+def test_local_cron_pipeline_needs_no_google_credentials(app, run, monkeypatch):
+    from app import routes
+
+    async def no_credentials():
+        raise AssertionError("Google credentials must not be loaded for the local backend")
+    monkeypatch.setattr(routes, 'get_api_credentials', no_credentials)
+    monkeypatch.setitem(app.config, 'STORAGE_BACKEND', 'local')
+    result = run(routes._run_cron_pipeline, 'cwl_analytics')
+    assert "error" not in result, result
+
+def test_war_log_cursor_not_saved_when_an_upload_fails(app, run, monkeypatch, tmp_path):
+    from app import routes
+    from app.services.clans import get_clans
+
+    class FailingLast50(LocalStorage):
+        async def upload_object(self, obj, file_name, folder_id, num_backups_to_keep=1, compact=None, codec=None):
+            if file_name == 'war_log_50.json':
+                return {"error": "quota exceeded"}
+            return await super().upload_object(obj, file_name, folder_id, num_backups_to_keep, compact=compact, codec=codec)
+
+    async def fetch_war_log(token, clan, storage, budget=None):
+        return {"data": [{"endTime": "20240101T000000.000Z"}], "last50": [], "cursor": "20240101T000000.000Z"}
+
+    saved = []
+    async def save_war_log_cursor(clan, cursor, recent_wars=()):
+        saved.append(cursor)
+    monkeypatch.setattr(routes, 'fetch_war_log', fetch_war_log)
+    monkeypatch.setattr(routes, 'save_war_log_cursor', save_war_log_cursor)
+    monkeypatch.setitem(app.config, 'WARLOG_LAYOUT', 'single')
+    result = run(routes.process_clan_data, get_clans()[0], 'war_log', 'token', FailingLast50(str(tmp_path)), None)
+    assert result == {"error": "quota exceeded"}
+    assert saved == []
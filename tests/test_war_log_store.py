@@ -0,0 +1,46 @@
+from app.services.storage import LocalStorage
+from app.services.war_log_store import ShardedWarLog, merge_wars, manifest_file_name, load_war_log_view
+
+def war(end_time, stars=3):
+    return {"endTime": end_time, "clan": {"stars": stars}}
+
+def test_merge_wars_prefers_new_copy():
+    merged = merge_wars([war('20230101T000000.000Z'), war('20240101T000000.000Z', stars=1)],
+                        [war('20240101T000000.000Z', stars=2), war('20240201T000000.000Z')])
+    assert [(w["endTime"][:8], w["clan"]["stars"]) for w in merged] == [
+        ('20240201', 3), ('20240101', 2), ('20230101', 3)]
+
+def test_append_merges_shards_and_manifest(tmp_path, run):
+    storage = LocalStorage(str(tmp_path))
+    store = ShardedWarLog(storage, 'shards')
+    assert run(store.load_manifest) == {"data": None}
+    run(store.append, [war('20231231T000000.000Z'), war('20240101T000000.000Z')], num_backups_to_keep=0)
+
+    # Lần chạy sau: đọc lại manifest, một trận trùng endTime và một trận mới trong shard 2024
+    store = ShardedWarLog(storage, 'shards')
+    run(store.load_manifest)
+    result = run(store.append, [war('20240101T000000.000Z', stars=1), war('20240301T000000.000Z')], num_backups_to_keep=0)
+    assert result["shards"] == ['war_log_2024.json']
+
+    manifest = run(storage.get_object, manifest_file_name(), 'shards')["data"]
+    assert manifest["newest"] == '20240301T000000.000Z'
+    assert manifest["total"] == 3
+    assert [(shard["key"], shard["count"]) for shard in manifest["shards"]] == [('2024', 2), ('2023', 1)]
+    shard_2024 = run(storage.get_object, 'war_log_2024.json', 'shards')["data"]
+    assert [(w["endTime"][:8], w["clan"]["stars"]) for w in shard_2024] == [('20240301', 3), ('20240101', 1)]
+
+def test_read_is_lazy(tmp_path, run):
+    storage = LocalStorage(str(tmp_path))
+    store = ShardedWarLog(storage, 'lazy')
+    run(store.append, [war('20220101T000000.000Z'), war('20230101T000000.000Z'), war('20240101T000000.000Z')], num_backups_to_keep=0)
+
+    store = ShardedWarLog(storage, 'lazy')
+    run(store.load_manifest)
+    assert [w["endTime"][:4] for w in run(store.read, limit=1)] == ['2024']
+    assert list(store._shards) == ['war_log_2024.json']
+    assert run(store.read, limit=0) == []
+    assert len(run(load_war_log_view, storage, 'lazy')["data"]) == 3
+
+def test_view_without_manifest_is_an_error(tmp_path, run):
+    result = run(load_war_log_view, LocalStorage(str(tmp_path)), 'empty')
+    assert "not found" in result["error"]